@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Compare the image config parsers of docker_pull
+
+    ./benchmarks/bench_config_json.py [config.json ...]
+
+Real configs are the <hex>.json files of an image tar or the config blobs
+of --blob-cache, without them configs shaped like the ones of Docker Hub
+images are made up.
+"""
+
+import argparse
+import json
+import random
+import string
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import docker_pull  # noqa: E402
+
+# the RUN lines of real images, Go escapes the &, < and > of them
+COMMANDS = (
+    "apt-get update && apt-get install -y --no-install-recommends {w} "
+    "&& rm -rf /var/lib/apt/lists/*",
+    "set -eux; {w} > /dev/null 2>&1 || exit 1; echo '<done>'",
+    "#(nop) ADD file:{w} in / ",
+    "#(nop)  ENV {W}=/usr/local/{w}",
+    "#(nop)  LABEL maintainer=\"{w} <{w}@example.com>\"",
+)
+
+
+def make_config(layers: int, rnd: random.Random) -> bytes:
+    """A config as the registry serves it, with a history of layers"""
+
+    def word() -> str:
+        return "".join(rnd.choices(string.ascii_lowercase, k=8))
+
+    history = []
+    for _ in range(layers):
+        command = rnd.choice(COMMANDS).format(w=word(), W=word().upper())
+        history.append(
+            {
+                "created": "2024-01-02T03:04:05.123456789Z",
+                "created_by": f"/bin/sh -c {command}",
+                "comment": "buildkit.dockerfile.v0",
+            }
+        )
+
+    container = {
+        "Env": [f"{word().upper()}={word()}" for _ in range(10)],
+        "Cmd": ["/bin/sh", "-c", "exec app > /dev/null 2>&1"],
+        "Labels": {f"org.{word()}": f"{word()} & {word()}" for _ in range(5)},
+    }
+    config = {
+        "architecture": "amd64",
+        "config": container,
+        "created": "2024-01-02T03:04:05.123456789Z",
+        "history": history,
+        "os": "linux",
+        "rootfs": {
+            "type": "layers",
+            "diff_ids": [
+                "sha256:%064x" % rnd.getrandbits(256) for _ in range(layers)
+            ],
+        },
+    }
+    data = json.dumps(config, separators=(",", ":"))
+    for char in "&<>":
+        data = data.replace(char, "\\u%04x" % ord(char))
+
+    return data.encode()
+
+
+def configs(paths: list[Path]) -> dict[str, bytes]:
+    if paths:
+        return {path.name: path.read_bytes() for path in paths}
+
+    rnd = random.Random(0)
+    return {
+        f"{layers} layers": make_config(layers, rnd)
+        for layers in (5, 30, 120)
+    }
+
+
+def parse_reference(data: bytes):
+    """config parse of docker_pull before json_loads_raw"""
+
+    return json.loads(data, cls=docker_pull.JSONDecoderRawString)
+
+
+def best_time(parse, data: bytes, number: int) -> float:
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(number):
+            parse(data)
+        best = min(best, time.perf_counter() - started)
+
+    return best / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("configs", nargs="*", type=Path)
+    parser.add_argument(
+        "--number", type=int, default=200, help="Parses of a config per run"
+    )
+    args = parser.parse_args()
+
+    for name, data in configs(args.configs).items():
+        if docker_pull.json_loads_raw(data) != parse_reference(data):
+            raise SystemExit(f"{name}: json_loads_raw differs")
+
+        old = best_time(parse_reference, data, args.number)
+        new = best_time(docker_pull.json_loads_raw, data, args.number)
+        print(
+            f"{name:>20} {docker_pull.sizeof_fmt(len(data)):>10}: "
+            f"{old * 1e6:9.1f}us -> {new * 1e6:8.1f}us  x{old / new:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
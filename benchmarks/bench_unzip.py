@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Compare the layer extract engines of docker_pull against gzip.open
+
+    ./benchmarks/bench_unzip.py --size 512M
+"""
+
+import argparse
+import gzip
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import docker_pull  # noqa: E402
+
+
+def make_layer(path: Path, size: int) -> int:
+    """A gzip blob of about size bytes of text and binary data"""
+
+    rnd = random.Random(0)
+    letters = string.ascii_lowercase.encode()
+    words = [
+        bytes(rnd.choices(letters, k=rnd.randint(2, 9))) for _ in range(5000)
+    ]
+    text = b" ".join(rnd.choices(words, k=800000))
+
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    done = 0
+    with open(path, "wb") as f:
+        while done < size:
+            offset = rnd.randrange(len(text) - 65536)
+            block = text[offset : offset + 57344] + os.urandom(8192)
+            f.write(c.compress(block))
+            done += len(block)
+
+        f.write(c.flush())
+
+    return done
+
+
+def unzip_gzip_open(zip_file: Path, out_file: Path):
+    """unzip of docker_pull before the extract engines"""
+
+    with gzip.open(zip_file, "rb") as zip_data, open(out_file, "wb") as out:
+        while chunk := zip_data.read(131072):
+            out.write(chunk)
+
+
+def unzip_engine(isal: bool, tools: tuple[str, ...]):
+    def unzip(zip_file: Path, out_file: Path):
+        saved = docker_pull.isal_zlib, docker_pull.GZIP_TOOLS
+        docker_pull.isal_zlib = saved[0] if isal else None
+        docker_pull.GZIP_TOOLS = tools
+        try:
+            docker_pull.unzip(zip_file, out_file, remove_zip_file=False)
+        finally:
+            docker_pull.isal_zlib, docker_pull.GZIP_TOOLS = saved
+
+    return unzip
+
+
+def engines() -> dict:
+    found = {
+        "gzip.open": unzip_gzip_open,
+        "zlib, pipelined": unzip_engine(False, ()),
+    }
+    if docker_pull.isal_zlib:
+        found["isal, pipelined"] = unzip_engine(True, ())
+    else:
+        print("no python-isal, pip install isal", file=sys.stderr)
+
+    for tool in docker_pull.GZIP_TOOLS:
+        if docker_pull.shutil.which(tool):
+            found[f"{tool} process"] = unzip_engine(False, (tool,))
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--size",
+        type=docker_pull.parse_size,
+        default="256M",
+        help="Extracted size of the test layer (default: 256M)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs of every engine"
+    )
+    parser.add_argument(
+        "--dir", type=Path, default=None, help="Dir of the test files"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        zip_file = Path(tmp, "layer.gz")
+        out_file = Path(tmp, "layer.tar")
+        size = make_layer(zip_file, args.size)
+        print(
+            f"layer: {docker_pull.sizeof_fmt(size)}, "
+            f"gzip {docker_pull.sizeof_fmt(zip_file.stat().st_size)}, "
+            f"{os.cpu_count()} cpus"
+        )
+
+        base = None
+        for name, unzip in engines().items():
+            best = float("inf")
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                unzip(zip_file, out_file)
+                best = min(best, time.perf_counter() - started)
+
+                if out_file.stat().st_size != size:
+                    raise SystemExit(f"{name}: wrong size of the output")
+
+            base = base or best
+            print(
+                f"{name:>20}: {best:6.2f}s  "
+                f"{size / best / (1 << 20):7.1f} MiB/s  x{base / best:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
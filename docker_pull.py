@@ -1,27 +1,98 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
+import ctypes.util
 import dataclasses
 import datetime
+import email.utils
+import fcntl
 import getpass
-import gzip
 import hashlib
 import json
 import logging
 import os
 import platform as os_platform
+import queue
+import random
+import re
 import shutil
+import ssl as ssl_lib
 import struct
+import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 import urllib.parse as urlparse
+import zlib
 from pathlib import Path
 from posixpath import join as path_join
+from typing import BinaryIO
 
 import requests
 import requests.auth
 
+try:
+    # ISA-L inflates gzip several times faster than zlib
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
 JSON_SEPARATOR = (",", ":")
+# linux/fs.h, clone a file extent by extent on btrfs/xfs
+FICLONE = 0x40049409
+# how often the hash state of a downloading blob is saved
+HASH_CHECKPOINT_INTERVAL = 64 << 20
+# registries treat a token without expires_in as valid for 60 seconds
+TOKEN_DEFAULT_EXPIRES_IN = 60
+# a token is renewed when it expires in less than that, a long blob
+# transfer gets more slack to survive redirects and range requests
+TOKEN_MIN_TTL = 10
+TOKEN_BLOB_MIN_TTL = 30
+# (connect, read) timeouts of registry requests, a stalled transfer is
+# retried rather than waited for forever
+REQUEST_TIMEOUT = (30, 300)
+# share of the registry rate limit left when requests start to be spread
+# over the rest of its window
+RATELIMIT_RESERVE = 0.2
+# a mirror failed a request is tried after the healthy ones for a while
+MIRROR_RETRY_AFTER = 60
+# errors of corrupt gzip data
+INFLATE_ERRORS = (zlib.error, isal_zlib.error) if isal_zlib else (zlib.error,)
+# errors of a corrupt blob, its partial download is not worth resuming
+BLOB_ERRORS = (ValueError, EOFError, *INFLATE_ERRORS)
+# gzip tools extracting a layer in a process of their own, when python-isal
+# is not installed
+GZIP_TOOLS = ("igzip", "pigz")
+# the zstandard package can't limit the output of a step, so it is fed the
+# input in slices of at least that, sized by the compression ratio seen
+ZSTD_MIN_INPUT = 64
+# chunks queued for the writer thread of an extracted layer
+WRITE_QUEUE_DEPTH = 8
+# buffers of a blob transfer: the chunk read, the decompressed ones and
+# the chunks queued for the writer thread
+TRANSFER_MEMORY = (WRITE_QUEUE_DEPTH + 4) * 131072
+# layers of a tar downloaded ahead of the one written, per job
+PREFETCH_LAYERS_PER_JOB = 2
+# largest manifest or config read into memory
+MAX_BODY_SIZE = 16 << 20
+# response bodies are cut to that in the debug log
+LOG_BODY_LIMIT = 1024
+# the \\ and \u escapes of JSON strings, escaped once more to keep the
+# \uXXXX ones raw
+RAW_ESCAPE = re.compile(r"\\[\\u]")
+RAW_ESCAPES = {"\\\\": "\\\\", "\\u": "\\\\u"}
+# a \u escape JSONDecoderRawString takes 4 chars of whatever they are with
+BAD_ESCAPE = re.compile(r"\\u(?![0-9A-Fa-f]{4})")
+# images whose v1 layer ids are kept, the tags and platforms of a pull
+LAYER_IDS_CACHE_SIZE = 64
 
 
 # based on json.decoder.py_scanstring
@@ -83,6 +154,45 @@ class JSONDecoderRawString(json.JSONDecoder):
         self.scan_once = json.scanner.py_make_scanner(self)
 
 
+def json_loads_raw(s: str | bytes):
+    """json.loads with JSONDecoderRawString, by the C scanner
+
+    The \\uXXXX escapes are escaped once more, so the C scanner keeps them
+    in the strings as is. JSONDecoderRawString decodes them in object keys,
+    the rare document with one there or with a malformed escape is left
+    to it.
+    """
+
+    if isinstance(s, bytes):
+        s = s.decode(json.detect_encoding(s), "surrogatepass")
+
+    if "\\u" not in s:
+        return json.loads(s)
+
+    if BAD_ESCAPE.search(s):
+        return json.loads(s, cls=JSONDecoderRawString)
+
+    if "\\\\" in s:
+        raw = RAW_ESCAPE.sub(lambda m: RAW_ESCAPES[m[0]], s)
+    else:
+        raw = s.replace("\\u", "\\\\u")
+
+    escaped_keys = []
+
+    def check_keys(obj: dict) -> dict:
+        # a key ending with \ before one starting with u only costs time
+        if "\\u" in "".join(obj):
+            escaped_keys.append(obj)
+
+        return obj
+
+    obj = json.loads(raw, object_hook=check_keys)
+    if escaped_keys:
+        return json.loads(s, cls=JSONDecoderRawString)
+
+    return obj
+
+
 class StructClassesJSONEncoder(json.JSONEncoder):
     def default(self, o):
         if dataclasses.is_dataclass(o):
@@ -272,6 +382,18 @@ class Manifest:
     Layers: list[str] = dataclasses.field(default_factory=list)
 
 
+@dataclasses.dataclass
+class ImageLayer:
+    id: str
+    json: str
+    digest: str
+    media_type: str
+    size: int = 0
+    # id of the previous layer with the same digest
+    link: str = None
+    diff_id: str = None
+
+
 @dataclasses.dataclass
 class ManifestList:
     manifests: list[Manifest] = dataclasses.field(default_factory=list)
@@ -285,6 +407,105 @@ class ManifestList:
         return json.dumps(r, separators=JSON_SEPARATOR, ensure_ascii=False)
 
 
+@dataclasses.dataclass
+class PullResult:
+    image: str
+    digest: str = None
+    error: Exception = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclasses.dataclass
+class PlannedImage:
+    image: str
+    img: "ImageParser"
+    # media type, dir name and manifest digest of the image tars
+    targets: list[tuple[str, str, str]] = dataclasses.field(
+        default_factory=list
+    )
+    # Docker-Content-Digest of an --incremental pull
+    manifest_digest: str = None
+    # image digest of an image whose tars are up to date
+    up_to_date: str = None
+    error: Exception = None
+
+
+@dataclasses.dataclass
+class PlannedBlob:
+    layer: ImageLayer
+    registry: str
+    url: str
+    # tars the blob goes to
+    consumers: list[str] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class PullPlan:
+    images: list[PlannedImage] = dataclasses.field(default_factory=list)
+    blobs: dict[str, PlannedBlob] = dataclasses.field(default_factory=dict)
+    # bytes downloaded when every image tar is pulled on its own
+    naive_size: int = 0
+    # tars built so far, see release
+    built: set[str] = dataclasses.field(default_factory=set)
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    @property
+    def unique_size(self) -> int:
+        return sum(blob.layer.size for blob in self.blobs.values())
+
+    def summary(self) -> str:
+        lines = []
+        blobs = sorted(self.blobs.values(), key=lambda b: -b.layer.size)
+        for blob in blobs:
+            lines.append(
+                f"{blob.layer.digest[7:19]}  "
+                f"{sizeof_fmt(blob.layer.size):>10}  "
+                f"x{len(blob.consumers)}  {', '.join(blob.consumers)}"
+            )
+
+        for planned in self.images:
+            if planned.error:
+                lines.append(f"{planned.image}: FAILED ({planned.error})")
+            elif planned.up_to_date:
+                lines.append(f"{planned.image}: up to date")
+
+        saved = self.naive_size - self.unique_size
+        lines.append(
+            f"{len(self.blobs)} unique blobs, "
+            f"{sizeof_fmt(self.unique_size)} to download instead of "
+            f"{sizeof_fmt(self.naive_size)} (saves {sizeof_fmt(saved)})"
+        )
+
+        return "\n".join(lines)
+
+    def merge(self, other: "PullPlan"):
+        self.images.extend(other.images)
+        self.naive_size += other.naive_size
+        for digest, blob in other.blobs.items():
+            if digest in self.blobs:
+                self.blobs[digest].consumers.extend(blob.consumers)
+            else:
+                self.blobs[digest] = blob
+
+    def release(self, dir_names: list[str]) -> list[str]:
+        """Digests of the blobs no tar needs once dir_names are built"""
+
+        with self._lock:
+            self.built.update(dir_names)
+            return [
+                digest
+                for digest, blob in self.blobs.items()
+                if any(name in blob.consumers for name in dir_names)
+                and self.built.issuperset(blob.consumers)
+            ]
+
+
 class FilesManager:
     def __init__(self, work_dir: str | Path):
         if isinstance(work_dir, str):
@@ -303,7 +524,10 @@ class FilesManager:
 
     def _join_path(self, p: Path) -> Path:
         path = self._work_dir.joinpath(p)
-        path.resolve().relative_to(p.parent.resolve())
+        # no symlinks are followed, the layer.tar of a repeated layer is one
+        Path(os.path.abspath(path)).relative_to(
+            os.path.abspath(self._work_dir)
+        )
 
         return path
 
@@ -340,6 +564,419 @@ class FilesManager:
         return self._work_dir.resolve()
 
 
+class BlobCache:
+    """Content-addressed store of registry blobs shared between pulls"""
+
+    def __init__(self, cache_dir: str | Path, max_size: int = 0):
+        self._dir = Path(cache_dir).expanduser()
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    def path(self, digest: str) -> Path:
+        algo, hex_digest = digest.split(":", 1)
+        return self._dir.joinpath(algo, hex_digest)
+
+    def get(self, digest: str) -> Path | None:
+        path = self.path(digest)
+        try:
+            # mtime is the last use of the blob, see _evict
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        logging.debug(f"Blob cache hit {digest}")
+        return path
+
+    def read(self, digest: str) -> bytes | None:
+        path = self.get(digest)
+        if path is None:
+            return None
+
+        return path.read_bytes()
+
+    def link(self, digest: str, dst: Path) -> bool:
+        path = self.get(digest)
+        if path is None:
+            return False
+
+        try:
+            link_file(path, dst)
+        except FileNotFoundError:
+            # evicted by a concurrent pull
+            return False
+
+        return True
+
+    def temp_path(self, digest: str, suffix: str = "part") -> Path:
+        path = self.path(digest)
+        path.parent.mkdir(0o755, True, True)
+
+        # hidden files are skipped by _evict. The name is taken with
+        # O_EXCL as mkstemp does, as other processes may share the cache,
+        # but the file gets the mode of the umask like the blobs.
+        while True:
+            token = f"{os.getpid()}.{os.urandom(4).hex()}"
+            tmp = path.with_name(f".{path.name}.{token}.{suffix}")
+            try:
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                continue
+
+            os.close(fd)
+            return tmp
+
+    def put(self, digest: str, src: Path, verified: bool = False):
+        if not verified and sha256sum(src) != digest.split(":", 1)[1]:
+            raise ValueError(f"{src}: digest mismatch, expected {digest}")
+
+        path = self.path(digest)
+        tmp = self.temp_path(digest, "tmp")
+        link_file(src, tmp)
+        os.replace(tmp, path)
+        # rename does nothing when both are links of the same file
+        tmp.unlink(missing_ok=True)
+
+        self._evict()
+
+    def put_bytes(self, digest: str, data: bytes):
+        if hashlib.sha256(data).hexdigest() != digest.split(":", 1)[1]:
+            raise ValueError(f"digest mismatch, expected {digest}")
+
+        path = self.path(digest)
+        tmp = self.temp_path(digest, "tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+        self._evict()
+
+    def _evict(self):
+        if not self._max_size:
+            return
+
+        with self._lock:
+            blobs = []
+            total = 0
+            for path in self._dir.glob("*/*"):
+                if path.name.startswith("."):
+                    continue
+
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+
+                blobs.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+            for _, size, path in sorted(blobs):
+                if total <= self._max_size:
+                    break
+
+                logging.debug(f"Evict {path} from blob cache")
+                path.unlink(missing_ok=True)
+                total -= size
+
+
+class TokenCache:
+    """Bearer tokens by (realm, service, scope, user), kept until expiry
+
+    With a path the tokens and auth challenges are stored on disk between
+    runs, in a file readable by the owner only.
+    """
+
+    def __init__(self, path: str | Path = None):
+        self._path = Path(path).expanduser() if path else None
+        self._lock = threading.Lock()
+        self._tokens: dict[tuple, tuple[str, float]] = {}
+        self._challenges: dict[str, dict] = {}
+
+        if self._path:
+            self._load()
+
+    def _load(self):
+        try:
+            st = self._path.stat()
+        except FileNotFoundError:
+            return
+
+        if st.st_mode & 0o077 or st.st_uid != os.getuid():
+            logging.warning(f"{self._path}: unsafe permissions, not used")
+            return
+
+        try:
+            data = json.loads(self._path.read_text())
+        except ValueError:
+            logging.warning(f"{self._path}: broken token cache, not used")
+            return
+
+        now = time.time()
+        for item in data.get("tokens", []):
+            if item["expires"] > now:
+                key = tuple(item["key"])
+                self._tokens[key] = (item["token"], item["expires"])
+
+        self._challenges.update(data.get("challenges", {}))
+
+    def _save(self):
+        if not self._path:
+            return
+
+        now = time.time()
+        data = {
+            "tokens": [
+                {"key": key, "token": token, "expires": expires}
+                for key, (token, expires) in self._tokens.items()
+                if expires > now
+            ],
+            "challenges": self._challenges,
+        }
+
+        self._path.parent.mkdir(0o700, True, True)
+        tmp = self._path.with_name(f".{self._path.name}.{os.getpid()}")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self._path)
+
+    def get(self, key: tuple, min_ttl: float = 0) -> str | None:
+        with self._lock:
+            token, expires = self._tokens.get(key, (None, 0))
+            if expires - time.time() > min_ttl:
+                return token
+
+            return None
+
+    def put(self, key: tuple, token: str, expires_in: float = None):
+        expires = time.time() + (expires_in or TOKEN_DEFAULT_EXPIRES_IN)
+        with self._lock:
+            self._tokens[key] = (token, expires)
+            self._save()
+
+    def discard(self, key: tuple, token: str):
+        """Forget the token rejected by the registry"""
+
+        with self._lock:
+            if self._tokens.get(key, (None,))[0] == token:
+                del self._tokens[key]
+                self._save()
+
+    def challenge(self, host: str) -> dict | None:
+        return self._challenges.get(host)
+
+    def set_challenge(self, host: str, challenge: dict):
+        with self._lock:
+            if self._challenges.get(host) != challenge:
+                self._challenges[host] = challenge
+                self._save()
+
+
+class MemoryBudget:
+    """Bytes of buffers the transfers of a pull may hold at once
+
+    A transfer reserves its buffers before it starts and waits while the
+    budget is spent, which holds back the downloads when extracting or
+    writing falls behind. A reservation over the whole budget waits for
+    all the others to finish, so it is never stuck.
+    """
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, size: int):
+        if not self.limit:
+            yield
+            return
+
+        with self._cond:
+            while self.used and self.used + size > self.limit:
+                self._cond.wait()
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= size
+                self._cond.notify_all()
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    """Exponential backoff with jitter for transient registry failures
+
+    Shared by all the registries of a fetcher, it also counts the retries
+    and the time spent waiting for them.
+    """
+
+    attempts: int = 5
+    backoff: float = 0.5
+    max_backoff: float = 30.0
+    max_retry_after: float = 600.0
+    statuses: tuple = (429, 500, 502, 503, 504)
+
+    retries: int = 0
+    backoff_time: float = 0.0
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    # a connection lost before or during a response
+    ERRORS = (
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    )
+
+    def delay(
+        self, attempt: int, reason: object, retry_after: str = None
+    ) -> float | None:
+        """Seconds to wait before the attempt, None when out of attempts"""
+
+        if attempt >= self.attempts:
+            return None
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    date = email.utils.parsedate_to_datetime(retry_after)
+                    delay = date.timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+            delay = min(max(delay, 0.0), self.max_retry_after)
+
+        logging.warning(
+            f"{reason}, retry {attempt}/{self.attempts - 1} in {delay:.1f}s"
+        )
+        with self._lock:
+            self.retries += 1
+            self.backoff_time += delay
+
+        return delay
+
+
+@dataclasses.dataclass
+class HostPace:
+    # theoretical arrival time of the next request, see Throttle
+    tat: float = 0.0
+    # min gaps between requests learned from 429 and rate-limit headers
+    backoff: float = 0.0
+    ratelimit: float = 0.0
+
+
+class Throttle:
+    """Request pacing per registry host and a download bandwidth cap
+
+    Both are token buckets shared by all the concurrent fetches. The
+    methods return the delay to wait, so threads and coroutines can use
+    the same throttle. The pace of a host also slows down on 429 responses
+    and when its rate-limit headers show the limit running out.
+    """
+
+    def __init__(self, rate: float = 0.0, bandwidth: int = 0):
+        self._interval = 1 / rate if rate > 0 else 0.0
+        self._burst = max(rate, 1.0)
+        self._byte_interval = 1 / bandwidth if bandwidth > 0 else 0.0
+        self._byte_tat = 0.0
+        self._hosts: dict[str, HostPace] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _reserve(
+        tat: float, cost: float, tolerance: float
+    ) -> tuple[float, float]:
+        # generic cell rate algorithm, cost and tolerance are in seconds
+        now = time.monotonic()
+        tat = max(tat, now) + cost
+
+        return tat, max(tat - tolerance - now, 0.0)
+
+    def request_delay(self, host: str) -> float:
+        with self._lock:
+            pace = self._hosts.setdefault(host, HostPace())
+
+            interval, burst = self._interval, self._burst
+            adaptive = max(pace.backoff, pace.ratelimit)
+            if adaptive > interval:
+                interval, burst = adaptive, 1.0
+
+            if not interval:
+                return 0.0
+
+            pace.tat, delay = self._reserve(
+                pace.tat, interval, burst * interval
+            )
+
+        return delay
+
+    def transfer_delay(self, size: int) -> float:
+        if not self._byte_interval:
+            return 0.0
+
+        with self._lock:
+            # up to a second of the bandwidth can go at once
+            self._byte_tat, delay = self._reserve(
+                self._byte_tat, size * self._byte_interval, 1.0
+            )
+
+        return delay
+
+    def observe(self, host: str, status: int, headers: dict):
+        """Adjust the pace of the host by the response"""
+
+        limit = self._ratelimit(headers.get("ratelimit-limit"))
+        remaining = self._ratelimit(headers.get("ratelimit-remaining"))
+
+        with self._lock:
+            pace = self._hosts.setdefault(host, HostPace())
+
+            if status == requests.codes.too_many_requests:
+                pace.backoff = min(max(pace.backoff * 2, 0.2), 10.0)
+            elif pace.backoff:
+                pace.backoff = pace.backoff * 0.9 if pace.backoff > 0.05 else 0
+
+            if limit and remaining:
+                count, window = remaining
+                if count < limit[0] * RATELIMIT_RESERVE and window:
+                    if not pace.ratelimit:
+                        logging.warning(
+                            f"{host}: {count} requests left of the rate "
+                            f"limit, slowing down"
+                        )
+                    pace.ratelimit = window / max(count, 1)
+                else:
+                    pace.ratelimit = 0.0
+
+    @staticmethod
+    def _ratelimit(value: str) -> tuple[int, int] | None:
+        """Count and window of a header like 100;w=21600"""
+
+        if not value:
+            return None
+
+        count, _, params = value.partition(";")
+        window = 0
+        for param in params.split(";"):
+            k, _, v = param.strip().partition("=")
+            if k == "w" and v.isdigit():
+                window = int(v)
+
+        try:
+            return int(count), window
+        except ValueError:
+            return None
+
+
 class EmptyProgressBar:
     def __init__(self, *args, **kwargs):
         pass
@@ -352,6 +989,9 @@ class EmptyProgressBar:
 
 
 class ProgressBar:
+    # layers may be fetched concurrently, keep their lines from interleaving
+    _print_lock = threading.Lock()
+
     def __init__(self, progressbar_length: int = 96):
         self._end = "\r"
         self._description = ""
@@ -404,70 +1044,325 @@ class ProgressBar:
             fill = self._progressbar_length - len(self._description)
             progress_bar_str = f'{self._description}{" " * fill}'
 
-        print(progress_bar_str, end=self._end, flush=True)
+        with self._print_lock:
+            print(progress_bar_str, end=self._end, flush=True)
+
+
+class RegistryAuth:
+    """Authorization of registry requests, shared by both clients
 
+    The token of a repository is picked from the token cache before the
+    request, a 401 response only teaches the realm and the scope.
+    """
+
+    _REPO_RE = re.compile(r"^/v2/(.+)/(?:manifests|blobs)/[^/]+$")
 
-class Registry:
     def __init__(
         self,
         credentials: requests.auth.HTTPBasicAuth = None,
-        ssl: bool = True,
+        token_cache: TokenCache = None,
     ):
         self.__credentials = credentials
-        self._ssl = ssl
-        self._session = requests.Session()
+        self._tokens = token_cache if token_cache is not None else TokenCache()
+        self._basic = False
+        # scopes of the 401 responses by repository
+        self._scopes: dict[tuple[str, str], str] = {}
 
-    def _auth(self, resp: requests.Response):
-        if not resp.headers.get("www-authenticate"):
+    def _basic_header(self) -> dict:
+        if not self.__credentials:
+            return {}
+
+        creds = f"{self.__credentials.username}:{self.__credentials.password}"
+        token = base64.b64encode(creds.encode()).decode()
+
+        return {"Authorization": f"Basic {token}"}
+
+    def _token_key(self, url: str) -> tuple | None:
+        u = urlparse.urlsplit(url)
+        challenge = self._tokens.challenge(u.netloc)
+        if not challenge:
+            return None
+
+        m = self._REPO_RE.match(u.path)
+        repo = m.group(1) if m else ""
+        scope = self._scopes.get((u.netloc, repo))
+        if scope is None:
+            scope = f"repository:{repo}:pull" if repo else ""
+
+        user = self.__credentials.username if self.__credentials else ""
+
+        return challenge["realm"], challenge["service"], scope, user
+
+    def _auth_header(self, url: str, min_ttl: float = 0) -> dict:
+        if self._basic:
+            return self._basic_header()
+
+        key = self._token_key(url)
+        token = self._tokens.get(key, min_ttl) if key else None
+        if not token:
+            return {}
+
+        return {"Authorization": f"Bearer {token}"}
+
+    def _token_request(
+        self, url: str, www_authenticate: str, rejected: dict
+    ) -> tuple[tuple, str] | None:
+        """Learn the challenge, the token url when a new token is needed"""
+
+        if not www_authenticate:
             raise ValueError("empty the www-authenticate header")
 
-        auth_scheme, parsed = www_auth(resp.headers["www-authenticate"])
+        auth_scheme, parsed = www_auth(www_authenticate)
         if auth_scheme.lower() == "basic":
-            self.__credentials(self._session)
-            return
+            self._basic = True
+            return None
+
+        u = urlparse.urlsplit(url)
+        self._tokens.set_challenge(
+            u.netloc, {"realm": parsed["realm"], "service": parsed["service"]}
+        )
+        m = self._REPO_RE.match(u.path)
+        self._scopes[(u.netloc, m.group(1) if m else "")] = parsed.get(
+            "scope", ""
+        )
+
+        key = self._token_key(url)
+        bearer = rejected.get("Authorization", "").removeprefix("Bearer ")
+        if bearer:
+            self._tokens.discard(key, bearer)
+        elif self._tokens.get(key, TOKEN_MIN_TTL):
+            # fetched by a concurrent request meanwhile
+            return None
 
         url_parts = list(urlparse.urlparse(parsed["realm"]))
 
         query = urlparse.parse_qs(url_parts[4])
         query.update(service=parsed["service"])
-        scope = parsed.get("scope")
-        if scope:
-            query.update(scope=scope)
+        if key[2]:
+            query.update(scope=key[2])
 
         url_parts[4] = urlparse.urlencode(query, True)
 
-        r = self._session.get(
-            urlparse.urlunparse(url_parts), auth=self.__credentials
+        return key, urlparse.urlunparse(url_parts)
+
+    def _save_token(self, key: tuple, resp: dict):
+        token = resp.get("token") or resp["access_token"]
+        self._tokens.put(key, token, resp.get("expires_in"))
+
+
+class Registry(RegistryAuth):
+    def __init__(
+        self,
+        credentials: requests.auth.HTTPBasicAuth = None,
+        ssl: bool = True,
+        pool_size: int = 10,
+        token_cache: TokenCache = None,
+        retry: RetryPolicy = None,
+        throttle: Throttle = None,
+        memory: MemoryBudget = None,
+    ):
+        super().__init__(credentials, token_cache)
+        self._ssl = ssl
+        self._session = requests.Session()
+        self._auth_lock = threading.Lock()
+        self._retry = retry or RetryPolicy()
+        self._throttle = throttle or Throttle()
+        self._memory = memory or MemoryBudget()
+
+        # keep-alive connections per host, enough for all parallel transfers
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def _auth(self, url: str, resp: requests.Response, rejected: dict):
+        with self._auth_lock:
+            req = self._token_request(
+                url, resp.headers.get("www-authenticate"), rejected
+            )
+            if req is None:
+                return
+
+            key, token_url = req
+            r = self._session.get(token_url, headers=self._basic_header())
+            r.raise_for_status()
+
+            self._save_token(key, r.json())
+
+    def _send(
+        self, method: str, url: str, headers: dict, stream: bool
+    ) -> requests.Response:
+        # streamed requests are blob transfers
+        min_ttl = TOKEN_BLOB_MIN_TTL if stream else TOKEN_MIN_TTL
+
+        auth = self._auth_header(url, min_ttl)
+        r = self._throttled_request(
+            method, url, {**(headers or {}), **auth}, stream
+        )
+        if r.status_code == requests.codes.unauthorized:
+            # drain the body, so the connection goes back to the pool
+            r.content
+            self._auth(url, r, auth)
+            auth = self._auth_header(url)
+            r = self._throttled_request(
+                method, url, {**(headers or {}), **auth}, stream
+            )
+
+        return r
+
+    def _throttled_request(
+        self, method: str, url: str, headers: dict, stream: bool
+    ) -> requests.Response:
+        host = urlparse.urlsplit(url).netloc
+        time.sleep(self._throttle.request_delay(host))
+
+        r = self._session.request(
+            method,
+            url,
+            headers=headers,
+            stream=True,
+            timeout=REQUEST_TIMEOUT,
         )
-        r.raise_for_status()
+        self._throttle.observe(host, r.status_code, r.headers)
+        if not stream:
+            self._read_body(method, url, r)
 
-        a_str = f"{auth_scheme} {r.json()['token']}"
-        self._session.headers["Authorization"] = a_str
+        return r
 
     def get(
         self, url: str, *, headers: dict = None, stream: bool = None
+    ) -> requests.Response:
+        return self.request("GET", url, headers=headers, stream=stream)
+
+    def head(self, url: str, *, headers: dict = None) -> requests.Response:
+        return self.request("HEAD", url, headers=headers)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        headers: dict = None,
+        stream: bool = None,
     ) -> requests.Response:
         if not url.startswith("http"):
             url = f"http{'s' if self._ssl else ''}://{url}"
 
         logging.debug("Request headers: %s", json.dumps(headers))
-        r = self._session.get(url, headers=headers, stream=stream)
-        if r.status_code == requests.codes.unauthorized:
-            self._auth(r)
-            r = self._session.get(url, headers=headers, stream=stream)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                r = self._send(method, url, headers, stream)
+            except self._retry.ERRORS as e:
+                delay = self._retry.delay(attempt, f"{url}: {e}")
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
 
-        if r.status_code != requests.codes.ok:
+            if r.status_code not in self._retry.statuses:
+                break
+
+            delay = self._retry.delay(
+                attempt,
+                f"{url}: status code {r.status_code}",
+                r.headers.get("Retry-After"),
+            )
+            if delay is None:
+                break
+            r.content
+            time.sleep(delay)
+
+        if r.status_code not in [
+            requests.codes.ok,
+            requests.codes.partial_content,
+        ]:
             logging.error(
-                f"Status code: {r.status_code}, Response: {r.content}"
+                f"Status code: {r.status_code}, "
+                f"Response: {log_body(r.content)}"
             )
             r.raise_for_status()
 
         logging.debug("Response headers: %s", json.dumps(r.headers.__dict__))
         if not stream:
-            logging.debug("Response body: %s", r.content)
+            logging.debug("Response body: %s", log_body(r.content))
 
         return r
 
+    def _read_body(self, method: str, url: str, r: requests.Response):
+        """Read the body of a non-streamed request into r.content, like
+        requests does, but refuse the ones over MAX_BODY_SIZE
+        """
+
+        if method == "HEAD":
+            r.content
+            return
+
+        size = int(r.headers.get("Content-Length") or MAX_BODY_SIZE)
+        body = bytearray()
+        with self._memory.reserve(min(size, MAX_BODY_SIZE)):
+            if size <= MAX_BODY_SIZE:
+                for chunk in r.iter_content(chunk_size=131072):
+                    body += chunk
+                    if len(body) > MAX_BODY_SIZE:
+                        break
+
+        if size > MAX_BODY_SIZE or len(body) > MAX_BODY_SIZE:
+            r.close()
+            raise ValueError(
+                f"{url}: response body is over {sizeof_fmt(MAX_BODY_SIZE)}"
+            )
+
+        r._content = bytes(body)
+
+    def _iter_content(
+        self,
+        url: str,
+        r: requests.Response,
+        headers: dict = None,
+        *,
+        offset: int = 0,
+        end: int = None,
+    ):
+        """Chunks of a blob response, resumed by a range request when the
+        connection breaks. offset and end are the blob range of r.
+        """
+
+        attempt = 0
+        skip = 0
+        while True:
+            try:
+                for chunk in r.iter_content(chunk_size=131072):
+                    if skip:
+                        # the registry resent the blob from the start
+                        n = min(skip, len(chunk))
+                        chunk = chunk[n:]
+                        skip -= n
+
+                    if chunk:
+                        offset += len(chunk)
+                        time.sleep(self._throttle.transfer_delay(len(chunk)))
+                        yield chunk
+
+                return
+            except self._retry.ERRORS as e:
+                attempt += 1
+                delay = self._retry.delay(attempt, f"{url}: {e}")
+                if delay is None:
+                    raise
+
+            time.sleep(delay)
+            rng = f"bytes={offset}-{'' if end is None else end}"
+            r = self.get(
+                url, headers={**(headers or {}), "Range": rng}, stream=True
+            )
+            if r.status_code == requests.codes.ok:
+                if end is not None:
+                    raise ValueError(f"{url}: range {rng} is not supported")
+                skip = offset
+
     def fetch_blob(
         self,
         url: str,
@@ -476,334 +1371,3230 @@ class Registry:
         sha256: str = None,
         headers: dict = None,
         progress: ProgressBar = EmptyProgressBar(),
+        cache: BlobCache = None,
+        stream: bool = True,
+        extract: bool = True,
+        size: int = 0,
+        segments: int = 1,
+        media_type: str = None,
+        resume: bool = True,
     ):
+        """Download a layer blob and extract it to out_file
+
+        With extract=False only the compressed blob is saved, next to
+        out_file with the .gz suffix. The blob of known size is fetched by
+        several range requests at once when segments > 1. The media type
+        picks the decompressor, gzip by default. With resume=False a
+        streamed blob is not saved for a next run to resume it.
+        """
 
-        mode = "wb"
-        done = 0
         layer_id_short = os.path.basename(url)[7:19]
         temp_file = out_file.with_suffix(".gz")
 
-        if temp_file.exists():
-            done = temp_file.stat().st_size
-            if done:
-                logging.debug(f'resume download layer blob "{temp_file}"')
-                mode = "ab"
+        if cache and sha256 and cache.link(f"sha256:{sha256}", temp_file):
+            if extract:
+                self._extract(
+                    temp_file,
+                    out_file,
+                    layer_id_short,
+                    progress,
+                    "Already exists",
+                    media_type,
+                )
+            else:
+                progress.flush(f"{layer_id_short}: Already exists")
 
-            if sha256sum(temp_file) == sha256:
-                if progress:
-                    progress.flush(f"{layer_id_short}: Pull complete")
+            return
 
-                logging.debug(f"File {temp_file} is up to date")
-                return
+        if stream and extract and segments < 2 and not temp_file.exists():
+            # the compressed blob is saved as well, so a next run resumes
+            # an interrupted download, and it goes to the cache on success.
+            # It takes as much scratch space as the saved path does.
+            tee_file = temp_file if resume or (cache and sha256) else None
+            with open(out_file, "wb") as f:
+                self._fetch_extracting(
+                    url,
+                    f,
+                    tee_file,
+                    sha256=sha256,
+                    headers=headers,
+                    progress=progress,
+                    checkpoint=resume,
+                    media_type=media_type,
+                )
+
+            if tee_file:
+                if cache and sha256:
+                    cache.put(f"sha256:{sha256}", tee_file, verified=True)
+
+                os.remove(tee_file)
+            progress.flush(f"{layer_id_short}: Pull complete")
 
-            headers["Range"] = f"bytes={done}-"
+            return
 
-        progress.update_description(f"{layer_id_short}: Pulling fs layer")
-        progress.set_size(0)
-        progress.write(0)
+        self._download(
+            url,
+            temp_file,
+            sha256=sha256,
+            headers=headers,
+            progress=progress,
+            size=size,
+            segments=segments,
+        )
 
-        r = self.get(url, headers=headers, stream=True)
+        # the blob is verified by _download
+        if cache and sha256:
+            cache.put(f"sha256:{sha256}", temp_file, verified=True)
+
+        if extract:
+            self._extract(
+                temp_file,
+                out_file,
+                layer_id_short,
+                progress,
+                media_type=media_type,
+            )
+        else:
+            progress.flush(f"{layer_id_short}: Download complete")
 
-        progress.update_description(f"{layer_id_short}: Downloading")
-        progress.set_size(int(r.headers.get("Content-Length", 0)))
+    def fetch_blob_into(
+        self,
+        url: str,
+        out: BinaryIO,
+        *,
+        sha256: str = None,
+        headers: dict = None,
+        progress: ProgressBar = EmptyProgressBar(),
+        cache: BlobCache = None,
+        media_type: str = None,
+    ):
+        """Download a layer blob and write it extracted to a file object"""
 
-        with open(temp_file, mode) as f:
-            for chunk in r.iter_content(chunk_size=131072):
-                if chunk:
-                    f.write(chunk)
-                    done += len(chunk)
+        layer_id_short = os.path.basename(url)[7:19]
+        digest = f"sha256:{sha256}"
 
-                    if progress:
-                        progress.write(done)
+        cached = cache.get(digest) if cache and sha256 else None
+        if cached:
+            progress.update_description(f"{layer_id_short}: Extracting")
+            unzip_to(cached, out, progress=progress, media_type=media_type)
+            progress.flush(f"{layer_id_short}: Already exists")
 
-        progress.update_description(f"{layer_id_short}: Extracting")
+            return
 
-        unzip(temp_file, out_file, progress=progress)
+        tee_file = cache.temp_path(digest) if cache and sha256 else None
+        try:
+            self._fetch_extracting(
+                url,
+                out,
+                tee_file,
+                sha256=sha256,
+                headers=headers,
+                progress=progress,
+                media_type=media_type,
+            )
+            if tee_file:
+                cache.put(digest, tee_file, verified=True)
+        finally:
+            if tee_file:
+                tee_file.unlink(missing_ok=True)
 
         progress.flush(f"{layer_id_short}: Pull complete")
 
-
-class TarInfo(tarfile.TarInfo):
+    def _download(
+        self,
+        url: str,
+        temp_file: Path,
+        *,
+        sha256: str = None,
+        headers: dict = None,
+        progress: ProgressBar = EmptyProgressBar(),
+        size: int = 0,
+        segments: int = 1,
+    ):
+        mode = "wb"
+        done = 0
+        layer_id_short = os.path.basename(url)[7:19]
+
+        state_file = temp_file.with_name(temp_file.name + ".segments")
+        if segments > 1 and size:
+            # a .gz without the state file is left by a single stream
+            if state_file.exists() or not temp_file.exists():
+                self._download_segmented(
+                    url,
+                    temp_file,
+                    state_file,
+                    sha256=sha256,
+                    headers=headers,
+                    progress=progress,
+                    size=size,
+                    segments=segments,
+                )
+
+                return
+
+        h = Sha256()
+        if temp_file.exists():
+            done = temp_file.stat().st_size
+            h = resume_sha256(temp_file)
+            if h.hexdigest() == sha256:
+                logging.debug(f"File {temp_file} is up to date")
+                return
+
+            if size and done >= size:
+                # the whole blob is there and it is not the right one
+                logging.debug(f"{temp_file}: digest mismatch, download again")
+                discard_partial(temp_file)
+                done = 0
+                h = Sha256()
+            elif done:
+                logging.debug(f'resume download layer blob "{temp_file}"')
+                mode = "ab"
+                headers["Range"] = f"bytes={done}-"
+
+        progress.update_description(f"{layer_id_short}: Pulling fs layer")
+        progress.set_size(0)
+        progress.write(0)
+
+        try:
+            r = self.get(url, headers=headers, stream=True)
+        except requests.HTTPError as e:
+            status = e.response.status_code
+            if mode != "ab" or status != requests.codes.range_not_satisfiable:
+                raise
+
+            # the partial blob is not shorter than the blob, so it is wrong
+            logging.debug(f"{url}: nothing after {done}, download again")
+            discard_partial(temp_file)
+            del headers["Range"]
+            r = self.get(url, headers=headers, stream=True)
+            mode = "wb"
+            done = 0
+            h = Sha256()
+
+        if mode == "ab" and r.status_code == requests.codes.ok:
+            logging.debug(f"{url}: range is ignored, download from scratch")
+            mode = "wb"
+            done = 0
+            h = Sha256()
+
+        progress.update_description(f"{layer_id_short}: Downloading")
+        progress.set_size(int(r.headers.get("Content-Length", 0)))
+
+        saved = done
+        try:
+            with open(temp_file, mode) as f:
+                for chunk in self._iter_content(url, r, headers, offset=done):
+                    if chunk:
+                        f.write(chunk)
+                        h.update(chunk)
+                        done += len(chunk)
+
+                        if progress:
+                            progress.write(done)
+
+                        if done - saved >= HASH_CHECKPOINT_INTERVAL:
+                            f.flush()
+                            save_sha256_state(temp_file, h, done)
+                            saved = done
+        except BaseException:
+            save_sha256_state(temp_file, h, done)
+            raise
+
+        sha256_state_file(temp_file).unlink(missing_ok=True)
+
+        if sha256 and h.hexdigest() != sha256:
+            temp_file.unlink()
+            if mode == "ab":
+                # the part of a previous run was corrupt, not this response
+                logging.debug(f"{url}: the resumed blob is corrupt, restart")
+                del headers["Range"]
+                return self._download(
+                    url,
+                    temp_file,
+                    sha256=sha256,
+                    headers=headers,
+                    progress=progress,
+                    size=size,
+                )
+
+            raise ValueError(
+                f"{url}: digest mismatch, got sha256:{h.hexdigest()}"
+            )
+
+    def _download_segmented(
+        self,
+        url: str,
+        temp_file: Path,
+        state_file: Path,
+        *,
+        sha256: str = None,
+        headers: dict = None,
+        progress: ProgressBar = EmptyProgressBar(),
+        size: int,
+        segments: int,
+    ):
+        layer_id_short = os.path.basename(url)[7:19]
+
+        step = -(-size // segments)
+        ranges = [(i, min(i + step, size) - 1) for i in range(0, size, step)]
+
+        # finished segments of an interrupted download
+        done_ranges = set()
+        if state_file.exists() and temp_file.exists():
+            state = json.loads(state_file.read_text())
+            if state["size"] == size and state["segments"] == segments:
+                done_ranges = {tuple(r) for r in state["done"]}
+
+        lock = threading.Lock()
+        done = sum(end - start + 1 for start, end in done_ranges)
+
+        progress.update_description(f"{layer_id_short}: Downloading")
+        progress.set_size(size)
+        progress.write(done)
+
+        def range_headers(rng: tuple[int, int]) -> dict:
+            return {**headers, "Range": "bytes={}-{}".format(*rng)}
+
+        def fetch_range(rng: tuple[int, int], r: requests.Response = None):
+            nonlocal done
+
+            if r is None:
+                r = self.get(url, headers=range_headers(rng), stream=True)
+            if r.status_code != requests.codes.partial_content:
+                raise ValueError(f"{url}: range {rng} is not supported")
+
+            offset = rng[0]
+            for chunk in self._iter_content(
+                url, r, headers, offset=rng[0], end=rng[1]
+            ):
+                if chunk:
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+
+                    with lock:
+                        done += len(chunk)
+                        progress.write(done)
+
+            if offset != rng[1] + 1:
+                raise ValueError(f"{url}: short read of range {rng}")
+
+            with lock:
+                done_ranges.add(rng)
+                state = {
+                    "size": size,
+                    "segments": segments,
+                    "done": sorted(done_ranges),
+                }
+                state_file.write_text(json.dumps(state))
+
+        pending = [rng for rng in ranges if rng not in done_ranges]
+        fd = os.open(temp_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+
+            r = None
+            if pending:
+                r = self.get(
+                    url, headers=range_headers(pending[0]), stream=True
+                )
+
+            if r is not None and r.status_code == requests.codes.ok:
+                # the registry ignores ranges, take the whole blob at once
+                logging.debug(f"{url}: range requests are not supported")
+                offset = 0
+                for chunk in self._iter_content(url, r, headers):
+                    if chunk:
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                        progress.write(offset)
+
+                os.ftruncate(fd, offset)
+            elif pending:
+                with concurrent.futures.ThreadPoolExecutor(segments) as pool:
+                    futures = [pool.submit(fetch_range, pending[0], r)]
+                    for rng in pending[1:]:
+                        futures.append(pool.submit(fetch_range, rng))
+
+                    try:
+                        for fut in futures:
+                            fut.result()
+                    except BaseException:
+                        pool.shutdown(wait=True, cancel_futures=True)
+                        raise
+        finally:
+            os.close(fd)
+
+        state_file.unlink(missing_ok=True)
+
+        if sha256 and sha256sum(temp_file) != sha256:
+            temp_file.unlink()
+            raise ValueError(f"{url}: digest mismatch of the segmented blob")
+
+    def _fetch_extracting(
+        self,
+        url: str,
+        out: BinaryIO,
+        tee_file: Path = None,
+        *,
+        sha256: str = None,
+        headers: dict = None,
+        progress: ProgressBar = EmptyProgressBar(),
+        checkpoint: bool = False,
+        media_type: str = None,
+    ):
+        done = 0
+        layer_id_short = os.path.basename(url)[7:19]
+        decompressor = layer_decompressor(media_type)
+
+        progress.update_description(f"{layer_id_short}: Pulling fs layer")
+        progress.set_size(0)
+        progress.write(0)
+
+        r = self.get(url, headers=headers, stream=True)
+
+        progress.update_description(f"{layer_id_short}: Downloading")
+        progress.set_size(int(r.headers.get("Content-Length", 0)))
+
+        h = Sha256()
+        saved = 0
+        checkpoint = checkpoint and tee_file is not None
+        tee = open(tee_file, "wb") if tee_file else contextlib.nullcontext()
+        try:
+            with tee, PipelinedWriter(out) as writer:
+                for chunk in self._iter_content(url, r, headers):
+                    if chunk:
+                        h.update(chunk)
+                        if tee_file:
+                            tee.write(chunk)
+
+                        for data in decompressor.decompress(chunk):
+                            writer.write(data)
+
+                        done += len(chunk)
+                        progress.write(done)
+
+                        interval = done - saved
+                        if checkpoint and interval >= HASH_CHECKPOINT_INTERVAL:
+                            tee.flush()
+                            save_sha256_state(tee_file, h, done)
+                            saved = done
+
+                writer.write(decompressor.flush())
+        except BLOB_ERRORS:
+            # resuming would only append to the corrupt data
+            if tee_file:
+                discard_partial(tee_file)
+            raise
+        except BaseException:
+            # the next run resumes the download of the saved blob
+            if checkpoint:
+                save_sha256_state(tee_file, h, done)
+            raise
+
+        if checkpoint:
+            sha256_state_file(tee_file).unlink(missing_ok=True)
+
+        if sha256 and h.hexdigest() != sha256:
+            if tee_file:
+                discard_partial(tee_file)
+            raise ValueError(
+                f"{url}: digest mismatch, got sha256:{h.hexdigest()}"
+            )
+
     @staticmethod
-    def _create_header(info, fmt, encoding, errors):
-        parts = [
-            tarfile.stn(info.get("name", ""), 100, encoding, errors),
-            tarfile.itn(info.get("mode", 0) & 0o7777, 8, fmt),
-            tarfile.itn(info.get("uid", 0), 8, fmt),
-            tarfile.itn(info.get("gid", 0), 8, fmt),
-            tarfile.itn(info.get("size", 0), 12, fmt),
-            tarfile.itn(info.get("mtime", 0), 12, fmt),
-            b"        ",  # checksum field
-            info.get("type", tarfile.REGTYPE),
-            tarfile.stn(info.get("linkname", ""), 100, encoding, errors),
-            info.get("magic", tarfile.POSIX_MAGIC),
-            tarfile.stn(info.get("uname", ""), 32, encoding, errors),
-            tarfile.stn(info.get("gname", ""), 32, encoding, errors),
-            tarfile.itn(info.get("devmajor", 0), 8, fmt),
-            tarfile.itn(info.get("devminor", 0), 8, fmt),
-            tarfile.stn(info.get("prefix", ""), 155, encoding, errors),
-        ]
+    def _extract(
+        temp_file: Path,
+        out_file: Path,
+        layer_id_short: str,
+        progress: ProgressBar,
+        status: str = "Pull complete",
+        media_type: str = None,
+    ):
+        progress.update_description(f"{layer_id_short}: Extracting")
+
+        unzip(temp_file, out_file, progress=progress, media_type=media_type)
+
+        progress.flush(f"{layer_id_short}: {status}")
+
+
+@dataclasses.dataclass
+class MirrorEndpoint:
+    base_url: str | None
+    registry: Registry
+    # moving averages of the response time and the blob download speed
+    latency: float = 0.0
+    throughput: float = 0.0
+    in_flight: int = 0
+    failed_at: float = 0.0
+
+    def url(self, url: str) -> str:
+        if self.base_url is None:
+            return url
+
+        if "://" not in url:
+            url = f"https://{url}"
+
+        u = urlparse.urlsplit(url)
+        path = f"{u.path}?{u.query}" if u.query else u.path
+
+        return self.base_url.rstrip("/") + path
+
+    def cost(self, size: int) -> float:
+        cost = self.latency
+        if size and self.throughput:
+            cost += size / self.throughput
+
+        return cost * (1 + self.in_flight)
+
+    @property
+    def name(self) -> str:
+        return self.base_url or "upstream"
+
+
+class RegistryMirrors:
+    """One upstream registry behind a list of mirrors
+
+    Requests go to the mirror expected to be the fastest one, unmeasured
+    mirrors first, the upstream registry is the last resort. On an error
+    the next endpoint is tried, blobs and digest references are checked
+    against their digest, so a copy of any mirror is as good as another.
+    """
+
+    EWMA_ALPHA = 0.3
+    # errors of an endpoint, a next one may serve the request
+    ERRORS = (requests.RequestException, *BLOB_ERRORS)
+
+    def __init__(
+        self, mirrors: list[MirrorEndpoint], upstream: MirrorEndpoint
+    ):
+        self._mirrors = mirrors
+        self._upstream = upstream
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_urls(
+        cls, urls: list[str], upstream: Registry, **kwargs
+    ) -> "RegistryMirrors":
+        mirrors = []
+        for url in urls:
+            if "://" not in url:
+                url = f"https://{url}"
+            mirrors.append(MirrorEndpoint(url, Registry(**kwargs)))
+
+        return cls(mirrors, MirrorEndpoint(None, upstream))
+
+    def _ranked(self, size: int = 0) -> list[MirrorEndpoint]:
+        now = time.monotonic()
+        with self._lock:
+            mirrors = sorted(
+                self._mirrors,
+                key=lambda ep: (
+                    now - ep.failed_at < MIRROR_RETRY_AFTER,
+                    ep.cost(size),
+                ),
+            )
+
+        return mirrors + [self._upstream]
+
+    def _average(self, old: float, new: float) -> float:
+        if not old:
+            return new
+
+        return old + self.EWMA_ALPHA * (new - old)
+
+    def _attempt(self, ep: MirrorEndpoint, size: int, fn):
+        with self._lock:
+            ep.in_flight += 1
+
+        started = time.monotonic()
+        try:
+            result = fn()
+        except self.ERRORS as e:
+            logging.warning(f"{ep.name}: {e}")
+            with self._lock:
+                ep.failed_at = time.monotonic()
+            raise
+        finally:
+            with self._lock:
+                ep.in_flight -= 1
+
+        elapsed = time.monotonic() - started
+        with self._lock:
+            if size:
+                # a short transfer shows latency rather than bandwidth
+                if elapsed > 0.1:
+                    speed = size / elapsed
+                    ep.throughput = self._average(ep.throughput, speed)
+            else:
+                ep.latency = self._average(ep.latency, elapsed)
+
+        return result
+
+    def _failover(self, size: int, fn, resumable=lambda: True):
+        error = None
+        for ep in self._ranked(size):
+            if error is not None:
+                if not resumable():
+                    raise error
+                logging.debug(f"retry with {ep.name}")
+
+            try:
+                return self._attempt(ep, size, lambda: fn(ep))
+            except self.ERRORS as e:
+                error = e
+
+        raise error
+
+    def get(
+        self, url: str, *, headers: dict = None, stream: bool = None
+    ) -> requests.Response:
+        digest = os.path.basename(url)
+        if not digest.startswith("sha256:") or stream:
+            digest = None
+
+        def get(ep: MirrorEndpoint) -> requests.Response:
+            r = ep.registry.get(
+                ep.url(url), headers=dict(headers or {}), stream=stream
+            )
+            got = hashlib.sha256(r.content).hexdigest() if digest else None
+            if digest and f"sha256:{got}" != digest:
+                raise ValueError(f"{ep.name}: digest mismatch of {digest}")
+
+            return r
+
+        return self._failover(0, get)
+
+    def head(self, url: str, *, headers: dict = None) -> requests.Response:
+        def head(ep: MirrorEndpoint) -> requests.Response:
+            return ep.registry.head(ep.url(url), headers=dict(headers or {}))
+
+        return self._failover(0, head)
+
+    def fetch_blob(self, url: str, out_file: Path, **kwargs):
+        temp_file = out_file.with_suffix(".gz")
+        tried = False
+
+        def fetch(ep: MirrorEndpoint):
+            nonlocal tried
+
+            if tried:
+                # the next endpoint starts over, what the failed one left
+                # may be corrupt
+                discard_partial(temp_file)
+                segments_file = temp_file.with_name(
+                    temp_file.name + ".segments"
+                )
+                segments_file.unlink(missing_ok=True)
+
+            tried = True
+            kwargs["headers"] = dict(kwargs.get("headers") or {})
+            ep.registry.fetch_blob(ep.url(url), out_file, **kwargs)
+
+        self._failover(kwargs.get("size", 0), fetch)
+
+    def fetch_blob_into(self, url: str, out: BinaryIO, **kwargs):
+        out = CountingWriter(out)
+
+        def fetch(ep: MirrorEndpoint):
+            ep.registry.fetch_blob_into(ep.url(url), out, **kwargs)
+
+        # the output can not be rolled back once something is written
+        self._failover(0, fetch, lambda: not out.written)
+
+
+class AsyncResponse:
+    """Response of AsyncConnectionPool, the body is read on demand"""
+
+    def __init__(
+        self,
+        url: str,
+        status_code: int,
+        headers: requests.structures.CaseInsensitiveDict,
+        reader: asyncio.StreamReader,
+        release,
+        *,
+        has_body: bool = True,
+    ):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = None
+        self._reader = reader
+        self._release = release
+
+        self._chunked = "chunked" in headers.get("Transfer-Encoding", "")
+        self._length = None
+        if not has_body:
+            self._length = 0
+        elif not self._chunked and "Content-Length" in headers:
+            self._length = int(headers["Content-Length"])
+
+        # the connection can be reused only after the whole body is read
+        self._keep_alive = headers.get("Connection", "").lower() != "close"
+        if not self._chunked and self._length is None:
+            self._keep_alive = False
+
+    @staticmethod
+    def _chunk_size(line: bytes) -> int:
+        return int(line.split(b";")[0], 16)
+
+    async def iter_content(self, chunk_size: int = 131072):
+        reader = self._reader
+        try:
+            if self._chunked:
+                while size := self._chunk_size(await reader.readline()):
+                    while size:
+                        data = await reader.read(min(chunk_size, size))
+                        if not data:
+                            raise asyncio.IncompleteReadError(b"", size)
+                        size -= len(data)
+                        yield data
+
+                    await reader.readexactly(2)
+
+                # trailers
+                while (await reader.readline()).strip():
+                    pass
+            elif self._length is not None:
+                size = self._length
+                while size:
+                    data = await reader.read(min(chunk_size, size))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b"", size)
+                    size -= len(data)
+                    yield data
+            else:
+                while data := await reader.read(chunk_size):
+                    yield data
+        except BaseException:
+            self.close()
+            raise
+
+        self._release(self._keep_alive)
+
+    async def read(self) -> bytes:
+        if self.content is None:
+            self.content = b"".join([c async for c in self.iter_content()])
+
+        return self.content
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+
+    def close(self):
+        self._release(False)
+
+
+class AsyncConnectionPool:
+    """Keep-alive HTTP/1.1 connections, max_connections per host at most
+
+    Transfers over the limit wait for a free connection, so any number of
+    them can be driven by a few sockets.
+    """
+
+    def __init__(self, max_connections: int = 8):
+        self._max_connections = max_connections
+        self._idle: dict[tuple, list] = {}
+        self._limits: dict[tuple, asyncio.Semaphore] = {}
+        self._ssl_context = None
+        self._loop = None
+
+    def _context(self) -> ssl_lib.SSLContext:
+        if self._ssl_context is None:
+            # the same CA bundle as requests
+            self._ssl_context = ssl_lib.create_default_context(
+                cafile=requests.certs.where()
+            )
+
+        return self._ssl_context
+
+    async def _connect(self, key: tuple):
+        scheme, host, port = key
+        ctx = self._context() if scheme == "https" else None
+
+        return await asyncio.open_connection(host, port, ssl=ctx)
+
+    async def request(
+        self, method: str, url: str, headers: dict = None
+    ) -> AsyncResponse:
+        u = urlparse.urlsplit(url)
+        port = u.port or (443 if u.scheme == "https" else 80)
+        key = (u.scheme, u.hostname, port)
+
+        # connections and limits of a previous event loop are useless
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._idle.clear()
+            self._limits.clear()
+
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = asyncio.Semaphore(self._max_connections)
+            self._limits[key] = limit
+
+        target = urlparse.urlunsplit(("", "", u.path or "/", u.query, ""))
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {u.netloc}"]
+        hdrs = {"Accept-Encoding": "identity", **(headers or {})}
+        lines.extend(f"{k}: {v}" for k, v in hdrs.items())
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        await limit.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            while True:
+                reused = bool(idle)
+                conn = idle.pop() if reused else await self._connect(key)
+                reader, writer = conn
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    status, resp_headers = await self._read_head(reader)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    # the server has closed an idle connection, try a next
+                    if not reused:
+                        raise
+        except BaseException:
+            limit.release()
+            raise
+
+        def release(keep_alive: bool):
+            nonlocal conn
+            if conn is None:
+                return
+
+            if keep_alive:
+                idle.append(conn)
+            else:
+                conn[1].close()
+
+            conn = None
+            limit.release()
+
+        return AsyncResponse(
+            url,
+            status,
+            resp_headers,
+            reader,
+            release,
+            has_body=method != "HEAD" and status not in [204, 304],
+        )
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("connection closed by the server")
+
+        status = int(line.split(b" ", 2)[1])
+
+        headers = requests.structures.CaseInsensitiveDict()
+        while (line := await reader.readline()).strip():
+            k, v = line.decode("latin-1").split(":", 1)
+            k, v = k.strip(), v.strip()
+            headers[k] = f"{headers[k]}, {v}" if k in headers else v
+
+        return status, headers
+
+    async def close(self):
+        for conns in self._idle.values():
+            for _, writer in conns:
+                writer.close()
+
+        self._idle.clear()
+
+
+class AsyncRegistry(RegistryAuth):
+    """asyncio counterpart of Registry, all of them share one pool"""
+
+    REDIRECT_CODES = [301, 302, 303, 307, 308]
+
+    def __init__(
+        self,
+        pool: AsyncConnectionPool,
+        credentials: requests.auth.HTTPBasicAuth = None,
+        ssl: bool = True,
+        token_cache: TokenCache = None,
+        retry: RetryPolicy = None,
+        throttle: Throttle = None,
+    ):
+        super().__init__(credentials, token_cache)
+        self._ssl = ssl
+        self._pool = pool
+        self._retry = retry or RetryPolicy()
+        self._throttle = throttle or Throttle()
+
+    async def _auth(self, url: str, resp: AsyncResponse, rejected: dict):
+        req = self._token_request(
+            url, resp.headers.get("www-authenticate"), rejected
+        )
+        if req is None:
+            return
+
+        key, token_url = req
+        r = await self._request(token_url, self._basic_header())
+        await r.read()
+        if r.status_code != requests.codes.ok:
+            raise requests.HTTPError(
+                f"{r.status_code} Error for url: {r.url}", response=None
+            )
+
+        self._save_token(key, r.json())
+
+    async def _request(self, url: str, hdrs: dict = None) -> AsyncResponse:
+        for _ in range(10):
+            host = urlparse.urlsplit(url).netloc
+            await asyncio.sleep(self._throttle.request_delay(host))
+
+            r = await self._pool.request("GET", url, hdrs)
+            self._throttle.observe(host, r.status_code, r.headers)
+            location = r.headers.get("Location")
+            if r.status_code not in self.REDIRECT_CODES or not location:
+                return r
+
+            await r.read()
+            next_url = urlparse.urljoin(url, location)
+            # like requests, credentials are not sent to another host
+            netloc = urlparse.urlsplit(url).netloc
+            if urlparse.urlsplit(next_url).netloc != netloc:
+                hdrs = {
+                    k: v
+                    for k, v in (hdrs or {}).items()
+                    if k.lower() != "authorization"
+                }
+            url = next_url
+
+        raise requests.TooManyRedirects(f"{url}: too many redirects")
+
+    async def _send(
+        self, url: str, headers: dict, stream: bool
+    ) -> AsyncResponse:
+        min_ttl = TOKEN_BLOB_MIN_TTL if stream else TOKEN_MIN_TTL
+
+        auth = self._auth_header(url, min_ttl)
+        r = await self._request(url, {**(headers or {}), **auth})
+        if r.status_code == requests.codes.unauthorized:
+            await r.read()
+            await self._auth(url, r, auth)
+            auth = self._auth_header(url)
+            r = await self._request(url, {**(headers or {}), **auth})
+
+        return r
+
+    async def get(
+        self, url: str, *, headers: dict = None, stream: bool = None
+    ) -> AsyncResponse:
+        if not url.startswith("http"):
+            url = f"http{'s' if self._ssl else ''}://{url}"
+
+        logging.debug("Request headers: %s", json.dumps(headers))
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                r = await self._send(url, headers, stream)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                delay = self._retry.delay(attempt, f"{url}: {e!r}")
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            if r.status_code not in self._retry.statuses:
+                break
+
+            delay = self._retry.delay(
+                attempt,
+                f"{url}: status code {r.status_code}",
+                r.headers.get("Retry-After"),
+            )
+            if delay is None:
+                break
+            await r.read()
+            await asyncio.sleep(delay)
+
+        if r.status_code not in [
+            requests.codes.ok,
+            requests.codes.partial_content,
+        ]:
+            body = await r.read()
+            logging.error(
+                f"Status code: {r.status_code}, Response: {log_body(body)}"
+            )
+            raise requests.HTTPError(
+                f"{r.status_code} Error for url: {url}", response=None
+            )
+
+        logging.debug("Response headers: %s", json.dumps(dict(r.headers)))
+        if not stream:
+            logging.debug("Response body: %s", log_body(await r.read()))
+
+        return r
+
+    async def fetch_blob(
+        self,
+        url: str,
+        out_file: Path,
+        *,
+        sha256: str = None,
+        headers: dict = None,
+        progress: ProgressBar = EmptyProgressBar(),
+        cache: BlobCache = None,
+        media_type: str = None,
+    ):
+        """Download a layer blob and extract it to out_file"""
+
+        layer_id_short = os.path.basename(url)[7:19]
+        temp_file = out_file.with_suffix(".gz")
+        digest = f"sha256:{sha256}"
+
+        if cache and sha256 and cache.link(digest, temp_file):
+            progress.update_description(f"{layer_id_short}: Extracting")
+            await asyncio.to_thread(
+                unzip,
+                temp_file,
+                out_file,
+                progress=progress,
+                media_type=media_type,
+            )
+            progress.flush(f"{layer_id_short}: Already exists")
+
+            return
+
+        progress.update_description(f"{layer_id_short}: Pulling fs layer")
+        progress.set_size(0)
+        progress.write(0)
+
+        r = await self.get(url, headers=headers, stream=True)
+
+        progress.update_description(f"{layer_id_short}: Downloading")
+        progress.set_size(int(r.headers.get("Content-Length", 0)))
+
+        done = 0
+        h = Sha256()
+        decompressor = layer_decompressor(media_type)
+        tee_file = temp_file if cache and sha256 else None
+        tee = open(tee_file, "wb") if tee_file else contextlib.nullcontext()
+
+        def consume(chunk: bytes):
+            h.update(chunk)
+            if tee_file:
+                tee.write(chunk)
+
+            for data in decompressor.decompress(chunk):
+                f.write(data)
+
+        # a chunk is inflated and written in a thread while the next one is
+        # received, so a large layer does not hold up the other transfers
+        pending = None
+        try:
+            with open(out_file, "wb") as f, tee:
+                try:
+                    async for chunk in r.iter_content(chunk_size=131072):
+                        delay = self._throttle.transfer_delay(len(chunk))
+                        await asyncio.sleep(delay)
+                        if pending:
+                            await pending
+
+                        pending = asyncio.ensure_future(
+                            asyncio.to_thread(consume, chunk)
+                        )
+                        done += len(chunk)
+                        progress.write(done)
+
+                    if pending:
+                        await pending
+
+                    await asyncio.to_thread(
+                        lambda: f.write(decompressor.flush())
+                    )
+                finally:
+                    # the files are closed only after the thread is done
+                    if pending and not pending.done():
+                        await asyncio.wait([pending])
+
+            if sha256 and h.hexdigest() != sha256:
+                raise ValueError(
+                    f"{url}: digest mismatch, got sha256:{h.hexdigest()}"
+                )
+        except BaseException:
+            # nothing is resumed here, and the .gz would be taken for a
+            # partial download by a next pull of ImageFetcher
+            if tee_file:
+                tee_file.unlink(missing_ok=True)
+            raise
+
+        if tee_file:
+            cache.put(digest, tee_file, verified=True)
+            os.remove(tee_file)
+
+        progress.flush(f"{layer_id_short}: Pull complete")
+
+
+class TarInfo(tarfile.TarInfo):
+    @staticmethod
+    def _create_header(info, fmt, encoding, errors):
+        parts = [
+            tarfile.stn(info.get("name", ""), 100, encoding, errors),
+            tarfile.itn(info.get("mode", 0) & 0o7777, 8, fmt),
+            tarfile.itn(info.get("uid", 0), 8, fmt),
+            tarfile.itn(info.get("gid", 0), 8, fmt),
+            tarfile.itn(info.get("size", 0), 12, fmt),
+            tarfile.itn(info.get("mtime", 0), 12, fmt),
+            b"        ",  # checksum field
+            info.get("type", tarfile.REGTYPE),
+            tarfile.stn(info.get("linkname", ""), 100, encoding, errors),
+            info.get("magic", tarfile.POSIX_MAGIC),
+            tarfile.stn(info.get("uname", ""), 32, encoding, errors),
+            tarfile.stn(info.get("gname", ""), 32, encoding, errors),
+            tarfile.itn(info.get("devmajor", 0), 8, fmt),
+            tarfile.itn(info.get("devminor", 0), 8, fmt),
+            tarfile.stn(info.get("prefix", ""), 155, encoding, errors),
+        ]
+
+        buf = struct.pack("%ds" % tarfile.BLOCKSIZE, b"".join(parts))
+        chksum = tarfile.calc_chksums(buf[-tarfile.BLOCKSIZE :])[0]
+
+        return buf[:-364] + bytes("%06o\0" % chksum, "ascii") + buf[-357:]
+
+
+def chain_ids(ids_list: list) -> list[str]:
+    if len(ids_list) < 2:
+        return ids_list
+
+    chain = [ids_list[0]]
+    for diff_id in ids_list[1:]:
+        chain_b = f"{chain[-1]} {diff_id}".encode()
+        chain.append("sha256:" + hashlib.sha256(chain_b).hexdigest())
+
+    return chain
+
+
+def layer_ids_list(chain_ids_list: list, config_image: dict) -> list[str]:
+    config_image.pop("id", "")
+
+    # the layers below the top one differ only in their ids, so the JSON of
+    # their LayerConfig is made once with markers to put the ids in place
+    def quote(s: str) -> str:
+        return json.dumps(s).replace(r"\\u", r"\u")
+
+    base = LayerConfig(
+        layer_id="<layer_id>", container_config=ContainerConfig()
+    ).json
+    child = LayerConfig(
+        layer_id="<layer_id>",
+        parent="<parent>",
+        container_config=ContainerConfig(),
+    ).json
+
+    chan_ids = []
+    parent = None
+    for chain_id in chain_ids_list[:-1]:
+        config_json = base if parent is None else child
+        config_json = config_json.replace('"<layer_id>"', quote(chain_id))
+        if parent is not None:
+            config_json = config_json.replace('"<parent>"', quote(parent))
+
+        parent = "sha256:" + hashlib.sha256(config_json.encode()).hexdigest()
+        chan_ids.append(parent)
+
+    if chain_ids_list:
+        config = LayerConfig(layer_id=chain_ids_list[-1], parent=parent)
+        config.container_config = ContainerConfig()
+        config.config = ContainerConfig()
+        config.deepcopy(config_image)
+
+        parent = "sha256:" + hashlib.sha256(config.json.encode()).hexdigest()
+        chan_ids.append(parent)
+
+    return chan_ids
+
+
+class LayerIdsCache:
+    """v1 layer ids of images by their diff ids and config digest
+
+    The tags of an image pulled in a run share the config, so its layer
+    ids are worked out once.
+    """
+
+    def __init__(self, size: int = LAYER_IDS_CACHE_SIZE):
+        self._size = size
+        self._ids: dict[tuple, list[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self, diff_ids: list[str], config_digest: str, config_image: dict
+    ) -> list[str]:
+        """layer_ids_list of the chain ids of diff_ids"""
+
+        key = (tuple(diff_ids), config_digest)
+        with self._lock:
+            # the dict keeps the order of use, the first key is evicted
+            ids = self._ids.pop(key, None)
+            if ids is not None:
+                self._ids[key] = ids
+
+        if ids is None:
+            ids = layer_ids_list(chain_ids(diff_ids), config_image)
+            with self._lock:
+                self._ids[key] = ids
+                while len(self._ids) > self._size:
+                    del self._ids[next(iter(self._ids))]
+        else:
+            logging.debug(f"Layer ids of {config_digest} are cached")
+            config_image.pop("id", "")
+
+        return list(ids)
+
+
+def date_parse(s: str) -> datetime.datetime:
+    layout = "%Y-%m-%dT%H:%M:%S.%f%z"
+
+    # remove Z at the end of the line
+    if s.endswith("Z"):
+        s = s[:-1]
+
+    nano_s = 0
+    datetime_parts = s.split(".")
+    if len(datetime_parts) == 2:
+        nano_s = datetime_parts[-1]
+        # cut nanoseconds to microseconds
+        if len(nano_s) > 6:
+            nano_s = nano_s[:6]
+
+    dt = "{}.{}+00:00".format(datetime_parts[0], nano_s)
+
+    return datetime.datetime.strptime(dt, layout)
+
+
+def www_auth(hdr: str) -> tuple[str, dict]:
+    auth_scheme, info = hdr.split(" ", 1)
+
+    out = {}
+    for part in info.split(","):
+        k, v = part.split("=", 1)
+        out[k] = v.replace('"', "").strip()
+
+    return auth_scheme, out
+
+
+def registry_host(registry: str) -> str:
+    return registry.removeprefix("https://").removeprefix("http://")
+
+
+def parse_mirror(s: str) -> tuple[str, list[str]]:
+    upstream, sep, urls = s.partition("=")
+    if not sep or not urls:
+        raise argparse.ArgumentTypeError(f"{s}: expected REGISTRY=URL[,URL]")
+
+    upstream = registry_host(upstream)
+    if upstream in ["docker.io", "index.docker.io"]:
+        upstream = ImageParser.REGISTRY_HOST
+
+    return upstream, [url for url in urls.split(",") if url]
+
+
+def _load_libcrypto():
+    # on macOS loading the system libcrypto aborts the process
+    if sys.platform != "linux":
+        return None
+
+    name = ctypes.util.find_library("crypto")
+    if not name:
+        return None
+
+    try:
+        lib = ctypes.CDLL(name)
+        lib.SHA256_Init.argtypes = [ctypes.c_void_p]
+        lib.SHA256_Update.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_size_t,
+        ]
+        lib.SHA256_Final.argtypes = [ctypes.c_char_p, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+
+    return lib
+
+
+LIBCRYPTO = _load_libcrypto()
+
+
+class Sha256:
+    """sha256 which state can be saved to resume hashing in a next run
+
+    hashlib can't export its state, so SHA256_CTX of libcrypto is used
+    when it is available.
+    """
+
+    # sizeof(SHA256_CTX)
+    CTX_SIZE = 112
+
+    def __init__(self, state: bytes = None):
+        self._hash = None
+        self._ctx = None
+
+        if LIBCRYPTO is None:
+            if state:
+                raise ValueError("libcrypto is required to restore a state")
+            self._hash = hashlib.sha256()
+        elif state:
+            self._ctx = ctypes.create_string_buffer(state, self.CTX_SIZE)
+        else:
+            self._ctx = ctypes.create_string_buffer(self.CTX_SIZE)
+            LIBCRYPTO.SHA256_Init(self._ctx)
+
+    def update(self, data: bytes):
+        if self._hash is not None:
+            self._hash.update(data)
+        else:
+            LIBCRYPTO.SHA256_Update(self._ctx, data, len(data))
+
+    def hexdigest(self) -> str:
+        if self._hash is not None:
+            return self._hash.hexdigest()
+
+        ctx = ctypes.create_string_buffer(self._ctx.raw, self.CTX_SIZE)
+        md = ctypes.create_string_buffer(32)
+        LIBCRYPTO.SHA256_Final(md, ctx)
+
+        return md.raw.hex()
+
+    def state(self) -> bytes | None:
+        if self._ctx is None:
+            return None
+
+        return self._ctx.raw
+
+
+def sha256_state_file(path: Path) -> Path:
+    return path.with_name(path.name + ".sha256")
+
+
+def discard_partial(path: Path):
+    """Remove a partial blob and its checkpoint"""
+
+    path.unlink(missing_ok=True)
+    sha256_state_file(path).unlink(missing_ok=True)
+
+
+def save_sha256_state(path: Path, h: Sha256, offset: int):
+    state = h.state()
+    if state is None:
+        return
+
+    checkpoint = {"offset": offset, "state": state.hex()}
+    sha256_state_file(path).write_text(json.dumps(checkpoint))
+
+
+def resume_sha256(path: Path) -> Sha256:
+    """Hash of a partial blob, only the bytes after the saved state are read"""
+
+    h = None
+    offset = 0
+    try:
+        checkpoint = json.loads(sha256_state_file(path).read_text())
+        if checkpoint["offset"] <= path.stat().st_size:
+            h = Sha256(bytes.fromhex(checkpoint["state"]))
+            offset = checkpoint["offset"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if h is None:
+        h = Sha256()
+
+    with open(path, "rb", buffering=0) as f:
+        f.seek(offset)
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+
+    return h
+
+
+def sha256sum(name: str | Path, chunk_num_blocks: int = 128) -> str:
+    h = hashlib.sha256()
+
+    with open(name, "rb", buffering=0) as f:
+        while chunk := f.read(chunk_num_blocks * h.block_size):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def link_file(src: str | Path, dst: str | Path):
+    """Hardlink src to dst, falling back to a reflink and then a copy"""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return
+    except OSError:
+        pass
+
+    shutil.copyfile(src, dst)
+
+
+def log_body(body: bytes) -> bytes:
+    """Head of a response body for the log"""
+
+    if len(body) <= LOG_BODY_LIMIT:
+        return body
+
+    return body[:LOG_BODY_LIMIT] + b"... %d bytes" % len(body)
+
+
+def sizeof_fmt(num: int) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(num) < 1024.0:
+            return f"{num:3.1f}{unit}"
+        num /= 1024.0
+
+    return f"{num:3.2f}TiB"
+
+
+def parse_size(s: str) -> int:
+    units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+    num = s.strip().upper().removesuffix("B").removesuffix("I")
+    unit = num[-1:] if num[-1:] in units else ""
+    num = num.removesuffix(unit)
+
+    return int(float(num) * units[unit])
+
+
+def single_platform(platform: str) -> str:
+    """The first platform of a list, "all" stands for the host one"""
+
+    platform = platform.split(",")[0].strip()
+
+    return "" if platform == "all" else platform
+
+
+def image_platform(s: str) -> tuple[str, str]:
+    _os, arch = "linux", os_platform.machine()
+    if s:
+        _os, arch = s.split("/")
+
+    return _os, arch
+
+
+def platform_dir_name(prefix: str, plf: dict) -> str:
+    """Name of the image tar of a platform of a manifest list, the variant
+    tells apart linux/arm/v6 and linux/arm/v7
+    """
+
+    dir_name = f"{prefix}_{plf['os']}_{plf['architecture']}"
+    if plf.get("variant"):
+        dir_name += f"_{plf['variant']}"
+
+    return dir_name
+
+
+class GzipDecompressor:
+    """Incremental gzip decompressor, accepts multi-member streams"""
+
+    def __init__(self):
+        self._d = self._new()
+
+    @staticmethod
+    def _new():
+        lib = isal_zlib or zlib
+        return lib.decompressobj(16 + lib.MAX_WBITS)
+
+    def decompress(self, data: bytes, chunk_size: int = 131072):
+        # the output of every step is limited by chunk_size, so a highly
+        # compressed chunk can't blow up the memory
+        while True:
+            if self._d.eof:
+                # members can be padded with zeroes like in gzip.open
+                data = data.lstrip(b"\0")
+                if not data:
+                    return
+
+                self._d = self._new()
+
+            out = self._d.decompress(data, chunk_size)
+            if self._d.eof:
+                data = self._d.unused_data
+            else:
+                data = self._d.unconsumed_tail
+            if out:
+                yield out
+
+            if not data and len(out) < chunk_size:
+                return
+
+    def flush(self) -> bytes:
+        out = self._d.flush()
+        if not self._d.eof:
+            raise EOFError(
+                "Compressed file ended before the "
+                "end-of-stream marker was reached"
+            )
+
+        return out
+
+
+class ZstdDecompressor:
+    """Incremental zstd decompressor, accepts multi-frame streams
+
+    Uses compression.zstd of Python 3.14+ or the zstandard package.
+    """
+
+    def __init__(self):
+        self._d = self._new()
+        # input of a step of the zstandard package
+        self._step = ZSTD_MIN_INPUT
+
+    @staticmethod
+    def _new():
+        with contextlib.suppress(ImportError):
+            from compression import zstd
+
+            return zstd.ZstdDecompressor()
+
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(
+                "zstd layers need Python 3.14+ or the zstandard package"
+            ) from None
+
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes, chunk_size: int = 131072):
+        # the output of every step is limited by chunk_size, as in
+        # GzipDecompressor
+        if hasattr(self._d, "needs_input"):
+            yield from self._decompress(data, chunk_size)
+        else:
+            yield from self._decompress_sliced(data, chunk_size)
+
+    def _decompress(self, data: bytes, chunk_size: int):
+        # zstd:chunked layers are a sequence of frames
+        while True:
+            if self._d.eof:
+                if not data:
+                    return
+
+                self._d = self._new()
+
+            out = self._d.decompress(data, chunk_size)
+            data = self._d.unused_data if self._d.eof else b""
+            if out:
+                yield out
+
+            if not self._d.eof and self._d.needs_input:
+                return
+
+    def _decompress_sliced(self, data: bytes, chunk_size: int):
+        data = memoryview(data)
+        while data:
+            if self._d.eof:
+                self._d = self._new()
+
+            out = self._d.decompress(data[: self._step])
+            data = data[self._step :]
+            if self._d.eof:
+                data = memoryview(self._d.unused_data + data)
+
+            if out:
+                step = self._step * chunk_size // len(out)
+            else:
+                step = self._step * 2
+            self._step = min(max(step, ZSTD_MIN_INPUT), chunk_size)
+
+            for i in range(0, len(out), chunk_size):
+                yield out[i : i + chunk_size]
+
+    def flush(self) -> bytes:
+        if not self._d.eof:
+            raise EOFError(
+                "Compressed file ended before the "
+                "end-of-stream marker was reached"
+            )
+
+        return b""
+
+
+class NullDecompressor:
+    """Passes uncompressed layers through"""
+
+    def decompress(self, data: bytes, chunk_size: int = 131072):
+        if data:
+            yield data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def layer_decompressor(
+    media_type: str = None,
+) -> GzipDecompressor | ZstdDecompressor | NullDecompressor:
+    """Decompressor of a layer blob by its media type, gzip by default"""
+
+    if media_type:
+        if media_type.endswith("+zstd"):
+            return ZstdDecompressor()
+
+        # application/vnd.oci.image.layer.v1.tar and the like
+        if media_type.endswith("tar"):
+            return NullDecompressor()
+
+    return GzipDecompressor()
+
+
+def unzip(
+    zip_file_path: str | Path,
+    out_file_path: str | Path,
+    remove_zip_file: bool = True,
+    progress: ProgressBar = EmptyProgressBar(),
+    media_type: str = None,
+):
+    with open(out_file_path, "wb") as unzip_data:
+        unzip_to(
+            zip_file_path, unzip_data, progress=progress, media_type=media_type
+        )
+
+    if remove_zip_file:
+        os.remove(zip_file_path)
+
+
+def gzip_tool() -> str | None:
+    for name in GZIP_TOOLS:
+        if path := shutil.which(name):
+            return path
+
+    return None
+
+
+def iter_unzip(zip_file_path: str | Path, media_type: str = None):
+    """Decompressed chunks of a layer blob with the compressed bytes read"""
+
+    decompressor = layer_decompressor(media_type)
+    if isinstance(decompressor, GzipDecompressor) and not isal_zlib:
+        if tool := gzip_tool():
+            yield from iter_unzip_process(zip_file_path, tool)
+            return
+
+    done = 0
+    with open(zip_file_path, "rb") as zip_data:
+        while chunk := zip_data.read(131072):
+            done += len(chunk)
+            for data in decompressor.decompress(chunk):
+                yield data, done
+
+    yield decompressor.flush(), done
+
+
+def iter_unzip_process(zip_file_path: str | Path, tool: str):
+    """iter_unzip by a gzip tool, which inflates, checks and reads the blob
+    on other cores than the one of the interpreter
+    """
+
+    done = 0
+
+    def feed(stdin: BinaryIO):
+        nonlocal done
+        try:
+            with open(zip_file_path, "rb") as zip_data:
+                while chunk := zip_data.read(131072):
+                    stdin.write(chunk)
+                    done += len(chunk)
+        except BrokenPipeError:
+            # the tool failed, its exit code tells why
+            pass
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                stdin.close()
+
+    proc = subprocess.Popen(
+        [tool, "-d", "-c"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    feeder = threading.Thread(target=feed, args=(proc.stdin,), daemon=True)
+    feeder.start()
+    try:
+        while data := proc.stdout.read(131072):
+            yield data, done
+
+        proc.wait()
+    finally:
+        # the consumer stopped early
+        if proc.returncode is None:
+            proc.kill()
+            proc.wait()
+
+        feeder.join()
+        stderr = proc.stderr.read().decode(errors="replace").strip()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if proc.returncode != 0:
+        raise ValueError(f"{zip_file_path}: {tool} failed, {stderr}")
+
+
+class PipelinedWriter:
+    """Writes to a file object in a thread of its own, so the disk writes
+    of a layer overlap with its decompression
+    """
+
+    def __init__(self, fileobj: BinaryIO, depth: int = WRITE_QUEUE_DEPTH):
+        self._f = fileobj
+        self._queue = queue.Queue(depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stop()
+
+    def _run(self):
+        while (data := self._queue.get()) is not None:
+            # the queue is drained after an error, so write() never blocks
+            if self._error is None:
+                try:
+                    self._f.write(data)
+                except BaseException as e:
+                    self._error = e
+
+    def write(self, data: bytes) -> int:
+        if self._error is not None:
+            raise self._error
+
+        if data:
+            self._queue.put(data)
+
+        return len(data)
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def close(self):
+        self._stop()
+        if self._error is not None:
+            raise self._error
+
+
+def unzip_to(
+    zip_file_path: str | Path,
+    unzip_data: BinaryIO,
+    progress: ProgressBar = EmptyProgressBar(),
+    media_type: str = None,
+):
+    # gzip ISIZE is the size of the last member modulo 4GiB, and zstd has
+    # none, so the progress follows the compressed bytes
+    progress.set_size(os.path.getsize(zip_file_path))
+
+    with PipelinedWriter(unzip_data) as out:
+        for data, done in iter_unzip(zip_file_path, media_type):
+            out.write(data)
+            progress.write(done)
+
+
+def tar_layer_ranges(path: Path) -> dict[str, tuple[int, int]]:
+    """Data offset and size of the layers of an image tar by diff id"""
+
+    ranges = {}
+    try:
+        with tarfile.open(path, "r:") as tar:
+            members = {m.name: m for m in tar.getmembers()}
+            manifest = json.load(tar.extractfile("manifest.json"))
+            for image in manifest:
+                config = json.load(tar.extractfile(image["Config"]))
+                diff_ids = config["rootfs"]["diff_ids"]
+                for name, diff_id in zip(image["Layers"], diff_ids):
+                    m = members.get(name)
+                    if m is not None and m.isfile():
+                        ranges[diff_id] = (m.offset_data, m.size)
+    except (OSError, tarfile.TarError, KeyError, TypeError, ValueError) as e:
+        logging.warning(f"{path}: layers can not be reused, {e}")
+        return {}
+
+    return ranges
+
+
+def copy_range(src: BinaryIO, offset: int, size: int, out: BinaryIO):
+    src.seek(offset)
+    while size:
+        data = src.read(min(size, 1 << 20))
+        if not data:
+            raise EOFError(f"{src.name}: unexpected end of file")
+
+        out.write(data)
+        size -= len(data)
+
+
+def oci_blob_path(digest: str) -> str:
+    return "blobs/" + digest.replace(":", "/", 1)
+
+
+def oci_image_name(img: "ImageParser") -> str:
+    """Full image name, as docker and containerd spell it"""
+
+    registry, image = img.registry, img.image
+    if registry == ImageParser.REGISTRY_HOST:
+        registry = "docker.io"
+        if "/" not in image:
+            image = path_join(ImageParser.REGISTRY_IMAGE_PREFIX, image)
+
+    return f"{registry}/{image}:{img.tag}"
+
+
+def make_tar(out_path: Path, path: Path, created: float):
+    tar = tarfile.open(out_path, "w")
+    tar.tarinfo = TarInfo
+    tar.format = tarfile.USTAR_FORMAT
+    tarfile.RECORDSIZE = 512
+
+    def mod(t: tarfile.TarInfo):
+        t.uid = 0
+        t.gid = 0
+        t.uname = ""
+        t.gname = ""
+        # the modes of TarWriter, whatever the umask of the work dir
+        if t.isdir():
+            t.mode = 0o755
+        elif t.isfile():
+            t.mode = 0o644
+
+        if t.name in ["manifest.json", "repositories"]:
+            t.mtime = 0
+        else:
+            t.mtime = created
+
+        return t
+
+    walk = []
+    for d in path.iterdir():
+        walk.append(d)
+
+    for d in sorted(walk):
+        tar.add(str(d.resolve()), str(d.relative_to(path)), filter=mod)
+
+    tar.close()
+
+
+class CountingWriter:
+    def __init__(self, fileobj: BinaryIO):
+        self._f = fileobj
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self.written += len(data)
+
+        return self._f.write(data)
+
+
+class TarWriter:
+    """Writes entries of an image tar one by one, byte-identical to make_tar
+
+    Entries must be added in the order make_tar walks the image dir.
+    """
+
+    def __init__(self, fileobj: BinaryIO, created: float):
+        self._f = fileobj
+        self._created = created
+        tarfile.RECORDSIZE = 512
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def _tarinfo(self, name: str, typ: bytes, mode: int, size: int = 0):
+        t = TarInfo(name)
+        t.type = typ
+        t.mode = mode
+        t.size = size
+        if name in ["manifest.json", "repositories"]:
+            t.mtime = 0
+        else:
+            t.mtime = self._created
+
+        return t
+
+    def _header(self, t: tarfile.TarInfo) -> bytes:
+        return t.tobuf(
+            tarfile.USTAR_FORMAT, tarfile.ENCODING, "surrogateescape"
+        )
+
+    def _pad(self, size: int):
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self._f.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def add_dir(self, name: str):
+        t = self._tarinfo(name, tarfile.DIRTYPE, 0o755)
+        self._f.write(self._header(t))
+
+    def add_symlink(self, name: str, target: str):
+        t = self._tarinfo(name, tarfile.SYMTYPE, 0o777)
+        t.linkname = target
+        self._f.write(self._header(t))
+
+    def add_bytes(self, name: str, data: bytes):
+        t = self._tarinfo(name, tarfile.REGTYPE, 0o644, len(data))
+        self._f.write(self._header(t))
+        self._f.write(data)
+        self._pad(len(data))
+
+    @contextlib.contextmanager
+    def open_stream(self, name: str):
+        """Add a file of unknown size, the output must be seekable"""
+
+        t = self._tarinfo(name, tarfile.REGTYPE, 0o644)
+        header_offset = self._f.tell()
+        self._f.write(self._header(t))
+
+        yield self._f
+
+        end = self._f.tell()
+        t.size = end - header_offset - tarfile.BLOCKSIZE
+        self._f.seek(header_offset)
+        self._f.write(self._header(t))
+        self._f.seek(end)
+        self._pad(t.size)
+
+    @contextlib.contextmanager
+    def open_sized(self, name: str, size: int):
+        """Add a file of known size, the output may be a pipe"""
+
+        t = self._tarinfo(name, tarfile.REGTYPE, 0o644, size)
+        self._f.write(self._header(t))
+
+        out = CountingWriter(self._f)
+        yield out
+
+        if out.written != size:
+            raise ValueError(f"{name}: {out.written} bytes written of {size}")
+
+        self._pad(size)
+
+    def close(self):
+        self._f.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+
+
+class ImageParser:
+    REGISTRY_HOST = "registry-1.docker.io"
+    REGISTRY_IMAGE_PREFIX = "library"
+    DEFAULT_IMAGE_TAG = "latest"
+
+    def __init__(self, image: str):
+        self._registry = None
+        self._image = None
+        self._tag = None
+        self._digest = None
+        self._manifest_digest = None
+
+        self._from_string(image)
+
+    def __str__(self):
+        return f"{self.registry}/{self.image}:{self.image_digest or self.tag}"
+
+    def _from_string(self, image: str):
+        registry = self.REGISTRY_HOST
+        tag = self.DEFAULT_IMAGE_TAG
+
+        idx = image.find("/")
+        if idx > -1 and ("." in image[:idx] or ":" in image[:idx]):
+            registry = image[:idx]
+            image = image[idx + 1 :]
+
+        idx = image.find("@")
+        if idx > -1:
+            self._manifest_digest = tag = image[idx + 1 :]
+            image = image[:idx]
+
+        idx = image.find(":")
+        if idx > -1:
+            tag = image[idx + 1 :]
+            image = image[:idx]
+
+        self._registry = registry
+        self._image = image
+        if not self._manifest_digest:
+            self._tag = tag
+
+    def _url(self, typ: str, tag: str):
+        img = self.image
+        idx = img.find("/")
+        if idx == -1 and self.registry == self.REGISTRY_HOST:
+            img = path_join(self.REGISTRY_IMAGE_PREFIX, img)
+
+        return f"{self._registry}/v2/{img}/{typ}/{tag}"
+
+    @property
+    def url_manifests(self):
+        return self._url("manifests", self._manifest_digest or self._tag)
+
+    @property
+    def url_config_image(self):
+        return self.url_blobs(self._digest or self._tag)
+
+    def url_blobs(self, layer_digest: str):
+        return self._url("blobs", layer_digest)
+
+    @property
+    def image_digest(self):
+        return self._digest
+
+    @property
+    def manifest_digest(self):
+        return self._manifest_digest
+
+    @property
+    def image(self):
+        return self._image
+
+    @property
+    def registry(self):
+        return self._registry
+
+    @property
+    def tag(self):
+        return self._tag
+
+    def set_manifest_digest(self, dig: str):
+        self._manifest_digest = dig
+
+    def set_image_digest(self, dig: str):
+        self._digest = dig
+
+
+class ImageFetcher:
+    __IMG_MANIFEST_FORMAT = "application/vnd.docker.distribution.manifest.v2+json"
+    _LST_MTYPE = "application/vnd.docker.distribution.manifest.list.v2+json"
+    __OCI_IMAGE_MANIFEST_FORMAT = "application/vnd.oci.image.manifest.v1+json"
+    __OCI_IMAGE_INDEX_FORMAT = "application/vnd.oci.image.index.v1+json"
+
+    def __init__(
+        self,
+        work_dir: Path,
+        *,
+        progress: ProgressBar = EmptyProgressBar(),
+        save_cache: bool = False,
+        jobs: int = 1,
+        max_transfers: int = 0,
+        blob_cache: BlobCache = None,
+        stream_extract: bool = True,
+        direct_tar: bool = False,
+        output: BinaryIO = None,
+        segments: int = 1,
+        segment_threshold: int = 256 << 20,
+        pool_size: int = 0,
+        token_cache: TokenCache = None,
+        mirrors: dict[str, list[str]] = None,
+        retry: RetryPolicy = None,
+        throttle: Throttle = None,
+        incremental: bool = False,
+        update: bool = False,
+        oci: bool = False,
+        keep_compressed: bool = False,
+        max_memory: int = 0,
+        resume: bool = True,
+    ):
+
+        self._registry_list: dict[str, Registry | RegistryMirrors] = {}
+        # one token cache for all registries, so tokens survive set_registry
+        self._token_cache = token_cache or TokenCache()
+        # mirror urls by upstream registry host
+        self._mirrors = mirrors or {}
+        self.retry = retry or RetryPolicy()
+        self._throttle = throttle or Throttle()
+        # buffers of all transfers, shared by the registries
+        self.memory = MemoryBudget(max_memory)
+        self._registry_lock = threading.Lock()
+        self._fsm = FilesManager(work_dir)
+        self._save_cache = save_cache
+        self._jobs = max(jobs, 1)
+        self._blob_cache = blob_cache
+        # the blob cache of a pull plan, emptied as the tars are built
+        self._temp_blob_cache = False
+        self._stream_extract = stream_extract
+        # keep streamed blobs until they are extracted, to resume them
+        self._resume = resume
+        self._direct_tar = direct_tar
+        # skip images whose tars are saved from the same manifest
+        self._incremental = incremental
+        # take unchanged layers from the image tar of the previous pull
+        self._update = update
+        # save OCI image layouts with the blobs as fetched
+        self._oci = oci
+        # layer.tar files are the blobs as fetched, docker load takes them
+        self._keep_compressed = keep_compressed
+        # write the image tar to a file object instead of the work dir
+        self._output = output
+        self._segments = segments
+        self._segment_threshold = segment_threshold
+        self._max_transfers = max_transfers
+        self._pool_size = pool_size or max(
+            10, self._jobs * max(segments, 1), max_transfers
+        )
+        self._transfer_slots = None
+        if max_transfers > 0:
+            self._transfer_slots = threading.BoundedSemaphore(max_transfers)
+        self._progress_bar = progress
+        self._layer_ids = LayerIdsCache()
+
+    def set_registry(
+        self,
+        registry: str,
+        user: str = None,
+        password: str = None,
+        ssl: bool = True,
+    ):
+        registry = registry_host(registry)
+
+        creds = requests.auth.HTTPBasicAuth(user, password) if user else None
+        self._registry_list[registry] = self._new_registry(
+            registry, creds, ssl
+        )
+
+    def _new_registry(
+        self,
+        registry: str,
+        credentials: requests.auth.HTTPBasicAuth = None,
+        ssl: bool = True,
+    ) -> Registry | RegistryMirrors:
+        upstream = Registry(
+            credentials,
+            ssl,
+            self._pool_size,
+            self._token_cache,
+            self.retry,
+            self._throttle,
+            self.memory,
+        )
+
+        mirrors = self._mirrors.get(registry)
+        if not mirrors:
+            return upstream
+
+        return RegistryMirrors.from_urls(
+            mirrors,
+            upstream,
+            pool_size=self._pool_size,
+            token_cache=self._token_cache,
+            retry=self.retry,
+            throttle=self._throttle,
+            memory=self.memory,
+        )
+
+    def _get_registry(self, registry: str) -> Registry | RegistryMirrors:
+        # one Registry per host, so its connections and token are reused
+        with self._registry_lock:
+            if registry not in self._registry_list:
+                self._registry_list[registry] = self._new_registry(registry)
+
+            return self._registry_list[registry]
+
+    @contextlib.contextmanager
+    def _transfer_slot(self, segments: int = 1):
+        slots = self._transfer_slots or contextlib.nullcontext()
+        with slots, self.memory.reserve(TRANSFER_MEMORY * segments):
+            yield
+
+    def _layer_segments(self, layer: ImageLayer) -> int:
+        if layer.size < self._segment_threshold:
+            return 1
+
+        return self._segments
+
+    def _fetch_layers(self, registry: Registry, layers: list[tuple]):
+        def fetch(url, out_file, layer, progress):
+            with self._transfer_slot(self._layer_segments(layer)):
+                registry.fetch_blob(
+                    url,
+                    out_file,
+                    sha256=layer.digest.split(":", 1)[1],
+                    headers={"Accept": layer.media_type},
+                    progress=progress,
+                    cache=self._blob_cache,
+                    stream=self._stream_extract,
+                    extract=not self._keep_compressed,
+                    size=layer.size,
+                    segments=self._layer_segments(layer),
+                    media_type=layer.media_type,
+                    resume=self._resume,
+                )
+
+            if self._keep_compressed:
+                os.replace(out_file.with_suffix(".gz"), out_file)
+
+        if self._jobs < 2 or len(layers) < 2:
+            for layer in layers:
+                fetch(*layer, self._progress_bar)
+
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self._jobs) as pool:
+            futures = [
+                pool.submit(fetch, *layer, copy.copy(self._progress_bar))
+                for layer in layers
+            ]
+            try:
+                for fut in concurrent.futures.as_completed(futures):
+                    fut.result()
+            except BaseException:
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise
+
+    def _get_manifest(
+        self, registry: Registry, img: ImageParser, media_type: str
+    ) -> dict:
+        return json.loads(self._get_manifest_raw(registry, img, media_type))
+
+    def _get_manifest_raw(
+        self, registry: Registry, img: ImageParser, media_type: str
+    ) -> bytes:
+        digest = img.manifest_digest
+        cache = self._blob_cache
+        if cache and digest:
+            data = cache.read(digest)
+            if data is not None:
+                return data
+
+        resp = registry.get(img.url_manifests, headers={"Accept": media_type})
+        # only manifests pulled by digest are immutable
+        if cache and digest:
+            cache.put_bytes(digest, resp.content)
+
+        return resp.content
+
+    def _get_config(
+        self, registry: Registry, img: ImageParser, out_file: Path = None
+    ) -> bytes:
+        cache = self._blob_cache
+        if cache and out_file and cache.link(img.image_digest, out_file):
+            return out_file.read_bytes()
+
+        if cache:
+            data = cache.read(img.image_digest)
+            if data is not None:
+                return data
+
+        data = registry.get(img.url_config_image).content
+        if out_file:
+            out_file.write_bytes(data)
+        if cache:
+            cache.put_bytes(img.image_digest, data)
+
+        return data
+
+    def _fetch_image(self, img: ImageParser, media_type: str, dir_name: str):
+        registry = self._get_registry(img.registry)
+        direct = self._direct_tar or self._output is not None or self._oci
+        saver = None if direct else self._fsm(dir_name)
+
+        # get image manifest
+        image_manifest_raw = self._get_manifest_raw(registry, img, media_type)
+        image_manifest_spec = json.loads(image_manifest_raw)
+
+        if image_manifest_spec["schemaVersion"] == 1:
+            raise ValueError("schema version 1 image manifest not supported")
+
+        img.set_image_digest(image_manifest_spec["config"]["digest"])
+
+        if self._oci:
+            self._fetch_oci(
+                registry,
+                img,
+                media_type,
+                dir_name,
+                image_manifest_raw,
+                image_manifest_spec,
+            )
+
+            return
+
+        # get and save image config
+        image_digest_hash = img.image_digest.split(":")[1]
+        image_config_filename = f"{image_digest_hash}.json"
+        image_config_raw = self._get_config(
+            registry,
+            img,
+            saver.filepath(image_config_filename) if saver else None,
+        )
+        files, image_layers, created = self._image_files(
+            img, image_manifest_spec, image_config_filename, image_config_raw
+        )
+
+        # Save layers with metadata to tar file
+        filename = self._tar_path(dir_name)
+
+        if self._output is not None:
+            self._write_tar(
+                registry,
+                img,
+                self._output,
+                dir_name,
+                created,
+                files,
+                image_layers,
+            )
 
-        buf = struct.pack("%ds" % tarfile.BLOCKSIZE, b"".join(parts))
-        chksum = tarfile.calc_chksums(buf[-tarfile.BLOCKSIZE :])[0]
+            return
 
-        return buf[:-364] + bytes("%06o\0" % chksum, "ascii") + buf[-357:]
+        reuse = {}
+        if self._update and filename.exists():
+            reuse = self._reusable_layers(filename, image_layers)
 
+        if self._direct_tar:
+            part_file = filename.with_name(filename.name + ".part")
+            try:
+                with open(part_file, "wb") as f:
+                    self._write_tar(
+                        registry,
+                        img,
+                        f,
+                        dir_name,
+                        created,
+                        files,
+                        image_layers,
+                        reuse,
+                    )
 
-def chain_ids(ids_list: list) -> list[str]:
-    chain = list()
-    chain.append(ids_list[0])
+                os.replace(part_file, filename)
+            finally:
+                part_file.unlink(missing_ok=True)
+        else:
+            self._write_dir(registry, img, saver, files, image_layers, reuse)
 
-    if len(ids_list) < 2:
-        return ids_list
+            make_tar(filename, saver.work_dir, created)
+            if not self._save_cache:
+                shutil.rmtree(saver.work_dir)
 
-    nxt = list()
-    chain_b = f"{ids_list[0]} {ids_list[1]}".encode()
-    nxt.append("sha256:" + hashlib.sha256(chain_b).hexdigest())
-    nxt.extend(ids_list[2:])
+        os.chmod(filename, 0o600)
 
-    chain.extend(chain_ids(nxt))
+    def _fetch_oci(
+        self,
+        registry: Registry,
+        img: ImageParser,
+        media_type: str,
+        dir_name: str,
+        manifest_raw: bytes,
+        manifest: dict,
+    ):
+        """Save the image as an OCI image layout tar, the blobs are written
+        as fetched, still compressed
+        """
+
+        config_raw = self._get_config(registry, img)
+        created = date_parse(json.loads(config_raw)["created"]).timestamp()
+        manifest_digest = "sha256:" + hashlib.sha256(manifest_raw).hexdigest()
+
+        descriptor = {
+            "mediaType": media_type,
+            "digest": manifest_digest,
+            "size": len(manifest_raw),
+        }
+        image_manifest = Manifest(Config=oci_blob_path(img.image_digest))
+        if img.tag:
+            descriptor["annotations"] = {
+                "io.containerd.image.name": oci_image_name(img),
+                "org.opencontainers.image.ref.name": img.tag,
+            }
+            image_manifest.RepoTags.append(f"{img.image}:{img.tag}")
+        else:
+            image_manifest.RepoTags = None
 
-    return chain
+        index = {
+            "schemaVersion": 2,
+            "mediaType": self.__OCI_IMAGE_INDEX_FORMAT,
+            "manifests": [descriptor],
+        }
 
+        layers = {}
+        for layer_info in manifest["layers"]:
+            digest = layer_info["digest"]
+            image_manifest.Layers.append(oci_blob_path(digest))
+            layers[oci_blob_path(digest)] = ImageLayer(
+                id=digest.split(":", 1)[1],
+                json="",
+                digest=digest,
+                media_type=layer_info["mediaType"],
+                size=layer_info.get("size", 0),
+            )
 
-def layer_ids_list(chain_ids_list: list, config_image: dict) -> list[str]:
-    config_image.pop("id", "")
+        # manifest.json lets `docker load` read the layout
+        images_manifest_list = ManifestList([image_manifest])
+        files = {
+            "index.json": json.dumps(index, separators=JSON_SEPARATOR),
+            "manifest.json": images_manifest_list.json + "\n",
+            "oci-layout": json.dumps(
+                {"imageLayoutVersion": "1.0.0"}, separators=JSON_SEPARATOR
+            ),
+        }
+        files = {name: data.encode() for name, data in files.items()}
+        files |= {
+            oci_blob_path(manifest_digest): manifest_raw,
+            oci_blob_path(img.image_digest): config_raw,
+        }
+
+        if self._output is not None:
+            self._write_oci(
+                registry, img, self._output, dir_name, created, files, layers
+            )
 
-    chan_ids = []
-    parent = None
-    for chain_id in chain_ids_list:
-        config = LayerConfig(layer_id=chain_id, parent=parent)
+            return
 
-        config.container_config = ContainerConfig()
-        if chain_id == chain_ids_list[-1]:
-            config.config = ContainerConfig()
-            config.deepcopy(config_image)
+        filename = self._tar_path(dir_name)
+        part_file = filename.with_name(filename.name + ".part")
+        try:
+            with open(part_file, "wb") as f:
+                self._write_oci(
+                    registry, img, f, dir_name, created, files, layers
+                )
 
-        parent = "sha256:" + hashlib.sha256(config.json.encode()).hexdigest()
-        chan_ids.append(parent)
+            os.replace(part_file, filename)
+        finally:
+            part_file.unlink(missing_ok=True)
 
-    return chan_ids
+        os.chmod(filename, 0o600)
 
+    def _write_oci(
+        self,
+        registry: Registry,
+        img: ImageParser,
+        f: BinaryIO,
+        scratch_name: str,
+        created: float,
+        files: dict[str, bytes],
+        layers: dict[str, ImageLayer],
+    ):
+        scratch = self._fsm(f".{scratch_name}")
+        pool = concurrent.futures.ThreadPoolExecutor(self._jobs)
+        try:
+            blobs = {
+                name: pool.submit(
+                    self._prefetch_layer,
+                    registry,
+                    img.url_blobs(layer.digest),
+                    scratch.filepath(f"{layer.id}.tar"),
+                    layer,
+                )
+                for name, layer in layers.items()
+            }
+
+            with TarWriter(f, created) as tar:
+                tar.add_dir("blobs")
+                tar.add_dir("blobs/sha256")
+                for name in sorted([*files, *blobs]):
+                    if name in files:
+                        tar.add_bytes(name, files[name])
+                        continue
+
+                    blob_file = blobs[name].result()
+                    size = os.path.getsize(blob_file)
+                    with tar.open_sized(name, size) as out:
+                        with open(blob_file, "rb") as src:
+                            shutil.copyfileobj(src, out, 1 << 20)
+
+                    os.remove(blob_file)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            shutil.rmtree(scratch.work_dir)
+
+    def _image_files(
+        self,
+        img: ImageParser,
+        image_manifest_spec: dict,
+        image_config_filename: str,
+        image_config_raw: bytes,
+    ) -> tuple[dict[str, bytes], list[ImageLayer], float]:
+        """Metadata files, layers and mtime of the docker-save image tar"""
 
-def date_parse(s: str) -> datetime.datetime:
-    layout = "%Y-%m-%dT%H:%M:%S.%f%z"
+        image_config = json_loads_raw(image_config_raw)
 
-    # remove Z at the end of the line
-    if s.endswith("Z"):
-        s = s[:-1]
+        image_manifest = Manifest(Config=image_config_filename)
+        if img.tag:
+            image_manifest.RepoTags.append(f"{img.image}:{img.tag}")
+        else:
+            image_manifest.RepoTags = None
 
-    nano_s = 0
-    datetime_parts = s.split(".")
-    if len(datetime_parts) == 2:
-        nano_s = datetime_parts[-1]
-        # cut nanoseconds to microseconds
-        if len(nano_s) > 6:
-            nano_s = nano_s[:6]
+        # fetch all layers with metadata
+        diff_ids = image_config["rootfs"]["diff_ids"]
+        v1_layer_ids_list = self._layer_ids.get(
+            diff_ids, image_manifest_spec["config"]["digest"], image_config
+        )
 
-    dt = "{}.{}+00:00".format(datetime_parts[0], nano_s)
+        v1_layer_id = None
+        parent_id = None
+        previous_digest = None
+        image_layers = []
+        layers = image_manifest_spec["layers"]
+        for i, layer_info in enumerate(layers):
+            v1_layer_id = v1_layer_ids_list[i][7:]
+            image_manifest.Layers.append(f"{v1_layer_id}/layer.tar")
 
-    return datetime.datetime.strptime(dt, layout)
+            v1_layer_info = V1Image(
+                id=v1_layer_id,
+                parent=parent_id,
+                os=image_config["os"],
+                container_config=ContainerConfig(),
+            )
 
+            if layer_info == layers[-1]:
+                v1_layer_info.config = ContainerConfig()
+                v1_layer_info.deepcopy(image_config)
 
-def www_auth(hdr: str) -> tuple[str, dict]:
-    auth_scheme, info = hdr.split(" ", 1)
+            digest = layer_info["digest"]
+            image_layers.append(
+                ImageLayer(
+                    id=v1_layer_id,
+                    json=v1_layer_info.json,
+                    digest=digest,
+                    media_type=layer_info["mediaType"],
+                    size=layer_info.get("size", 0),
+                    # `docker save` command is not deterministic https://github.com/moby/moby/issues/42766#issuecomment-1801221610
+                    link=parent_id if previous_digest == digest else None,
+                    diff_id=diff_ids[i],
+                )
+            )
 
-    out = {}
-    for part in info.split(","):
-        k, v = part.split("=", 1)
-        out[k] = v.replace('"', "").strip()
+            previous_digest = digest
+            parent_id = v1_layer_id
 
-    return auth_scheme, out
+        files = {image_config_filename: image_config_raw}
+        if img.tag:
+            # https://github.com/moby/moby/issues/45440
+            # docker didn't create this file when pulling image by digest,
+            # but podman created ¯\_(ツ)_/¯
+            repos_legacy = {img.image: {img.tag: v1_layer_id}}
+            data = json.dumps(repos_legacy, separators=JSON_SEPARATOR) + "\n"
 
+            files["repositories"] = data.encode()
 
-def sha256sum(name: str | Path, chunk_num_blocks: int = 128) -> str:
-    h = hashlib.sha256()
+        images_manifest_list = ManifestList()
+        images_manifest_list.manifests.append(image_manifest)
+        files["manifest.json"] = (images_manifest_list.json + "\n").encode()
 
-    with open(name, "rb", buffering=0) as f:
-        while chunk := f.read(chunk_num_blocks * h.block_size):
-            h.update(chunk)
+        created = date_parse(image_config["created"]).timestamp()
 
-    return h.hexdigest()
+        return files, image_layers, created
+
+    def _reusable_layers(
+        self, tar_path: Path, image_layers: list[ImageLayer]
+    ) -> dict[str, tuple[Path, int, int]]:
+        """Layers found in the tar of a previous pull, checked against
+        their diff ids, as the tar path and the data range by layer id
+        """
+
+        ranges = tar_layer_ranges(tar_path)
+
+        reuse = {}
+        with open(tar_path, "rb") as f:
+            for layer in image_layers:
+                rng = ranges.get(layer.diff_id)
+                if layer.link or rng is None:
+                    continue
+
+                h = Sha256()
+                f.seek(rng[0])
+                size = rng[1]
+                while size and (data := f.read(min(size, 1 << 20))):
+                    h.update(data)
+                    size -= len(data)
+
+                if f"sha256:{h.hexdigest()}" == layer.diff_id:
+                    reuse[layer.id] = (tar_path, *rng)
+                else:
+                    logging.warning(f"{tar_path}: {layer.diff_id} is broken")
 
+        return reuse
 
-def sizeof_fmt(num: int) -> str:
-    for unit in ["B", "KiB", "MiB", "GiB"]:
-        if abs(num) < 1024.0:
-            return f"{num:3.1f}{unit}"
-        num /= 1024.0
+    def _reuse_layer(self, layer: ImageLayer, reuse: dict, out: BinaryIO):
+        src, offset, size = reuse[layer.id]
+        with open(src, "rb") as f:
+            copy_range(f, offset, size, out)
 
-    return f"{num:3.2f}TiB"
+        self._progress_bar.flush(f"{layer.digest[7:19]}: Already exists")
 
+    def _write_dir(
+        self,
+        registry: Registry,
+        img: ImageParser,
+        saver: FilesManager,
+        files: dict[str, bytes],
+        image_layers: list[ImageLayer],
+        reuse: dict[str, tuple[Path, int, int]] = None,
+    ):
+        pending_layers = []
+        for url, out_file, layer in self._write_meta(
+            img, saver, files, image_layers
+        ):
+            if reuse and layer.id in reuse:
+                with open(out_file, "wb") as out:
+                    self._reuse_layer(layer, reuse, out)
+            else:
+                pending_layers.append((url, out_file, layer))
 
-def image_platform(s: str) -> tuple[str, str]:
-    _os, arch = "linux", os_platform.machine()
-    if s:
-        _os, arch = s.split("/")
+        self._fetch_layers(registry, pending_layers)
 
-    return _os, arch
+    @staticmethod
+    def _write_meta(
+        img: ImageParser,
+        saver: FilesManager,
+        files: dict[str, bytes],
+        image_layers: list[ImageLayer],
+    ) -> list[tuple[str, Path, ImageLayer]]:
+        """Write all files of the image dir but layers, which are returned"""
+
+        pending_layers = []
+        for layer in image_layers:
+            with saver(layer.id) as fw:
+                if layer.link:
+                    # left by an interrupted pull
+                    fw.filepath("layer.tar").unlink(missing_ok=True)
+                    os.symlink(
+                        f"../{layer.link}/layer.tar", fw.filepath("layer.tar")
+                    )
+                else:
+                    pending_layers.append(
+                        (
+                            img.url_blobs(layer.digest),
+                            fw.filepath("layer.tar"),
+                            layer,
+                        )
+                    )
 
+                fw.write("json", layer.json)
+                fw.write("VERSION", "1.0")
 
-def unzip(
-    zip_file_path: str | Path,
-    out_file_path: str | Path,
-    remove_zip_file: bool = True,
-    progress: ProgressBar = EmptyProgressBar(),
-):
-    with gzip.open(zip_file_path, "rb") as zip_data, open(
-        out_file_path, "wb"
-    ) as unzip_data:
-        zip_data.myfileobj.seek(-4, 2)
-        size_bytes = zip_data.myfileobj.read(4)
-        zip_data.myfileobj.seek(0)
+        for name, data in files.items():
+            # the image config is saved by _get_config
+            if not saver.filepath(name).exists():
+                saver.write(name, data)
 
-        progress.set_size(struct.unpack("I", size_bytes)[0])
+        return pending_layers
 
-        done = 0
-        while chunk := zip_data.read(131072):
-            unzip_data.write(chunk)
-            done += len(chunk)
+    def _write_tar(
+        self,
+        registry: Registry,
+        img: ImageParser,
+        f: BinaryIO,
+        scratch_name: str,
+        created: float,
+        files: dict[str, bytes],
+        image_layers: list[ImageLayer],
+        reuse: dict[str, tuple[Path, int, int]] = None,
+    ):
+        reuse = reuse or {}
+        layers = {layer.id: layer for layer in image_layers}
+        blobs = [
+            layer
+            for layer in image_layers
+            if not layer.link and layer.id not in reuse
+        ]
+        # the size of a layer must be known before it is written to a pipe
+        seekable = f.seekable()
+
+        # layers can be written to the tar only in its order, the ones
+        # downloaded ahead of time are kept compressed, as well as
+        # the ones downloaded by several range requests. For a pipe they
+        # are extracted instead, the size is then known once written
+        if (
+            (self._jobs > 1 and len(blobs) > 1)
+            or not seekable
+            or self._keep_compressed
+        ):
+            prefetch_layers = blobs
+        else:
+            prefetch_layers = [
+                layer for layer in blobs if self._layer_segments(layer) > 1
+            ]
+
+        # in the tar order, a few at a time as they wait in the scratch
+        pending = sorted(prefetch_layers, key=lambda layer: layer.id)
+        extract = not seekable and not self._keep_compressed
+        window = self._jobs * PREFETCH_LAYERS_PER_JOB
+        scratch = None
+        prefetch = {}
+        pool = None
+        if pending:
+            scratch = self._fsm(f".{scratch_name}")
+            pool = concurrent.futures.ThreadPoolExecutor(self._jobs)
+
+        def prefetch_more():
+            while pending and len(prefetch) < window:
+                layer = pending.pop(0)
+                prefetch[layer.id] = pool.submit(
+                    self._prefetch_layer,
+                    registry,
+                    img.url_blobs(layer.digest),
+                    scratch.filepath(f"{layer.id}.tar"),
+                    layer,
+                    extract=extract,
+                )
 
-            progress.write(done)
+        try:
+            prefetch_more()
+            with TarWriter(f, created) as tar:
+                for name in sorted([*files, *layers]):
+                    layer = layers.get(name)
+                    if layer is None:
+                        tar.add_bytes(name, files[name])
+                        continue
+
+                    tar.add_dir(name)
+                    tar.add_bytes(f"{name}/VERSION", b"1.0")
+                    tar.add_bytes(f"{name}/json", layer.json.encode())
+
+                    layer_tar = f"{name}/layer.tar"
+                    if layer.link:
+                        link = f"../{layer.link}/layer.tar"
+                        tar.add_symlink(layer_tar, link)
+                        continue
+
+                    if layer.id in reuse:
+                        size = reuse[layer.id][2]
+                        with tar.open_sized(layer_tar, size) as out:
+                            self._reuse_layer(layer, reuse, out)
+                        continue
+
+                    if layer.id in prefetch:
+                        blob_file = prefetch.pop(layer.id).result()
+                        prefetch_more()
+                        if self._keep_compressed or extract:
+                            size = os.path.getsize(blob_file)
+                            with tar.open_sized(layer_tar, size) as out:
+                                with open(blob_file, "rb") as src:
+                                    shutil.copyfileobj(src, out, 1 << 20)
+                        else:
+                            extracting = self.memory.reserve(TRANSFER_MEMORY)
+                            with extracting, tar.open_stream(layer_tar) as out:
+                                unzip_to(
+                                    blob_file,
+                                    out,
+                                    media_type=layer.media_type,
+                                )
+
+                        os.remove(blob_file)
+                        continue
+
+                    with tar.open_stream(layer_tar) as out:
+                        with self._transfer_slot():
+                            registry.fetch_blob_into(
+                                img.url_blobs(layer.digest),
+                                out,
+                                sha256=layer.digest.split(":", 1)[1],
+                                headers={"Accept": layer.media_type},
+                                progress=self._progress_bar,
+                                cache=self._blob_cache,
+                                media_type=layer.media_type,
+                            )
+        finally:
+            if pool:
+                pool.shutdown(wait=True, cancel_futures=True)
+            if scratch:
+                shutil.rmtree(scratch.work_dir)
+
+    def _prefetch_layer(
+        self,
+        registry: Registry,
+        url: str,
+        out_file: Path,
+        layer: ImageLayer,
+        extract: bool = False,
+    ) -> Path:
+        """Download a layer blob to the scratch, compressed unless extract,
+        and return its path
+        """
+
+        with self._transfer_slot(self._layer_segments(layer)):
+            registry.fetch_blob(
+                url,
+                out_file,
+                sha256=layer.digest.split(":", 1)[1],
+                headers={"Accept": layer.media_type},
+                progress=copy.copy(self._progress_bar),
+                cache=self._blob_cache,
+                stream=self._stream_extract,
+                extract=extract,
+                size=layer.size,
+                segments=self._layer_segments(layer),
+                media_type=layer.media_type,
+                resume=False,
+            )
 
-    if remove_zip_file:
-        os.remove(zip_file_path)
+        return out_file if extract else out_file.with_suffix(".gz")
 
+    def pull_many(
+        self, images: list[str], platform: str, parallel: int = 1
+    ) -> list[PullResult]:
+        if len(images) > 1 and not self._update:
+            return self._pull_planned(images, platform, parallel)
 
-def make_tar(out_path: Path, path: Path, created: float):
-    tar = tarfile.open(out_path, "w")
-    tar.tarinfo = TarInfo
-    tar.format = tarfile.USTAR_FORMAT
-    tarfile.RECORDSIZE = 512
+        def pull(image: str) -> PullResult:
+            result = PullResult(image)
+            started = time.monotonic()
+            try:
+                result.digest = self.pull(image, platform)
+            except Exception as e:
+                logging.error(f"Failed to pull {image}: {e}")
+                result.error = e
+            result.elapsed = time.monotonic() - started
+
+            return result
+
+        if parallel < 2 or len(images) < 2:
+            return [pull(image) for image in images]
+
+        with concurrent.futures.ThreadPoolExecutor(parallel) as pool:
+            return list(pool.map(pull, images))
+
+    def _pull_planned(
+        self, images: list[str], platform: str, parallel: int
+    ) -> list[PullResult]:
+        """Resolve all the images first, download every blob they need
+        once, then build the image tars from the blob cache
+        """
+
+        started = time.monotonic()
+        with self._planning_cache() as fetcher:
+            plan = fetcher.plan(images, platform, parallel)
+            fetcher._prefetch_plan(plan)
+
+            def materialize(planned: PlannedImage) -> PullResult:
+                result = PullResult(planned.image, planned.up_to_date)
+                if planned.error:
+                    result.error = planned.error
+                elif not planned.up_to_date:
+                    try:
+                        result.digest = fetcher._materialize(planned, plan)
+                    except Exception as e:
+                        logging.error(f"Failed to pull {planned.image}: {e}")
+                        result.error = e
+                result.elapsed = time.monotonic() - started
+
+                return result
+
+            if parallel < 2:
+                return [materialize(planned) for planned in plan.images]
+
+            with concurrent.futures.ThreadPoolExecutor(parallel) as pool:
+                return list(pool.map(materialize, plan.images))
+
+    def plan(
+        self, images: list[str], platform: str, parallel: int = 1
+    ) -> PullPlan:
+        """Manifests of the images and the unique blobs they consist of,
+        resolved parallel images at a time
+        """
+
+        def resolve(image: str) -> PullPlan:
+            plan = PullPlan()
+            try:
+                planned = self._resolve(image, platform)
+                if not planned.up_to_date:
+                    self._plan_blobs(plan, planned)
+            except Exception as e:
+                logging.error(f"Failed to pull {image}: {e}")
+                planned = PlannedImage(image, None, error=e)
 
-    def mod(t: tarfile.TarInfo):
-        t.uid = 0
-        t.gid = 0
-        t.uname = ""
-        t.gname = ""
+            plan.images.append(planned)
 
-        if t.name in ["manifest.json", "repositories"]:
-            t.mtime = 0
+            return plan
+
+        plan = PullPlan()
+        if parallel < 2 or len(images) < 2:
+            plans = [resolve(image) for image in images]
         else:
-            t.mtime = created
+            with concurrent.futures.ThreadPoolExecutor(parallel) as pool:
+                plans = list(pool.map(resolve, images))
 
-        return t
+        # merged in the order of the images, as the plan is shown
+        for image_plan in plans:
+            plan.merge(image_plan)
 
-    walk = []
-    for d in path.iterdir():
-        walk.append(d)
+        return plan
 
-    for d in sorted(walk):
-        tar.add(str(d.resolve()), str(d.relative_to(path)), filter=mod)
+    def pull(self, image: str, platform: str) -> str:
+        planned = self._resolve(image, platform)
+        if planned.up_to_date:
+            return planned.up_to_date
 
-    tar.close()
+        if len(planned.targets) < 2 or self._update:
+            return self._materialize(planned)
 
+        # the platforms of a manifest list share blobs
+        with self._planning_cache() as fetcher:
+            plan = PullPlan([planned])
+            fetcher._plan_blobs(plan, planned)
+            fetcher._prefetch_plan(plan)
 
-class ImageParser:
-    REGISTRY_HOST = "registry-1.docker.io"
-    REGISTRY_IMAGE_PREFIX = "library"
-    DEFAULT_IMAGE_TAG = "latest"
+            return fetcher._materialize(planned, plan)
 
-    def __init__(self, image: str):
-        self._registry = None
-        self._image = None
-        self._tag = None
-        self._digest = None
-        self._manifest_digest = None
+    def _resolve(self, image: str, platform: str) -> PlannedImage:
+        img = ImageParser(image)
+        registry = self._get_registry(img.registry)
+        planned = PlannedImage(image, img)
 
-        self._from_string(image)
+        if self._incremental:
+            planned.manifest_digest, planned.up_to_date = (
+                self._check_unchanged(registry, img, platform)
+            )
+            if planned.up_to_date:
+                print(f"Status: Image is up to date for {image}\n")
+                return planned
 
-    def __str__(self):
-        return f"{self.registry}/{self.image}:{self.image_digest or self.tag}"
+        print(f"{img.tag}: Pulling from {img.image}")
+        # get manifest list
+        manifest = self._get_manifest(registry, img, self._LST_MTYPE)
+        planned.targets = self._pull_targets(img, manifest, platform)
 
-    def _from_string(self, image: str):
-        registry = self.REGISTRY_HOST
-        tag = self.DEFAULT_IMAGE_TAG
+        return planned
 
-        idx = image.find("/")
-        if idx > -1 and ("." in image[:idx] or ":" in image[:idx]):
-            registry = image[:idx]
-            image = image[idx + 1 :]
+    def _plan_blobs(self, plan: PullPlan, planned: PlannedImage):
+        img = copy.copy(planned.img)
+        registry = self._get_registry(img.registry)
 
-        idx = image.find("@")
-        if idx > -1:
-            self._manifest_digest = tag = image[idx + 1 :]
-            image = image[:idx]
+        for media_type, dir_name, digest in planned.targets:
+            if digest:
+                img.set_manifest_digest(digest)
+
+            spec = self._get_manifest(registry, img, media_type)
+            if spec["schemaVersion"] == 1:
+                raise ValueError(
+                    "schema version 1 image manifest not supported"
+                )
+
+            descriptors = {d["digest"]: d for d in spec["layers"]}
+            descriptors[spec["config"]["digest"]] = spec["config"]
+            for blob_digest, info in descriptors.items():
+                plan.naive_size += info.get("size", 0)
+
+                blob = plan.blobs.get(blob_digest)
+                if blob is None:
+                    layer = ImageLayer(
+                        id=blob_digest.split(":", 1)[1],
+                        json="",
+                        digest=blob_digest,
+                        media_type=info["mediaType"],
+                        size=info.get("size", 0),
+                    )
+                    blob = PlannedBlob(
+                        layer, img.registry, img.url_blobs(blob_digest)
+                    )
+                    plan.blobs[blob_digest] = blob
 
-        idx = image.find(":")
-        if idx > -1:
-            tag = image[idx + 1 :]
-            image = image[:idx]
+                blob.consumers.append(dir_name)
 
-        self._registry = registry
-        self._image = image
-        if not self._manifest_digest:
-            self._tag = tag
+    def _materialize(
+        self, planned: PlannedImage, plan: PullPlan = None
+    ) -> str:
+        img = planned.img
+        for i, (media_type, dir_name, digest) in enumerate(planned.targets):
+            if digest:
+                img.set_manifest_digest(digest)
 
-    def _url(self, typ: str, tag: str):
-        img = self.image
-        idx = img.find("/")
-        if idx == -1 and self.registry == self.REGISTRY_HOST:
-            img = path_join(self.REGISTRY_IMAGE_PREFIX, img)
+            self._drop_state(dir_name)
+            try:
+                self._fetch_image(img, media_type, dir_name)
+            except BaseException:
+                # the tars left out need their blobs no more either
+                self._free_blobs(plan, [t[1] for t in planned.targets[i:]])
+                raise
+
+            self._free_blobs(plan, [dir_name])
+
+        if planned.manifest_digest:
+            state = {
+                "digest": planned.manifest_digest,
+                "image": img.image_digest,
+            }
+            for _, dir_name, _ in planned.targets:
+                self._save_state(dir_name, state)
+
+        print("Digest:", img.image_digest, "\n")
+
+        return img.image_digest
+
+    def _free_blobs(self, plan: PullPlan | None, dir_names: list[str]):
+        """Remove the blobs of the temporary cache once their tars are
+        built, so they do not pile up until the last one
+        """
+
+        if plan is None or not self._temp_blob_cache:
+            return
+
+        for digest in plan.release(dir_names):
+            self._blob_cache.path(digest).unlink(missing_ok=True)
+
+    @contextlib.contextmanager
+    def _planning_cache(self):
+        """The fetcher with a blob cache, a temporary one if it has none"""
+
+        if self._blob_cache is not None:
+            yield self
+            return
+
+        temp_cache = Path(
+            tempfile.mkdtemp(prefix=".blobs-", dir=self._fsm.work_dir)
+        )
+        fetcher = copy.copy(self)
+        fetcher._blob_cache = BlobCache(temp_cache)
+        fetcher._temp_blob_cache = True
+        try:
+            yield fetcher
+        finally:
+            shutil.rmtree(temp_cache, ignore_errors=True)
+
+    def _prefetch_plan(self, plan: PullPlan):
+        """Download the blobs shared by tars of the plan into the blob
+        cache, the others are extracted as they stream in
+        """
+
+        scratch = Path(
+            tempfile.mkdtemp(prefix=".prefetch-", dir=self._fsm.work_dir)
+        )
+        shared = [b for b in plan.blobs.values() if len(b.consumers) > 1]
+        # the largest first, so they do not end up last alone
+        blobs = sorted(shared, key=lambda b: -b.layer.size)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self._jobs) as pool:
+                futures = {
+                    pool.submit(
+                        self._prefetch_layer,
+                        self._get_registry(blob.registry),
+                        blob.url,
+                        scratch.joinpath(f"{blob.layer.id}.tar"),
+                        blob.layer,
+                    ): blob
+                    for blob in blobs
+                }
+                for fut in concurrent.futures.as_completed(futures):
+                    try:
+                        os.remove(fut.result())
+                    except Exception as e:
+                        # the images needing the blob retry it on their own
+                        digest = futures[fut].layer.digest
+                        logging.warning(f"Failed to prefetch {digest}: {e}")
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def _tar_path(self, dir_name: str) -> Path:
+        return self._fsm.work_dir.joinpath(f"{dir_name}.tar")
+
+    def _state_path(self, dir_name: str) -> Path:
+        # the sidecar of the image tar, written by --incremental and
+        # removed by any other pull of the tar
+        return self._fsm.work_dir.joinpath(f"{dir_name}.tar.json")
+
+    def _drop_state(self, dir_name: str):
+        # the tar is about to be rewritten, maybe from another manifest
+        self._state_path(dir_name).unlink(missing_ok=True)
+
+    def _save_state(self, dir_name: str, state: dict):
+        path = self._state_path(dir_name)
+        tmp = path.with_name(f".{path.name}.{threading.get_ident()}")
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, path)
+
+    def _saved_dir_name(self, name: str) -> str | None:
+        """Name of the only saved tar of a platform given by os and
+        architecture, with or without the variant of the image
+        """
+
+        suffix = ".tar.json"
+        found = []
+        for file_name in os.listdir(self._fsm.work_dir):
+            if not file_name.endswith(suffix):
+                continue
+
+            dir_name = file_name[: -len(suffix)]
+            variant = dir_name[len(name) + 1 :]
+            if dir_name == name or (
+                dir_name.startswith(f"{name}_") and "_" not in variant
+            ):
+                found.append(dir_name)
+
+        return found[0] if len(found) == 1 else None
+
+    def _check_unchanged(
+        self, registry: Registry, img: ImageParser, platform: str
+    ) -> tuple[str | None, str | None]:
+        """Manifest digest of the image by a HEAD request, and the image
+        digest when the saved tars are pulled from that manifest
+        """
+
+        r = registry.head(
+            img.url_manifests, headers={"Accept": self._LST_MTYPE}
+        )
+        manifest_digest = r.headers.get("Docker-Content-Digest")
+        if not manifest_digest:
+            return None, None
+
+        media_type = r.headers.get("Content-Type", "").split(";")[0].strip()
+        if media_type in [self._LST_MTYPE, self.__OCI_IMAGE_INDEX_FORMAT]:
+            # the tar names of a manifest list are known for full platforms
+            img_name_n = img.image.replace("/", "_")
+            img_tag_n = img.tag.replace(":", "_")
+
+            dir_names = []
+            for plf in platform.split(","):
+                if plf == "all":
+                    return manifest_digest, None
+
+                img_os, img_arch = image_platform(plf.strip())
+                if not img_os or not img_arch:
+                    return manifest_digest, None
+
+                dir_name = self._saved_dir_name(
+                    platform_dir_name(
+                        f"{img_name_n}_{img_tag_n}",
+                        {"os": img_os, "architecture": img_arch},
+                    )
+                )
+                if dir_name is None:
+                    return manifest_digest, None
+
+                dir_names.append(dir_name)
+        else:
+            targets = self._pull_targets(
+                img, {"mediaType": media_type}, platform
+            )
+            dir_names = [dir_name for _, dir_name, _ in targets]
+
+        image_digest = None
+        for dir_name in dir_names:
+            try:
+                state = json.loads(self._state_path(dir_name).read_text())
+            except (OSError, ValueError):
+                return manifest_digest, None
+
+            if state.get("digest") != manifest_digest:
+                return manifest_digest, None
+            if not self._tar_path(dir_name).exists():
+                return manifest_digest, None
+
+            image_digest = state.get("image")
+
+        return manifest_digest, image_digest
+
+    def _manifests(self, manifest_list: dict, platform: str) -> list:
+        manifests = manifest_list.get("manifests", [])
+        if manifest_list.get("schemaVersion") == 1:
+            raise ValueError("schema version 1 image manifest not supported")
 
-        return f"{self._registry}/v2/{img}/{typ}/{tag}"
+        if platform == "all":
+            # attestations are stored as images of the unknown platform
+            return [
+                mfst
+                for mfst in manifests
+                if mfst.get("platform", {}).get("os") != "unknown"
+            ]
 
-    @property
-    def url_manifests(self):
-        return self._url("manifests", self._manifest_digest or self._tag)
+        if "," in platform:
+            out = []
+            for plf in platform.split(","):
+                for mfst in self._manifests(manifest_list, plf.strip()):
+                    if mfst not in out:
+                        out.append(mfst)
 
-    @property
-    def url_config_image(self):
-        return self.url_blobs(self._digest or self._tag)
+            return out
 
-    def url_blobs(self, layer_digest: str):
-        return self._url("blobs", layer_digest)
+        img_os, img_arch = image_platform(platform)
 
-    @property
-    def image_digest(self):
-        return self._digest
+        if not img_os and not img_arch:
+            return manifests
 
-    @property
-    def manifest_digest(self):
-        return self._manifest_digest
+        out = []
+        for mfst in manifests:
+            plf = mfst["platform"]
 
-    @property
-    def image(self):
-        return self._image
+            if img_os and img_arch:
+                if plf["os"] == img_os and plf["architecture"] == img_arch:
+                    out.append(mfst)
+                    break
+            else:
+                if plf["os"] == img_os or plf["architecture"] == img_arch:
+                    out.append(mfst)
 
-    @property
-    def registry(self):
-        return self._registry
+        return out
+    
+    def _pull_targets(
+        self, img: ImageParser, manifest: dict, platform: str
+    ) -> list[tuple[str, str, str]]:
+        """Media type, dir name and manifest digest of the images to fetch"""
 
-    @property
-    def tag(self):
-        return self._tag
+        img_name_n = img.image.replace("/", "_")
+        if img.manifest_digest:
+            img_tag_n = img.manifest_digest.replace(":", "_").replace(
+                "@", "_"
+            )
+            img_os, img_arch = image_platform(single_platform(platform))
+            dir_name = f"{img_name_n}_{img_tag_n}_{img_os}_{img_arch}"
 
-    def set_manifest_digest(self, dig: str):
-        self._manifest_digest = dig
+            return [(manifest["mediaType"], dir_name, None)]
 
-    def set_image_digest(self, dig: str):
-        self._digest = dig
+        img_tag_n = img.tag.replace(":", "_")
+        if manifest["mediaType"] in [
+            self.__IMG_MANIFEST_FORMAT,
+            self.__OCI_IMAGE_MANIFEST_FORMAT,
+        ]:
+            return [(manifest["mediaType"], f"{img_name_n}_{img_tag_n}", None)]
+
+        if manifest["mediaType"] not in [
+            self._LST_MTYPE,
+            self.__OCI_IMAGE_INDEX_FORMAT,
+        ]:
+            return []
+
+        targets = []
+        for mfst in self._manifests(manifest, platform):
+            dir_name = platform_dir_name(
+                f"{img_name_n}_{img_tag_n}", mfst["platform"]
+            )
+            if any(dir_name == target[1] for target in targets):
+                raise ValueError(
+                    f"{img}: several images of {dir_name}, pull them "
+                    "by digest"
+                )
 
+            targets.append((mfst["mediaType"], dir_name, mfst["digest"]))
 
-class ImageFetcher:
-    __IMG_MANIFEST_FORMAT = "application/vnd.docker.distribution.manifest.v2+json"
-    __LST_MTYPE = "application/vnd.docker.distribution.manifest.list.v2+json"
-    __OCI_IMAGE_MANIFEST_FORMAT = "application/vnd.oci.image.manifest.v1+json"
-    __OCI_IMAGE_INDEX_FORMAT = "application/vnd.oci.image.index.v1+json"
+        return targets
 
-    def __init__(
-        self,
-        work_dir: Path,
-        *,
-        progress: ProgressBar = EmptyProgressBar(),
-        save_cache: bool = False,
-    ):
 
-        self.__registry_list: dict[str, Registry] = {}
-        self._fsm = FilesManager(work_dir)
-        self._save_cache = save_cache
-        self.__progress_bar = progress
+class AsyncImageFetcher(ImageFetcher):
+    """ImageFetcher running all transfers on one asyncio event loop
+
+    pull and pull_many are coroutines here. Images are saved by way of the
+    image dir and make_tar, with layers extracted while downloading.
+    """
+
+    def __init__(self, work_dir: Path, *, max_connections: int = 8, **kwargs):
+        super().__init__(work_dir, **kwargs)
+
+        self._pool = AsyncConnectionPool(max_connections)
+        # asyncio primitives are bound to the running loop
+        self._slots_loop = None
+        self._async_slots = None
 
     def set_registry(
         self,
@@ -812,179 +4603,184 @@ class ImageFetcher:
         password: str = None,
         ssl: bool = True,
     ):
-        registry = registry.lstrip("https://").lstrip("http://")
+        registry = registry_host(registry)
 
         creds = requests.auth.HTTPBasicAuth(user, password) if user else None
-        self.__registry_list[registry] = Registry(creds, ssl)
+        self._registry_list[registry] = AsyncRegistry(
+            self._pool,
+            creds,
+            ssl,
+            self._token_cache,
+            self.retry,
+            self._throttle,
+        )
 
-    def _get_registry(self, registry: str) -> Registry:
-        return self.__registry_list.get(registry, Registry())
+    def _get_registry(self, registry: str) -> AsyncRegistry:
+        if registry not in self._registry_list:
+            self._registry_list[registry] = AsyncRegistry(
+                self._pool,
+                token_cache=self._token_cache,
+                retry=self.retry,
+                throttle=self._throttle,
+            )
 
-    def _fetch_image(self, img: ImageParser, media_type: str, dir_name: str):
-        registry = self._get_registry(img.registry)
-        saver = self._fsm(dir_name)
+        return self._registry_list[registry]
 
-        # get image manifest
-        image_manifest_resp = registry.get(
+    async def _get_manifest(
+        self, registry: AsyncRegistry, img: ImageParser, media_type: str
+    ) -> dict:
+        digest = img.manifest_digest
+        cache = self._blob_cache
+        if cache and digest:
+            data = cache.read(digest)
+            if data is not None:
+                return json.loads(data)
+
+        resp = await registry.get(
             img.url_manifests, headers={"Accept": media_type}
         )
-        image_manifest_spec = image_manifest_resp.json()
-
-        if image_manifest_spec["schemaVersion"] == 1:
-            raise ValueError("schema version 1 image manifest not supported")
+        data = await resp.read()
+        if cache and digest:
+            cache.put_bytes(digest, data)
 
-        img.set_image_digest(image_manifest_spec["config"]["digest"])
+        return json.loads(data)
 
-        # get image config
-        image_config_resp = registry.get(img.url_config_image)
-        image_config = image_config_resp.json(cls=JSONDecoderRawString)
+    async def _get_config(
+        self, registry: AsyncRegistry, img: ImageParser, out_file: Path
+    ) -> bytes:
+        cache = self._blob_cache
+        if cache and cache.link(img.image_digest, out_file):
+            return out_file.read_bytes()
 
-        # save image config
-        image_digest_hash = img.image_digest.split(":")[1]
-        image_config_filename = f"{image_digest_hash}.json"
-        saver.write(image_config_filename, image_config_resp.content)
+        data = await (await registry.get(img.url_config_image)).read()
+        out_file.write_bytes(data)
+        if cache:
+            cache.put_bytes(img.image_digest, data)
 
-        image_manifest = Manifest(Config=image_config_filename)
-        if img.tag:
-            image_manifest.RepoTags.append(f"{img.image}:{img.tag}")
-        else:
-            image_manifest.RepoTags = None
+        return data
 
-        # fetch all layers with metadata
-        diff_ids = image_config["rootfs"]["diff_ids"]
-        chain_ids_list = chain_ids(diff_ids)
-        v1_layer_ids_list = layer_ids_list(chain_ids_list, image_config)
+    def _loop_transfer_slots(self):
+        """The --max-transfers limit of the running event loop"""
 
-        v1_layer_id = None
-        parent_id = None
-        previous_digest = None
-        layers = image_manifest_spec["layers"]
-        for i, layer_info in enumerate(layers):
-            v1_layer_id = v1_layer_ids_list[i][7:]
-            image_manifest.Layers.append(f"{v1_layer_id}/layer.tar")
+        loop = asyncio.get_running_loop()
+        if self._slots_loop is not loop:
+            self._slots_loop = loop
+            self._async_slots = contextlib.nullcontext()
+            if self._max_transfers > 0:
+                self._async_slots = asyncio.Semaphore(self._max_transfers)
 
-            v1_layer_info = V1Image(
-                id=v1_layer_id,
-                parent=parent_id,
-                os=image_config["os"],
-                container_config=ContainerConfig(),
-            )
+        return self._async_slots
 
-            if layer_info == layers[-1]:
-                v1_layer_info.config = ContainerConfig()
-                v1_layer_info.deepcopy(image_config)
+    async def _fetch_layers(
+        self, registry: AsyncRegistry, layers: list[tuple]
+    ):
+        jobs = asyncio.Semaphore(self._jobs)
+        slots = self._loop_transfer_slots()
+
+        async def fetch(url, out_file, layer):
+            async with jobs, slots:
+                await registry.fetch_blob(
+                    url,
+                    out_file,
+                    sha256=layer.digest.split(":", 1)[1],
+                    headers={"Accept": layer.media_type},
+                    progress=copy.copy(self._progress_bar),
+                    cache=self._blob_cache,
+                    media_type=layer.media_type,
+                )
+
+        tasks = [asyncio.create_task(fetch(*layer)) for layer in layers]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _fetch_image(
+        self, img: ImageParser, media_type: str, dir_name: str
+    ):
+        registry = self._get_registry(img.registry)
+        saver = self._fsm(dir_name)
 
-            digest = layer_info["digest"]
-            with saver(v1_layer_id) as fw:
-                if previous_digest == digest:
-                    # `docker save` command is not deterministic https://github.com/moby/moby/issues/42766#issuecomment-1801221610
-                    os.symlink(
-                        f"../{parent_id}/layer.tar", fw.filepath("layer.tar")
-                    )
-                else:
-                    registry.fetch_blob(
-                        img.url_blobs(digest),
-                        fw.filepath("layer.tar"),
-                        headers={"Accept": layer_info["mediaType"]},
-                        progress=self.__progress_bar,
-                    )
+        # get image manifest
+        image_manifest_spec = await self._get_manifest(
+            registry, img, media_type
+        )
 
-                fw.write("json", v1_layer_info.json)
-                fw.write("VERSION", "1.0")
+        if image_manifest_spec["schemaVersion"] == 1:
+            raise ValueError("schema version 1 image manifest not supported")
 
-            previous_digest = digest
-            parent_id = v1_layer_id
+        img.set_image_digest(image_manifest_spec["config"]["digest"])
 
-        if img.tag:
-            # https://github.com/moby/moby/issues/45440
-            # docker didn't create this file when pulling image by digest,
-            # but podman created ¯\_(ツ)_/¯
-            repos_legacy = {img.image: {img.tag: v1_layer_id}}
-            data = json.dumps(repos_legacy, separators=JSON_SEPARATOR) + "\n"
+        # get and save image config
+        image_digest_hash = img.image_digest.split(":")[1]
+        image_config_filename = f"{image_digest_hash}.json"
+        image_config_raw = await self._get_config(
+            registry, img, saver.filepath(image_config_filename)
+        )
 
-            saver.write("repositories", data)
+        files, image_layers, created = self._image_files(
+            img, image_manifest_spec, image_config_filename, image_config_raw
+        )
 
-        images_manifest_list = ManifestList()
-        images_manifest_list.manifests.append(image_manifest)
-        saver.write("manifest.json", images_manifest_list.json + "\n")
+        pending_layers = self._write_meta(img, saver, files, image_layers)
+        await self._fetch_layers(registry, pending_layers)
 
         # Save layers with metadata to tar file
-        filename = str(self._fsm.work_dir.joinpath(dir_name)) + ".tar"
-        created = date_parse(image_config["created"]).timestamp()
+        filename = Path(str(self._fsm.work_dir.joinpath(dir_name)) + ".tar")
 
-        make_tar(Path(filename), saver.work_dir, created)
+        await asyncio.to_thread(make_tar, filename, saver.work_dir, created)
         os.chmod(filename, 0o600)
         if not self._save_cache:
             shutil.rmtree(saver.work_dir)
 
-    def pull(self, image: str, platform: str):
-        img = ImageParser(image)
-        registry = self._get_registry(img.registry)
-
-        print(f"{img.tag}: Pulling from {img.image}")
-        # get manifest list
-        headers = {"Accept": self.__LST_MTYPE}
-        manifest_resp = registry.get(img.url_manifests, headers=headers)
-        manifest = manifest_resp.json()
-
-        if not img.manifest_digest:
-            if manifest["mediaType"] in [self.__IMG_MANIFEST_FORMAT, self.__OCI_IMAGE_MANIFEST_FORMAT]:
-                self._pull_from_manifest(img, manifest)
-            elif manifest["mediaType"] in [self.__LST_MTYPE, self.__OCI_IMAGE_INDEX_FORMAT]:
-                self._pull_from_mainfest_list(img, manifest, platform)
-        else:
-            img_name_n = img.image.replace("/", "_")
-            img_tag_n = img.manifest_digest.replace(":", "_").replace(
-                "@", "_"
-            )
-            img_os, img_arch = image_platform(platform)
-            dir_name = f"{img_name_n}_{img_tag_n}_{img_os}_{img_arch}"
-
-            self._fetch_image(img, manifest["mediaType"], dir_name)
+    async def pull_many(
+        self, images: list[str], platform: str, parallel: int = 1
+    ) -> list[PullResult]:
+        images_slots = asyncio.Semaphore(max(parallel, 1))
 
-        print("Digest:", img.image_digest, "\n")
-
-    def _manifests(self, manifest_list: dict, platform: str) -> list:
-        img_os, img_arch = image_platform(platform)
-        manifests = manifest_list.get("manifests", [])
-        if manifest_list.get("schemaVersion") == 1:
-            raise ValueError("schema version 1 image manifest not supported")
+        async def pull(image: str) -> PullResult:
+            result = PullResult(image)
+            started = time.monotonic()
+            async with images_slots:
+                try:
+                    result.digest = await self.pull(image, platform)
+                except Exception as e:
+                    logging.error(f"Failed to pull {image}: {e}")
+                    result.error = e
+            result.elapsed = time.monotonic() - started
 
-        if not img_os and not img_arch:
-            return manifests
+            return result
 
-        out = []
-        for mfst in manifests:
-            plf = mfst["platform"]
+        try:
+            return await asyncio.gather(*[pull(image) for image in images])
+        finally:
+            await self._pool.close()
 
-            if img_os and img_arch:
-                if plf["os"] == img_os and plf["architecture"] == img_arch:
-                    out.append(mfst)
-                    break
-            else:
-                if plf["os"] == img_os or plf["architecture"] == img_arch:
-                    out.append(mfst)
+    async def pull(self, image: str, platform: str) -> str:
+        img = ImageParser(image)
+        registry = self._get_registry(img.registry)
 
-        return out
-    
-    def _pull_from_manifest(self, img: ImageParser, manifest: dict):
-        img_name_n = img.image.replace("/", "_")
-        img_tag_n = img.tag.replace(":", "_")
-        dir_name = f"{img_name_n}_{img_tag_n}"
+        print(f"{img.tag}: Pulling from {img.image}")
+        # get manifest list
+        manifest = await self._get_manifest(
+            registry, img, self._LST_MTYPE
+        )
 
-        self._fetch_image(img, manifest["mediaType"], dir_name)
+        for media_type, dir_name, digest in self._pull_targets(
+            img, manifest, platform
+        ):
+            if digest:
+                img.set_manifest_digest(digest)
 
+            self._drop_state(dir_name)
+            await self._fetch_image(img, media_type, dir_name)
 
-    def _pull_from_mainfest_list(self, img: ImageParser, manifest: dict, platform: str):
-        for mfst in self._manifests(manifest, platform):
-            img.set_manifest_digest(mfst["digest"])
-            img_name_n = img.image.replace("/", "_")
-            img_tag_n = img.tag.replace(":", "_")
-            plf = mfst["platform"]
-            arch = plf["architecture"]
-            dir_name = f"{img_name_n}_{img_tag_n}_{plf['os']}_{arch}"
+        print("Digest:", img.image_digest, "\n")
 
-            self._fetch_image(img, mfst["mediaType"], dir_name)
+        return img.image_digest
 
 
 if __name__ == "__main__":
@@ -998,20 +4794,163 @@ if __name__ == "__main__":
     parser.add_argument("images", nargs="+")
 
     parser.add_argument(
-        "--output", "-o", default="output", type=Path, help="Output dir"
+        "--output",
+        "-o",
+        default="output",
+        type=Path,
+        help="Output dir, - to write the image tar to stdout",
     )
     parser.add_argument(
         "--save-cache",
         action="store_true",
         help="Do not delete the temp folder",
     )
+    parser.add_argument(
+        "--format",
+        choices=["docker", "oci"],
+        default="docker",
+        help="Image tar format, oci keeps the layers compressed",
+    )
+    parser.add_argument(
+        "--keep-compressed",
+        action="store_true",
+        help="Save layers of the docker format as fetched, not extracted",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Show the blobs to download and their sizes, pull nothing",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip images whose tars in the output dir are up to date",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Take unchanged layers from the existing image tars",
+    )
+    parser.add_argument(
+        "--direct-tar",
+        action="store_true",
+        help="Write layers straight to the image tar, without the temp folder",
+    )
+    parser.add_argument(
+        "--no-stream-extract",
+        action="store_true",
+        help="Save layers to .gz before extracting them, slower",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Do not keep streamed layers to resume, half the scratch space",
+    )
+    parser.add_argument(
+        "--blob-cache",
+        type=Path,
+        help="Dir of the blob cache shared between images and runs",
+    )
+    parser.add_argument(
+        "--blob-cache-size",
+        type=parse_size,
+        default=0,
+        help="Max size of the blob cache (e.g. 20G), unlimited by default",
+    )
+    parser.add_argument(
+        "--token-cache",
+        type=Path,
+        help="File keeping registry tokens between runs",
+    )
+    parser.add_argument(
+        "--mirror",
+        type=parse_mirror,
+        action="append",
+        default=[],
+        metavar="REGISTRY=URL[,URL]",
+        help="Pull from the mirrors first, the registry is used on a miss",
+    )
     parser.add_argument("--registry", "-r", type=str, help="Registry")
     parser.add_argument("--user", "-u", type=str, help="Registry login")
     parser.add_argument(
         "--platform",
         type=str,
         default="linux/amd64",
-        help="Set platform for downloaded image",
+        help="Set platform for downloaded image, a comma list or all",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of layers downloaded in parallel",
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=1,
+        help="Number of range requests fetching a large blob at once",
+    )
+    parser.add_argument(
+        "--segment-threshold",
+        type=parse_size,
+        default="256M",
+        help="Min size of a blob fetched by range requests (default: 256M)",
+    )
+    parser.add_argument(
+        "--parallel-images",
+        type=int,
+        default=1,
+        help="Number of images pulled in parallel",
+    )
+    parser.add_argument(
+        "--max-transfers",
+        type=int,
+        default=0,
+        help="Limit of blob downloads in flight across all images",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        default=0,
+        help="Memory for the buffers of transfers (e.g. 64M), "
+        "unlimited by default",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=0,
+        help="Keep-alive connections per registry host (default: by --jobs)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="Max requests per second to a registry host",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=parse_size,
+        default=0,
+        help="Max download speed in bytes per second (e.g. 50M)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=4,
+        help="Retries of a failed request, with exponential backoff",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="Run transfers in threads or on one asyncio event loop",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=8,
+        help="Connections per registry host of the asyncio engine",
     )
 
     verbose_grp = parser.add_mutually_exclusive_group()
@@ -1032,6 +4971,51 @@ if __name__ == "__main__":
     )
     parsed_args = parser.parse_args()
 
+    _output = None
+    _work_dir = parsed_args.output
+    if str(parsed_args.output) == "-":
+        if len(parsed_args.images) > 1:
+            parser.error("only one image can be written to stdout")
+        if sys.stdout.isatty():
+            parser.error("refusing to write the image tar to a terminal")
+        if parsed_args.incremental or parsed_args.update:
+            parser.error("--incremental and --update need an output dir")
+        if parsed_args.platform == "all" or "," in parsed_args.platform:
+            parser.error("only one platform can be written to stdout")
+
+        _output = sys.stdout.buffer
+        # the tar takes stdout, messages go to stderr
+        sys.stdout = sys.stderr
+        _work_dir = Path(tempfile.mkdtemp(prefix="docker_pull-"))
+
+    _async = parsed_args.engine == "asyncio"
+    if _async and (
+        _output is not None
+        or parsed_args.direct_tar
+        or parsed_args.no_stream_extract
+        or parsed_args.segments > 1
+        or parsed_args.mirror
+        or parsed_args.incremental
+        or parsed_args.update
+        or parsed_args.plan
+        or parsed_args.format == "oci"
+        or parsed_args.keep_compressed
+        or parsed_args.max_memory
+    ):
+        parser.error(
+            "--engine asyncio does not support -o -, --direct-tar, "
+            "--no-stream-extract, --segments, --mirror, --incremental, "
+            "--update, --plan, --format oci, --keep-compressed "
+            "and --max-memory"
+        )
+
+    if parsed_args.update and (
+        parsed_args.format == "oci" or parsed_args.keep_compressed
+    ):
+        parser.error(
+            "--update does not support --format oci and --keep-compressed"
+        )
+
     if parsed_args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
@@ -1040,11 +5024,58 @@ if __name__ == "__main__":
     else:
         _progress = ProgressBar()
 
-    puller = ImageFetcher(
-        parsed_args.output,
-        progress=_progress,
-        save_cache=parsed_args.save_cache,
-    )
+    _blob_cache = None
+    if parsed_args.blob_cache:
+        _blob_cache = BlobCache(
+            parsed_args.blob_cache, parsed_args.blob_cache_size
+        )
+
+    _token_cache = TokenCache(parsed_args.token_cache)
+    _retry = RetryPolicy(attempts=max(parsed_args.retries, 0) + 1)
+    _throttle = Throttle(parsed_args.rate_limit, parsed_args.bandwidth)
+
+    _mirrors = {}
+    for _upstream, _urls in parsed_args.mirror:
+        _mirrors.setdefault(_upstream, []).extend(_urls)
+
+    if _async:
+        puller = AsyncImageFetcher(
+            _work_dir,
+            progress=_progress,
+            save_cache=parsed_args.save_cache,
+            jobs=parsed_args.jobs,
+            max_transfers=parsed_args.max_transfers,
+            blob_cache=_blob_cache,
+            max_connections=parsed_args.max_connections,
+            token_cache=_token_cache,
+            retry=_retry,
+            throttle=_throttle,
+        )
+    else:
+        puller = ImageFetcher(
+            _work_dir,
+            progress=_progress,
+            save_cache=parsed_args.save_cache,
+            jobs=parsed_args.jobs,
+            max_transfers=parsed_args.max_transfers,
+            blob_cache=_blob_cache,
+            stream_extract=not parsed_args.no_stream_extract,
+            direct_tar=parsed_args.direct_tar,
+            output=_output,
+            segments=parsed_args.segments,
+            segment_threshold=parsed_args.segment_threshold,
+            pool_size=parsed_args.pool_size,
+            token_cache=_token_cache,
+            mirrors=_mirrors,
+            retry=_retry,
+            throttle=_throttle,
+            incremental=parsed_args.incremental,
+            update=parsed_args.update,
+            oci=parsed_args.format == "oci",
+            keep_compressed=parsed_args.keep_compressed,
+            max_memory=parsed_args.max_memory,
+            resume=not parsed_args.no_resume,
+        )
 
     if parsed_args.user:
         _password = parsed_args.password
@@ -1061,5 +5092,43 @@ if __name__ == "__main__":
             _password,
         )
 
-    for _image in parsed_args.images:
-        puller.pull(_image, parsed_args.platform)
+    if parsed_args.plan:
+        plan = puller.plan(
+            parsed_args.images,
+            parsed_args.platform,
+            parsed_args.parallel_images,
+        )
+        print(plan.summary())
+        sys.exit(0)
+
+    _results = puller.pull_many(
+        parsed_args.images,
+        parsed_args.platform,
+        parallel=parsed_args.parallel_images,
+    )
+    if _async:
+        _results = asyncio.run(_results)
+
+    if _output is not None:
+        _output.flush()
+        shutil.rmtree(_work_dir, ignore_errors=True)
+
+    if len(_results) > 1:
+        print("Summary:")
+        for _res in _results:
+            _status = _res.digest if _res.ok else f"FAILED ({_res.error})"
+            print(f"  {_res.image}: {_status} [{_res.elapsed:.1f}s]")
+
+    if parsed_args.max_memory:
+        logging.debug(
+            "Peak memory of buffers: %s", sizeof_fmt(puller.memory.peak)
+        )
+
+    if _retry.retries:
+        print(
+            f"Retried {_retry.retries} requests, "
+            f"{_retry.backoff_time:.1f}s in backoff"
+        )
+
+    if not all(_res.ok for _res in _results):
+        sys.exit(1)
@@ -0,0 +1,325 @@
+"""A registry serving images from memory, a stand-in for the tests"""
+
+import gzip
+import hashlib
+import io
+import json
+import re
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+MANIFEST_LIST = "application/vnd.docker.distribution.manifest.list.v2+json"
+CONFIG = "application/vnd.docker.container.image.v1+json"
+LAYER = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+
+CHUNK_SIZE = 1000
+
+
+def sha256(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def layer_tar(files: dict[str, bytes]) -> bytes:
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w", format=tarfile.USTAR_FORMAT) as t:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1600000000
+            t.addfile(info, io.BytesIO(data))
+
+    return out.getvalue()
+
+
+class StandInRegistry:
+    """Registry v2 API on 127.0.0.1
+
+    auth: requests without a bearer token get 401, tokens come from /token
+    chunked: bodies are sent with the chunked transfer encoding
+    redirect: base url the blob requests are redirected to, blobs are also
+        served unauthenticated under /storage/<digest>
+    delay: seconds every manifest request takes
+    ranges: Range headers are served, else the whole blob is sent
+
+    Blobs are served with Range support. corrupt counts the responses of
+    a blob digest still to be sent with a byte flipped, drop the ones cut
+    off halfway by closing the connection.
+    """
+
+    def __init__(
+        self,
+        *,
+        auth: bool = False,
+        chunked: bool = False,
+        redirect: str = None,
+        delay: float = 0,
+        ranges: bool = True,
+    ):
+        self.auth = auth
+        self.chunked = chunked
+        self.redirect = redirect
+        self.delay = delay
+        self.ranges = ranges
+        # most manifest requests served at once
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.blobs: dict[str, bytes] = {}
+        self.manifests: dict[tuple[str, str], tuple[str, bytes]] = {}
+        self.corrupt: dict[str, int] = {}
+        self.drop: dict[str, int] = {}
+        # method, path and headers of every request
+        self.requests: list[tuple[str, str, dict]] = []
+        self.connections = 0
+        self.tokens = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def host(self) -> str:
+        return "127.0.0.1:%d" % self._server.server_port
+
+    def __enter__(self):
+        serve = threading.Thread(target=self._server.serve_forever)
+        serve.daemon = True
+        serve.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_blob(self, data: bytes) -> str:
+        digest = sha256(data)
+        self.blobs[digest] = data
+
+        return digest
+
+    def add_image(
+        self,
+        repo: str,
+        tag: str,
+        layers: list[dict[str, bytes]],
+        architecture: str = "amd64",
+        variant: str = None,
+    ) -> tuple[str, int]:
+        """Manifest digest and size of an image of layers of files"""
+
+        diff_ids = []
+        manifest_layers = []
+        for files in layers:
+            tar = layer_tar(files)
+            blob = gzip.compress(tar, mtime=0)
+            diff_ids.append(sha256(tar))
+            manifest_layers.append(
+                {
+                    "mediaType": LAYER,
+                    "size": len(blob),
+                    "digest": self.add_blob(blob),
+                }
+            )
+
+        config = {
+            "architecture": architecture,
+            "config": {"Env": ["PATH=/bin", "A=<&>"], "Cmd": ["/bin/sh"]},
+            "created": "2024-01-02T03:04:05.123456789Z",
+            "history": [{"created_by": "ADD <files> && true"}] * len(layers),
+            "os": "linux",
+            "rootfs": {"type": "layers", "diff_ids": diff_ids},
+        }
+        if variant:
+            config["variant"] = variant
+        # escaped as Go does, the v1 layer ids keep the escapes
+        config_data = json.dumps(config)
+        for char in "&<>":
+            config_data = config_data.replace(char, "\\u%04x" % ord(char))
+        config_data = config_data.encode()
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": MANIFEST_V2,
+            "config": {
+                "mediaType": CONFIG,
+                "size": len(config_data),
+                "digest": self.add_blob(config_data),
+            },
+            "layers": manifest_layers,
+        }
+
+        data = json.dumps(manifest).encode()
+        digest = sha256(data)
+        self.manifests[(repo, digest)] = (MANIFEST_V2, data)
+        self.manifests[(repo, tag)] = (MANIFEST_V2, data)
+
+        return digest, len(data)
+
+    def add_index(self, repo: str, tag: str, platforms: dict[str, list]):
+        """An index of images by platform, e.g. linux/arm/v7"""
+
+        manifests = []
+        for name, layers in platforms.items():
+            _, architecture, *variant = name.split("/")
+            variant = variant[0] if variant else None
+            digest, size = self.add_image(
+                repo, f"{tag}-{name}", layers, architecture, variant
+            )
+            platform = {"architecture": architecture, "os": "linux"}
+            if variant:
+                platform["variant"] = variant
+            manifests.append(
+                {
+                    "mediaType": MANIFEST_V2,
+                    "size": size,
+                    "digest": digest,
+                    "platform": platform,
+                }
+            )
+
+        index = {
+            "schemaVersion": 2,
+            "mediaType": MANIFEST_LIST,
+            "manifests": manifests,
+        }
+        data = json.dumps(index).encode()
+        self.manifests[(repo, sha256(data))] = (MANIFEST_LIST, data)
+        self.manifests[(repo, tag)] = (MANIFEST_LIST, data)
+
+    def _handler(self):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                registry.connections += 1
+                super().setup()
+
+            def send(self, code: int, body: bytes = b"", headers=None):
+                self.send_response(code)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+
+                if not registry.chunked or self.command == "HEAD":
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    if self.command != "HEAD":
+                        self.wfile.write(body)
+
+                    return
+
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i in range(0, len(body), CHUNK_SIZE):
+                    chunk = body[i : i + CHUNK_SIZE]
+                    size = b"%x;ext=1" % len(chunk)
+                    self.wfile.write(size + b"\r\n" + chunk + b"\r\n")
+                self.wfile.write(b"0\r\nX-Trailer: 1\r\n\r\n")
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                registry.requests.append(
+                    (self.command, self.path, dict(self.headers))
+                )
+
+                if self.path.startswith("/token"):
+                    registry.tokens += 1
+                    token = {"token": "token%d" % registry.tokens}
+                    return self.send(200, json.dumps(token).encode())
+
+                m = re.match(r"/storage/(.+)$", self.path)
+                if m and m.group(1) in registry.blobs:
+                    return self.send_blob(m.group(1))
+
+                m = re.match(r"/v2/(.+)/(manifests|blobs)/(.+)$", self.path)
+                if not m:
+                    return self.send(404, b"{}")
+
+                repo, kind, ref = m.groups()
+                authorization = self.headers.get("Authorization", "")
+                if registry.auth and not authorization.startswith("Bearer "):
+                    challenge = (
+                        f'Bearer realm="http://{registry.host}/token",'
+                        f'service="stand-in",scope="repository:{repo}:pull"'
+                    )
+                    return self.send(
+                        401, b"{}", {"WWW-Authenticate": challenge}
+                    )
+
+                if kind == "manifests":
+                    with registry._lock:
+                        registry._in_flight += 1
+                        registry.max_in_flight = max(
+                            registry.max_in_flight, registry._in_flight
+                        )
+                    time.sleep(registry.delay)
+                    with registry._lock:
+                        registry._in_flight -= 1
+
+                    if (repo, ref) not in registry.manifests:
+                        return self.send(404, b"{}")
+
+                    media_type, data = registry.manifests[(repo, ref)]
+                    headers = {
+                        "Content-Type": media_type,
+                        "Docker-Content-Digest": sha256(data),
+                    }
+                    return self.send(200, data, headers)
+
+                if ref not in registry.blobs:
+                    return self.send(404, b"{}")
+
+                if registry.redirect:
+                    location = f"{registry.redirect}/storage/{ref}"
+                    return self.send(307, b"", {"Location": location})
+
+                return self.send_blob(ref)
+
+            def send_blob(self, digest: str):
+                data = registry.blobs[digest]
+                get = self.command == "GET"
+                if get and registry.corrupt.get(digest):
+                    registry.corrupt[digest] -= 1
+                    i = len(data) // 2
+                    data = data[:i] + bytes([data[i] ^ 0xFF]) + data[i + 1 :]
+
+                code = 200
+                headers = {}
+                rng = self.headers.get("Range", "") if registry.ranges else ""
+                m = re.match(r"bytes=(\d+)-(\d*)$", rng)
+                if m:
+                    start = int(m.group(1))
+                    end = min(int(m.group(2) or len(data) - 1), len(data) - 1)
+                    if start >= len(data):
+                        headers = {"Content-Range": f"bytes */{len(data)}"}
+                        return self.send(416, b"", headers)
+
+                    code = 206
+                    headers = {
+                        "Content-Range": f"bytes {start}-{end}/{len(data)}"
+                    }
+                    data = data[start : end + 1]
+
+                if get and registry.drop.get(digest):
+                    registry.drop[digest] -= 1
+                    return self.send_dropped(code, data, headers)
+
+                return self.send(code, data, headers)
+
+            def send_dropped(self, code: int, body: bytes, headers: dict):
+                self.send_response(code)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[: len(body) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
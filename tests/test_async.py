@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import time
+
+import pytest
+
+import docker_pull
+from registry import StandInRegistry
+
+LAYERS = [
+    {"etc/os-release": b"NAME=stand-in\n"},
+    {"usr/lib/big": bytes(range(256)) * 4000},
+    {"app/run": b"#!/bin/sh\n"},
+]
+
+
+async def get_all(registry: docker_pull.AsyncRegistry, urls: list[str]):
+    bodies = []
+    for url in urls:
+        r = await registry.get(url, stream=True)
+        bodies.append(b"".join([c async for c in r.iter_content(4096)]))
+
+    return bodies
+
+
+def async_registry(**kwargs) -> docker_pull.AsyncRegistry:
+    pool = docker_pull.AsyncConnectionPool(2)
+    return docker_pull.AsyncRegistry(pool, ssl=False, **kwargs)
+
+
+def test_chunked_keep_alive():
+    with StandInRegistry(chunked=True) as reg:
+        digests = [reg.add_blob(bytes([i]) * 5000 + b"end") for i in range(3)]
+        urls = [f"{reg.host}/v2/lib/img/blobs/{d}" for d in digests]
+
+        bodies = asyncio.run(get_all(async_registry(), urls))
+
+        assert bodies == [reg.blobs[d] for d in digests]
+        # every body was read to its end, so one connection did it all
+        assert reg.connections == 1
+
+
+def test_token_flow():
+    with StandInRegistry(auth=True) as reg:
+        digest = reg.add_blob(b"blob")
+        url = f"{reg.host}/v2/lib/img/blobs/{digest}"
+
+        bodies = asyncio.run(get_all(async_registry(), [url, url]))
+
+        assert bodies == [b"blob", b"blob"]
+        # the token of the first 401 is used for the next request
+        assert reg.tokens == 1
+        blob_path = f"/v2/lib/img/blobs/{digest}"
+        paths = [r[1].split("?")[0] for r in reg.requests]
+        assert paths == [blob_path, "/token", blob_path, blob_path]
+        assert reg.requests[-1][2]["Authorization"] == "Bearer token1"
+
+
+def test_redirect_drops_credentials():
+    with StandInRegistry() as storage:
+        with StandInRegistry(
+            auth=True, redirect=f"http://{storage.host}"
+        ) as reg:
+            digest = reg.add_blob(b"stored blob")
+            storage.blobs = reg.blobs
+            url = f"{reg.host}/v2/lib/img/blobs/{digest}"
+
+            bodies = asyncio.run(get_all(async_registry(), [url]))
+
+            assert bodies == [b"stored blob"]
+            assert [r[1] for r in storage.requests] == [f"/storage/{digest}"]
+            assert "Authorization" not in storage.requests[0][2]
+
+
+def tar_hashes(path) -> dict[str, str]:
+    return {
+        p.name: hashlib.sha256(p.read_bytes()).hexdigest()
+        for p in path.glob("*.tar")
+    }
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+@pytest.mark.parametrize("max_transfers", [0, 2])
+def test_pull_matches_threads(tmp_path, chunked, max_transfers):
+    with StandInRegistry(auth=True, chunked=chunked) as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        reg.add_image("lib/img", "2.0", LAYERS[:2])
+        images = [f"{reg.host}/lib/img:1.0", f"{reg.host}/lib/img:2.0"]
+
+        fetcher = docker_pull.ImageFetcher(tmp_path / "threads")
+        fetcher.set_registry(reg.host, ssl=False)
+        for image in images:
+            fetcher.pull(image, "linux/amd64")
+
+        # pull is awaited directly, each image on its own event loop
+        fetcher = docker_pull.AsyncImageFetcher(
+            tmp_path / "async", jobs=3, max_transfers=max_transfers
+        )
+        fetcher.set_registry(reg.host, ssl=False)
+        for image in images:
+            asyncio.run(fetcher.pull(image, "linux/amd64"))
+
+        expected = tar_hashes(tmp_path / "threads")
+        assert len(expected) == 2
+        assert tar_hashes(tmp_path / "async") == expected
+
+
+def test_fetch_blob_leaves_loop_free(tmp_path, monkeypatch):
+    class SlowDecompressor(docker_pull.NullDecompressor):
+        def decompress(self, data: bytes, chunk_size: int = 131072):
+            time.sleep(0.2)
+            yield data
+
+    def slow(media_type: str = None):
+        return SlowDecompressor()
+
+    monkeypatch.setattr(docker_pull, "layer_decompressor", slow)
+
+    async def fetch_and_tick(url: str) -> float:
+        fetch = asyncio.create_task(
+            async_registry().fetch_blob(url, tmp_path / "layer.tar")
+        )
+        longest = 0.0
+        while not fetch.done():
+            started = time.monotonic()
+            await asyncio.sleep(0.01)
+            longest = max(longest, time.monotonic() - started)
+
+        await fetch
+        return longest
+
+    with StandInRegistry() as reg:
+        data = bytes(range(256)) * 1024
+        digest = reg.add_blob(data)
+        url = f"{reg.host}/v2/lib/img/blobs/{digest}"
+
+        longest = asyncio.run(fetch_and_tick(url))
+
+        assert (tmp_path / "layer.tar").read_bytes() == data
+        # a chunk takes 200ms to inflate, the loop was never held that long
+        assert longest < 0.1
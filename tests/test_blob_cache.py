@@ -0,0 +1,56 @@
+import concurrent.futures
+import hashlib
+import os
+from pathlib import Path
+
+import docker_pull
+
+BLOB = bytes(range(256)) * 8192
+DIGEST = "sha256:" + hashlib.sha256(BLOB).hexdigest()
+
+
+def put_many(cache_dir: Path, n: int):
+    cache = docker_pull.BlobCache(cache_dir)
+    for _ in range(n):
+        cache.put_bytes(DIGEST, BLOB)
+
+    src = cache_dir / f"src{os.getpid()}"
+    src.write_bytes(BLOB)
+    for _ in range(n):
+        cache.put(DIGEST, src)
+
+
+def test_processes_share_the_cache(tmp_path):
+    # the main threads of the processes may have the same thread ident
+    with concurrent.futures.ProcessPoolExecutor(4) as pool:
+        dirs = [tmp_path] * 4
+        list(pool.map(put_many, dirs, [100] * 4))
+
+    cache = docker_pull.BlobCache(tmp_path)
+    assert cache.read(DIGEST) == BLOB
+    assert not list(tmp_path.glob("sha256/.*"))
+
+
+def test_temp_paths_are_unique(tmp_path):
+    cache = docker_pull.BlobCache(tmp_path)
+    paths = {cache.temp_path(DIGEST) for _ in range(100)}
+
+    assert len(paths) == 100
+    assert all(p.exists() and p.name.startswith(".") for p in paths)
+
+
+def test_evict_skips_vanished_blobs(tmp_path, monkeypatch):
+    glob = Path.glob
+
+    def racing_glob(self, pattern):
+        yield from glob(self, pattern)
+        # evicted by another process in the meantime
+        yield self / "sha256" / ("0" * 64)
+
+    monkeypatch.setattr(Path, "glob", racing_glob)
+    cache = docker_pull.BlobCache(tmp_path, max_size=len(BLOB))
+    cache.put_bytes(DIGEST, BLOB)
+    cache.put_bytes("sha256:" + hashlib.sha256(b"new").hexdigest(), b"new")
+
+    assert cache.get(DIGEST) is None
+    assert cache.read("sha256:" + hashlib.sha256(b"new").hexdigest())
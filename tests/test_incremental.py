@@ -0,0 +1,39 @@
+import hashlib
+
+import docker_pull
+from registry import StandInRegistry
+
+LAYERS_X = [{"etc/version": b"x\n"}]
+LAYERS_Y = [{"etc/version": b"y\n"}]
+
+
+def pull(reg: StandInRegistry, out, incremental: bool) -> str:
+    fetcher = docker_pull.ImageFetcher(out, incremental=incremental)
+    fetcher.set_registry(reg.host, ssl=False)
+    [result] = fetcher.pull_many([f"{reg.host}/lib/img:1.0"], "linux/amd64")
+    assert result.ok
+
+    tar = out / "lib_img_1.0.tar"
+    return hashlib.sha256(tar.read_bytes()).hexdigest()
+
+
+def test_plain_pull_drops_the_sidecar(tmp_path):
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS_X)
+        tag_x = reg.manifests[("lib/img", "1.0")]
+        tar_x = pull(reg, tmp_path, incremental=True)
+
+        reg.add_image("lib/img", "1.0", LAYERS_Y)
+        tar_y = pull(reg, tmp_path, incremental=False)
+        assert tar_y != tar_x
+        assert not (tmp_path / "lib_img_1.0.tar.json").exists()
+
+        # the tag is rolled back, the tar of Y is not taken for X
+        reg.manifests[("lib/img", "1.0")] = tag_x
+        assert pull(reg, tmp_path, incremental=True) == tar_x
+        assert (tmp_path / "lib_img_1.0.tar.json").exists()
+
+        # now it is up to date, the manifest is not even fetched
+        requests = len(reg.requests)
+        assert pull(reg, tmp_path, incremental=True) == tar_x
+        assert [r[0] for r in reg.requests[requests:]] == ["HEAD"]
@@ -0,0 +1,86 @@
+import json
+import random
+
+import pytest
+
+import docker_pull
+
+DOCUMENTS = [
+    r'{"a":"b"}',
+    r'"<&>"',
+    r'["\\u0041", "\\A", "\\\\u0041", "\\"]',
+    r'{"k":"\"\n\u000a\t\/"}',
+    r'"😀 \ud800 éé"',
+    r'{"a\\":1,"u":2}',
+    r'{"a\\":1,"uA":2}',
+    r'{"k":"v","k":[{"é":null}]}',
+    r'"\u12zz"',
+    # the quote is taken as one of the 4 chars of the escape
+    r'"\u12"x"',
+    r'"\\A\\u"',
+    '{"é☃":"é☃\\u2603","n":[1,2.5e3,-0,true,false,null]}',
+    "[]",
+    '""',
+]
+MALFORMED = [r'"\u12"', r'["\u"]', r'"\x"', r'{"a":"\u00']
+
+
+def reference(s):
+    if isinstance(s, bytes):
+        s = s.decode(json.detect_encoding(s), "surrogatepass")
+
+    return json.loads(s, cls=docker_pull.JSONDecoderRawString)
+
+
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_matches_raw_string_decoder(document):
+    assert docker_pull.json_loads_raw(document) == reference(document)
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "utf-16", "utf-32-be"])
+def test_bytes(encoding):
+    for document in DOCUMENTS:
+        data = document.encode(encoding)
+        assert docker_pull.json_loads_raw(data) == reference(data)
+
+
+@pytest.mark.parametrize("document", MALFORMED)
+def test_malformed(document):
+    with pytest.raises(json.JSONDecodeError):
+        reference(document)
+    with pytest.raises(json.JSONDecodeError):
+        docker_pull.json_loads_raw(document)
+
+
+def random_string(rnd: random.Random) -> str:
+    pieces = ["\\", "u", "\\u", '"', "<", "&", "é", "☃", "😀", "a", "0"]
+    return "".join(rnd.choices(pieces, k=rnd.randrange(8)))
+
+
+def random_value(rnd: random.Random, depth: int = 0):
+    kind = rnd.randrange(4 if depth < 3 else 2)
+    if kind == 0:
+        return random_string(rnd)
+    if kind == 1:
+        return rnd.choice([1, -2.5, True, None])
+    if kind == 2:
+        return [random_value(rnd, depth + 1) for _ in range(rnd.randrange(4))]
+
+    return {
+        random_string(rnd): random_value(rnd, depth + 1)
+        for _ in range(rnd.randrange(4))
+    }
+
+
+def test_fuzz():
+    rnd = random.Random(1)
+    for _ in range(3000):
+        document = json.dumps(
+            random_value(rnd), ensure_ascii=rnd.random() < 0.5
+        )
+        if rnd.random() < 0.5:
+            # escaped as Go does
+            for char in "<&>":
+                document = document.replace(char, "\\u%04x" % ord(char))
+
+        assert docker_pull.json_loads_raw(document) == reference(document)
@@ -0,0 +1,120 @@
+import copy
+import hashlib
+
+import pytest
+
+import docker_pull
+from docker_pull import ContainerConfig, LayerConfig
+
+CONFIGS = {
+    "plain": b'{"architecture":"amd64","os":"linux","config":{"Cmd":["sh"]}}',
+    # escaped as Go does, the escapes are hashed as they are
+    "escapes": (
+        b'{"architecture":"arm","variant":"v7","os":"linux",'
+        b'"config":{"Env":["A=\\u003c\\u0026\\u003e","B=\\u00e9\\\\u"],'
+        b'"Labels":{"k\\u00e9y":"\\u2603 \\ud83d\\ude00"}},'
+        b'"created":"2024-01-02T03:04:05.123456789Z","id":"dropped",'
+        b'"container_config":{"Cmd":["/bin/sh","-c","a \\u0026\\u0026 b"]}}'
+    ),
+}
+
+
+# the recursive versions layer ids were first worked out with
+def reference_chain_ids(ids_list: list) -> list[str]:
+    chain = list()
+    chain.append(ids_list[0])
+
+    if len(ids_list) < 2:
+        return ids_list
+
+    nxt = list()
+    chain_b = f"{ids_list[0]} {ids_list[1]}".encode()
+    nxt.append("sha256:" + hashlib.sha256(chain_b).hexdigest())
+    nxt.extend(ids_list[2:])
+
+    chain.extend(reference_chain_ids(nxt))
+
+    return chain
+
+
+def reference_layer_ids_list(chain_ids_list: list, config_image: dict):
+    config_image.pop("id", "")
+
+    chan_ids = []
+    parent = None
+    for chain_id in chain_ids_list:
+        config = LayerConfig(layer_id=chain_id, parent=parent)
+
+        config.container_config = ContainerConfig()
+        if chain_id == chain_ids_list[-1]:
+            config.config = ContainerConfig()
+            config.deepcopy(config_image)
+
+        parent = "sha256:" + hashlib.sha256(config.json.encode()).hexdigest()
+        chan_ids.append(parent)
+
+    return chan_ids
+
+
+def diff_ids(n: int) -> list[str]:
+    return [
+        "sha256:" + hashlib.sha256(b"layer %d" % i).hexdigest()
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("layers", [1, 2, 3, 17, 200])
+def test_chain_ids(layers):
+    ids = diff_ids(layers)
+
+    assert docker_pull.chain_ids(ids) == reference_chain_ids(ids)
+
+
+def test_no_layers():
+    assert docker_pull.chain_ids([]) == []
+    config = docker_pull.json_loads_raw(CONFIGS["plain"])
+
+    assert docker_pull.layer_ids_list([], config) == []
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+@pytest.mark.parametrize("layers", [1, 2, 3, 17])
+def test_layer_ids_list(config, layers):
+    chain = reference_chain_ids(diff_ids(layers))
+    config_image = docker_pull.json_loads_raw(CONFIGS[config])
+    expected = reference_layer_ids_list(chain, copy.deepcopy(config_image))
+
+    assert docker_pull.layer_ids_list(chain, config_image) == expected
+    assert "id" not in config_image
+
+
+@pytest.mark.parametrize(
+    "chain_id", ['a"b', "a\\b", "a\\u00e9", "é☃", "a\nb"]
+)
+def test_layer_ids_list_quotes_ids(chain_id):
+    chain = [chain_id + "1", chain_id + "2", chain_id + "3"]
+    config_image = docker_pull.json_loads_raw(CONFIGS["escapes"])
+    expected = reference_layer_ids_list(chain, copy.deepcopy(config_image))
+
+    assert docker_pull.layer_ids_list(chain, config_image) == expected
+
+
+def test_cache():
+    ids = diff_ids(3)
+    cache = docker_pull.LayerIdsCache(size=1)
+    expected = reference_layer_ids_list(
+        reference_chain_ids(ids),
+        docker_pull.json_loads_raw(CONFIGS["escapes"]),
+    )
+
+    for _ in range(2):
+        config_image = docker_pull.json_loads_raw(CONFIGS["escapes"])
+        layer_ids = cache.get(ids, "sha256:config", config_image)
+        assert layer_ids == expected
+        assert "id" not in config_image
+        # the cached list is not the one handed out
+        layer_ids.clear()
+
+    other = docker_pull.json_loads_raw(CONFIGS["plain"])
+    cache.get(ids, "sha256:other", other)
+    assert list(cache._ids) == [(tuple(ids), "sha256:other")]
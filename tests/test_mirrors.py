@@ -0,0 +1,68 @@
+import hashlib
+import json
+import random
+
+import pytest
+
+import docker_pull
+from registry import StandInRegistry
+
+# half of it is more than a chunk, the dropped transfers leave some
+BIG = random.Random(1).randbytes(600000)
+LAYERS = [{"etc/os-release": b"NAME=stand-in\n"}, {"usr/lib/big": BIG}]
+IMAGE = "lib_img_1.0.tar"
+
+
+def tar_hash(path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def pull(reg: StandInRegistry, out, **kwargs) -> docker_pull.PullResult:
+    fetcher = docker_pull.ImageFetcher(out, **kwargs)
+    fetcher.set_registry(reg.host, ssl=False)
+    [result] = fetcher.pull_many([f"{reg.host}/lib/img:1.0"], "linux/amd64")
+
+    return result
+
+
+@pytest.mark.parametrize("fault", ["corrupt", "drop"])
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"stream_extract": False},
+        {"stream_extract": False, "segments": 3, "segment_threshold": 1},
+        {"blob_cache": True},
+    ],
+)
+def test_failover_from_broken_mirror(tmp_path, fault, kwargs):
+    with StandInRegistry() as reg, StandInRegistry() as mirror:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        mirror.blobs = reg.blobs
+        mirror.manifests = reg.manifests
+        _, manifest = reg.manifests[("lib/img", "1.0")]
+        digest = json.loads(manifest)["layers"][1]["digest"]
+        getattr(mirror, fault)[digest] = 100
+
+        if kwargs.get("blob_cache"):
+            kwargs["blob_cache"] = docker_pull.BlobCache(tmp_path / "cache")
+        result = pull(
+            reg,
+            tmp_path / "out",
+            mirrors={reg.host: [f"http://{mirror.host}"]},
+            retry=docker_pull.RetryPolicy(attempts=1),
+            **kwargs,
+        )
+
+        assert result.ok
+        blob_path = f"/v2/lib/img/blobs/{digest}"
+        assert blob_path in [r[1] for r in mirror.requests]
+        if "segments" not in kwargs:
+            # the upstream sends the whole blob, not the rest of the mirror's
+            [upstream] = [r for r in reg.requests if r[1] == blob_path]
+            assert "Range" not in upstream[2]
+
+        assert pull(reg, tmp_path / "clean").ok
+
+    out_tar = tmp_path / "out" / IMAGE
+    assert tar_hash(out_tar) == tar_hash(tmp_path / "clean" / IMAGE)
@@ -0,0 +1,71 @@
+import json
+import time
+
+import docker_pull
+from registry import StandInRegistry
+
+BASE = {"etc/os-release": b"NAME=stand-in\n"}
+IMAGES = {
+    "a": [BASE, {"app/a": b"a"}],
+    "b": [BASE, {"app/b": b"b"}],
+    "c": [{"app/c": b"c"}],
+}
+
+
+def layer_digests(reg: StandInRegistry, name: str) -> set[str]:
+    _, manifest = reg.manifests[(f"lib/{name}", "1.0")]
+    return {layer["digest"] for layer in json.loads(manifest)["layers"]}
+
+
+def test_plan_resolves_in_parallel(tmp_path):
+    with StandInRegistry(delay=0.2) as reg:
+        for name, layers in IMAGES.items():
+            reg.add_image(f"lib/{name}", "1.0", layers)
+        images = [f"{reg.host}/lib/{name}:1.0" for name in IMAGES]
+
+        fetcher = docker_pull.ImageFetcher(tmp_path)
+        fetcher.set_registry(reg.host, ssl=False)
+        started = time.monotonic()
+        plan = fetcher.plan(images, "linux/amd64", parallel=3)
+
+        assert reg.max_in_flight == 3
+        assert time.monotonic() - started < 0.6
+        # merged in the order of the images
+        assert [p.image for p in plan.images] == images
+        # the configs and four layers, the base one shared
+        assert len(plan.blobs) == 3 + 4
+        shared = [b for b in plan.blobs.values() if len(b.consumers) > 1]
+        assert len(shared) == 1
+
+
+def test_planned_blobs_are_freed_once_built(tmp_path, monkeypatch):
+    cached = []
+    make_tar = docker_pull.make_tar
+
+    def record(out_path, path, created):
+        # the blobs in the temporary cache as each tar is built
+        [cache] = tmp_path.glob(".blobs-*")
+        cached.append({"sha256:" + p.name for p in cache.rglob("*")})
+        make_tar(out_path, path, created)
+
+    monkeypatch.setattr(docker_pull, "make_tar", record)
+
+    with StandInRegistry() as reg:
+        for name, layers in IMAGES.items():
+            reg.add_image(f"lib/{name}", "1.0", layers)
+        images = [f"{reg.host}/lib/{name}:1.0" for name in IMAGES]
+
+        fetcher = docker_pull.ImageFetcher(tmp_path, direct_tar=False)
+        fetcher.set_registry(reg.host, ssl=False)
+        results = fetcher.pull_many(images, "linux/amd64")
+        layers_a, layers_b = layer_digests(reg, "a"), layer_digests(reg, "b")
+
+    assert all(r.ok for r in results)
+    assert len(list(tmp_path.glob("*.tar"))) == 3
+    assert not list(tmp_path.glob(".blobs-*"))
+    # the layer only a needs is gone once a is built, the shared one
+    # once b is, so c is built with neither left
+    assert len(cached) == 3
+    assert cached[0] >= layers_a
+    assert not cached[1] & (layers_a - layers_b)
+    assert not cached[2] & (layers_a | layers_b)
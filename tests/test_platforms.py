@@ -0,0 +1,61 @@
+import json
+
+import docker_pull
+from registry import StandInRegistry
+
+PLATFORMS = {
+    "linux/amd64": [{"app": b"amd64"}],
+    "linux/arm/v6": [{"app": b"arm v6"}],
+    "linux/arm/v7": [{"app": b"arm v7"}],
+    "linux/arm64/v8": [{"app": b"arm64"}],
+}
+
+
+def pull(reg: StandInRegistry, out, platform: str, **kwargs):
+    fetcher = docker_pull.ImageFetcher(out, **kwargs)
+    fetcher.set_registry(reg.host, ssl=False)
+    [result] = fetcher.pull_many([f"{reg.host}/lib/img:1.0"], platform)
+
+    return result
+
+
+def test_variants_get_own_tars(tmp_path):
+    with StandInRegistry() as reg:
+        reg.add_index("lib/img", "1.0", PLATFORMS)
+
+        assert pull(reg, tmp_path, "all").ok
+
+        assert sorted(p.name for p in tmp_path.glob("*.tar")) == [
+            "lib_img_1.0_linux_amd64.tar",
+            "lib_img_1.0_linux_arm64_v8.tar",
+            "lib_img_1.0_linux_arm_v6.tar",
+            "lib_img_1.0_linux_arm_v7.tar",
+        ]
+
+
+def test_duplicate_platforms_are_refused(tmp_path):
+    with StandInRegistry() as reg:
+        reg.add_index("lib/img", "1.0", PLATFORMS)
+        media_type, data = reg.manifests[("lib/img", "1.0")]
+        index = json.loads(data)
+        index["manifests"].append(index["manifests"][1])
+        data = json.dumps(index).encode()
+        reg.manifests[("lib/img", "1.0")] = (media_type, data)
+
+        result = pull(reg, tmp_path, "all")
+
+        assert not result.ok
+        assert "lib_img_1.0_linux_arm_v6" in str(result.error)
+        assert not list(tmp_path.glob("*.tar"))
+
+
+def test_incremental_finds_variant_tar(tmp_path):
+    with StandInRegistry() as reg:
+        reg.add_index("lib/img", "1.0", PLATFORMS)
+
+        assert pull(reg, tmp_path, "linux/arm64", incremental=True).ok
+        assert (tmp_path / "lib_img_1.0_linux_arm64_v8.tar").exists()
+
+        requests = len(reg.requests)
+        assert pull(reg, tmp_path, "linux/arm64", incremental=True).ok
+        assert [r[0] for r in reg.requests[requests:]] == ["HEAD"]
@@ -0,0 +1,122 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import random
+
+import pytest
+
+import docker_pull
+from registry import StandInRegistry
+
+BIG = random.Random(1).randbytes(300000)
+LAYERS = [{"etc/os-release": b"NAME=stand-in\n"}, {"usr/lib/big": BIG}]
+
+
+def tar_hash(path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def pull(reg: StandInRegistry, out, **kwargs) -> docker_pull.PullResult:
+    fetcher = docker_pull.ImageFetcher(out, **kwargs)
+    fetcher.set_registry(reg.host, ssl=False)
+    [result] = fetcher.pull_many([f"{reg.host}/lib/img:1.0"], "linux/amd64")
+
+    return result
+
+
+def big_layer(reg: StandInRegistry) -> tuple[str, bytes]:
+    """Digest of the blob of the big layer and its tar"""
+
+    _, manifest = reg.manifests[("lib/img", "1.0")]
+    digest = json.loads(manifest)["layers"][1]["digest"]
+
+    return digest, gzip.decompress(reg.blobs[digest])
+
+
+def corrupt(data: bytes) -> bytes:
+    i = len(data) // 2
+    return data[:i] + bytes([data[i] ^ 0xFF]) + data[i + 1 :]
+
+
+@pytest.mark.parametrize("stream_extract", [True, False])
+def test_corrupt_response_then_rerun(tmp_path, stream_extract):
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        assert pull(reg, tmp_path / "clean").ok
+        digest, _ = big_layer(reg)
+
+        reg.corrupt[digest] = 1
+        out = tmp_path / "out"
+        assert not pull(reg, out, stream_extract=stream_extract).ok
+        assert not list(out.rglob("*.gz")) and not list(out.rglob("*.sha256"))
+
+        assert pull(reg, out, stream_extract=stream_extract).ok
+
+    tar = "lib_img_1.0.tar"
+    assert tar_hash(out / tar) == tar_hash(tmp_path / "clean" / tar)
+
+
+@pytest.mark.parametrize("size", [0, 1])
+@pytest.mark.parametrize("left", [1.0, 0.75])
+def test_corrupt_partial_blob(tmp_path, size, left):
+    """A .gz left by a run that was killed is verified as it is resumed"""
+
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        digest, tar = big_layer(reg)
+        blob = reg.blobs[digest]
+
+        out_file = tmp_path / "layer.tar"
+        partial = corrupt(blob)[: int(len(blob) * left)]
+        out_file.with_suffix(".gz").write_bytes(partial)
+
+        registry = docker_pull.Registry(ssl=False)
+        registry.fetch_blob(
+            f"{reg.host}/v2/lib/img/blobs/{digest}",
+            out_file,
+            sha256=digest.split(":")[1],
+            headers={},
+            size=len(blob) * size,
+        )
+
+        assert out_file.read_bytes() == tar
+
+
+def test_async_corrupt_response_then_rerun(tmp_path):
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        digest, _ = big_layer(reg)
+        reg.corrupt[digest] = 1
+        cache = docker_pull.BlobCache(tmp_path / "cache")
+
+        fetcher = docker_pull.AsyncImageFetcher(
+            tmp_path / "out", blob_cache=cache
+        )
+        fetcher.set_registry(reg.host, ssl=False)
+        with pytest.raises(docker_pull.BLOB_ERRORS):
+            asyncio.run(fetcher.pull(f"{reg.host}/lib/img:1.0", "linux/amd64"))
+        assert not list((tmp_path / "out").rglob("*.gz"))
+        assert cache.get(digest) is None
+
+        assert pull(reg, tmp_path / "out", blob_cache=cache).ok
+        assert cache.get(digest) is not None
+
+
+@pytest.mark.parametrize("resume", [True, False])
+def test_dropped_stream(tmp_path, resume):
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        digest, _ = big_layer(reg)
+        reg.drop[digest] = 1
+        retry = docker_pull.RetryPolicy(attempts=1)
+
+        out = tmp_path / "out"
+        assert not pull(reg, out, retry=retry, resume=resume).ok
+        # the blob is kept for the next run only when it is resumed
+        assert bool(list(out.rglob("*.gz"))) == resume
+
+        assert pull(reg, out, retry=retry, resume=resume).ok
+        blob_path = f"/v2/lib/img/blobs/{digest}"
+        last = [r for r in reg.requests if r[1] == blob_path][-1]
+        assert ("Range" in last[2]) == resume
@@ -0,0 +1,154 @@
+import json
+import random
+
+import pytest
+
+import docker_pull
+from registry import StandInRegistry
+
+BIG = random.Random(2).randbytes(600000)
+LAYERS = [{"etc/os-release": b"NAME=stand-in\n"}, {"usr/lib/big": BIG}]
+TAR = "lib_img_1.0.tar"
+
+
+def pull(reg: StandInRegistry, out, **kwargs) -> docker_pull.PullResult:
+    fetcher = docker_pull.ImageFetcher(out, **kwargs)
+    fetcher.set_registry(reg.host, ssl=False)
+    [result] = fetcher.pull_many([f"{reg.host}/lib/img:1.0"], "linux/amd64")
+
+    return result
+
+
+def layer_digests(reg: StandInRegistry) -> list[str]:
+    _, manifest = reg.manifests[("lib/img", "1.0")]
+
+    return [layer["digest"] for layer in json.loads(manifest)["layers"]]
+
+
+def blob_requests(reg: StandInRegistry, digest: str) -> list[dict]:
+    """Headers of the GET requests of a blob"""
+
+    path = f"/v2/lib/img/blobs/{digest}"
+
+    return [h for m, p, h in reg.requests if m == "GET" and p == path]
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+@pytest.mark.parametrize("stream_extract", [True, False])
+def test_resume_after_drop(tmp_path, stream_extract, ranges):
+    with StandInRegistry(ranges=ranges) as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        assert pull(reg, tmp_path / "clean").ok
+        digest = layer_digests(reg)[1]
+
+        reg.drop[digest] = 2
+        del reg.requests[:]
+        retry = docker_pull.RetryPolicy(attempts=3, backoff=0.01)
+        out = tmp_path / "out"
+        assert pull(reg, out, retry=retry, stream_extract=stream_extract).ok
+
+    assert (out / TAR).read_bytes() == (tmp_path / "clean" / TAR).read_bytes()
+    assert retry.retries == 2
+
+    first, *resumed = blob_requests(reg, digest)
+    assert "Range" not in first
+    # each resumes after the bytes received so far, the registry that
+    # ignores ranges sends the blob again and its head is skipped
+    offsets = [int(h["Range"][6:-1]) for h in resumed]
+    assert len(offsets) == 2 and 0 < offsets[0] <= offsets[1]
+    assert (offsets[0] < offsets[1]) == ranges
+
+
+def test_segmented_drop(tmp_path):
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        assert pull(reg, tmp_path / "clean").ok
+        digest = layer_digests(reg)[1]
+
+        reg.drop[digest] = 1
+        del reg.requests[:]
+        retry = docker_pull.RetryPolicy(attempts=2, backoff=0.01)
+        out = tmp_path / "out"
+        result = pull(
+            reg,
+            out,
+            retry=retry,
+            segments=4,
+            segment_threshold=1,
+            jobs=1,
+        )
+        assert result.ok
+
+    assert (out / TAR).read_bytes() == (tmp_path / "clean" / TAR).read_bytes()
+    assert retry.retries == 1
+
+    ends = [h["Range"].split("-")[1] for h in blob_requests(reg, digest)]
+    # the four segments, and the rest of the one cut off
+    assert len(ends) == 5 and len(set(ends)) == 4
+    assert not list(out.rglob("*.segments"))
+
+
+@pytest.mark.skipif(
+    docker_pull.LIBCRYPTO is None, reason="the sha256 state needs libcrypto"
+)
+def test_sha256_checkpoint(tmp_path, monkeypatch):
+    """A rerun hashes only the bytes after the checkpoint of a partial blob"""
+
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        assert pull(reg, tmp_path / "clean").ok
+        digest = layer_digests(reg)[1]
+        blob = reg.blobs[digest]
+
+        reg.drop[digest] = 1
+        retry = docker_pull.RetryPolicy(attempts=1)
+        out = tmp_path / "out"
+        assert not pull(reg, out, retry=retry, stream_extract=False).ok
+
+        small = layer_digests(reg)[0]
+        [partial] = out.rglob("*.gz")
+        checkpoint = json.loads(
+            docker_pull.sha256_state_file(partial).read_text()
+        )
+        done = partial.stat().st_size
+        assert checkpoint["offset"] == done > 0
+
+        hashed = []
+        update = docker_pull.Sha256.update
+
+        def counting(self, data):
+            hashed.append(len(data))
+            return update(self, data)
+
+        monkeypatch.setattr(docker_pull.Sha256, "update", counting)
+        del reg.requests[:]
+        assert pull(reg, out, retry=retry, stream_extract=False).ok
+
+    assert (out / TAR).read_bytes() == (tmp_path / "clean" / TAR).read_bytes()
+    [request] = blob_requests(reg, digest)
+    assert request["Range"] == f"bytes={done}-"
+    refetched = len(blob_requests(reg, small)) * len(reg.blobs[small])
+    assert sum(hashed) == len(blob) - done + refetched
+    assert not list(out.rglob("*.sha256"))
+
+
+@pytest.mark.parametrize("direct_tar", [True, False])
+def test_update_reuses_layers(tmp_path, direct_tar):
+    """--update downloads only the layers the saved tar does not have"""
+
+    top = {"etc/motd": b"changed\n"}
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        out = tmp_path / "out"
+        assert pull(reg, out, update=True, direct_tar=direct_tar).ok
+
+        reg.add_image("lib/img", "1.0", [*LAYERS, top])
+        assert pull(reg, tmp_path / "clean").ok
+        big, changed = layer_digests(reg)[1:]
+
+        del reg.requests[:]
+        assert pull(reg, out, update=True, direct_tar=direct_tar).ok
+
+    assert (out / TAR).read_bytes() == (tmp_path / "clean" / TAR).read_bytes()
+    assert len(blob_requests(reg, changed)) == 1
+    assert not blob_requests(reg, big)
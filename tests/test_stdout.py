@@ -0,0 +1,74 @@
+import io
+import time
+
+import pytest
+
+import docker_pull
+from registry import StandInRegistry
+
+LAYERS = [{f"layer/{i}": bytes([i]) * 50000} for i in range(6)]
+
+
+class Pipe(io.BytesIO):
+    """A slow reader on the other end of the image tar"""
+
+    def seekable(self) -> bool:
+        return False
+
+    def write(self, data) -> int:
+        time.sleep(0.001)
+        return super().write(data)
+
+
+def pull(reg: StandInRegistry, work_dir, **kwargs):
+    fetcher = docker_pull.ImageFetcher(work_dir, **kwargs)
+    fetcher.set_registry(reg.host, ssl=False)
+    [result] = fetcher.pull_many([f"{reg.host}/lib/img:1.0"], "linux/amd64")
+    assert result.ok
+
+
+@pytest.mark.parametrize("stream_extract", [True, False])
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_pipe_output(tmp_path, monkeypatch, stream_extract, jobs):
+    with StandInRegistry() as reg:
+        reg.add_image("lib/img", "1.0", LAYERS)
+        pull(reg, tmp_path / "clean")
+
+        waiting = []
+        prefetch_layer = docker_pull.ImageFetcher._prefetch_layer
+
+        def counting(self, registry, url, out_file, *args, **kwargs):
+            waiting.append(len(list(out_file.parent.iterdir())))
+            return prefetch_layer(
+                self, registry, url, out_file, *args, **kwargs
+            )
+
+        inflated = []
+        iter_unzip = docker_pull.iter_unzip
+
+        def counting_unzip(path, *args, **kwargs):
+            inflated.append(path)
+            return iter_unzip(path, *args, **kwargs)
+
+        monkeypatch.setattr(
+            docker_pull.ImageFetcher, "_prefetch_layer", counting
+        )
+        monkeypatch.setattr(docker_pull, "iter_unzip", counting_unzip)
+        del reg.requests[:]
+        out = Pipe()
+        pull(
+            reg,
+            tmp_path / "work",
+            output=out,
+            jobs=jobs,
+            stream_extract=stream_extract,
+        )
+
+    clean = tmp_path / "clean" / "lib_img_1.0.tar"
+    assert out.getvalue() == clean.read_bytes()
+
+    blobs = [path for _, path, _ in reg.requests if "/blobs/" in path]
+    assert len(blobs) == len(set(blobs)) == len(LAYERS) + 1
+    # a layer is inflated once, and only a few wait in the scratch
+    assert len(inflated) == (0 if stream_extract else len(LAYERS))
+    assert max(waiting) <= jobs * docker_pull.PREFETCH_LAYERS_PER_JOB
@@ -0,0 +1,99 @@
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+import docker_pull
+
+CREATED = 1700000000.5
+
+CONFIG = "a" * 64 + ".json"
+LAYERS = {
+    # layer id: layer.tar data, None for a link to the previous layer
+    "1" * 64: b"base layer" * 1000,
+    "2" * 64: b"top layer",
+    "3" * 64: None,
+}
+FILES = {
+    CONFIG: b'{"os":"linux"}',
+    "manifest.json": b'[{"Config":"' + CONFIG.encode() + b'"}]\n',
+    "repositories": b'{"lib/img":{"1.0":"' + b"3" * 64 + b'"}}\n',
+}
+
+
+@pytest.fixture(params=[0o022, 0o077])
+def umask(request):
+    old = os.umask(request.param)
+    yield request.param
+    os.umask(old)
+
+
+def image_dir(path: Path) -> Path:
+    """The image dir as _write_dir saves it"""
+
+    fsm = docker_pull.FilesManager(path)
+    previous = None
+    for layer_id, data in LAYERS.items():
+        with fsm(layer_id) as fw:
+            fw.write("VERSION", "1.0")
+            fw.write("json", f'{{"id":"{layer_id}"}}')
+            if data is None:
+                os.symlink(
+                    f"../{previous}/layer.tar", fw.filepath("layer.tar")
+                )
+            else:
+                fw.write("layer.tar", data)
+
+        previous = layer_id
+
+    for name, data in FILES.items():
+        fsm.write(name, data)
+
+    return path
+
+
+def tar_writer_bytes(seekable: bool) -> bytes:
+    """The image tar as _write_tar writes it"""
+
+    out = io.BytesIO()
+    previous = None
+    with docker_pull.TarWriter(out, CREATED) as tar:
+        for name in sorted([*FILES, *LAYERS]):
+            if name in FILES:
+                tar.add_bytes(name, FILES[name])
+                continue
+
+            tar.add_dir(name)
+            tar.add_bytes(f"{name}/VERSION", b"1.0")
+            tar.add_bytes(f"{name}/json", f'{{"id":"{name}"}}'.encode())
+
+            data = LAYERS[name]
+            if data is None:
+                link = f"../{previous}/layer.tar"
+                tar.add_symlink(f"{name}/layer.tar", link)
+            elif seekable:
+                with tar.open_stream(f"{name}/layer.tar") as f:
+                    f.write(data)
+            else:
+                with tar.open_sized(f"{name}/layer.tar", len(data)) as f:
+                    f.write(data)
+
+            previous = name
+
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+def test_tar_writer_matches_make_tar(tmp_path, umask, seekable):
+    tar_path = tmp_path / "image.tar"
+    docker_pull.make_tar(tar_path, image_dir(tmp_path / "image"), CREATED)
+
+    assert tar_writer_bytes(seekable) == tar_path.read_bytes()
+
+
+def test_open_sized_checks_size():
+    tar = docker_pull.TarWriter(io.BytesIO(), CREATED)
+    with pytest.raises(ValueError):
+        with tar.open_sized("layer.tar", 10) as f:
+            f.write(b"short")
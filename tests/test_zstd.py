@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import docker_pull
+
+zstandard = pytest.importorskip("zstandard")
+
+
+def decompressor() -> docker_pull.ZstdDecompressor:
+    try:
+        return docker_pull.ZstdDecompressor()
+    except ValueError as e:
+        pytest.skip(str(e))
+
+
+def decompress(data: bytes, chunk_size: int, step: int) -> list[bytes]:
+    d = decompressor()
+    pieces = []
+    for i in range(0, len(data), step):
+        pieces.extend(d.decompress(data[i : i + step], chunk_size))
+    pieces.append(d.flush())
+
+    return pieces
+
+
+def test_output_is_limited_by_chunk_size():
+    data = zstandard.ZstdCompressor().compress(bytes(64 << 20))
+    assert len(data) < 6000
+
+    pieces = decompress(data, 65536, len(data))
+
+    assert max(len(p) for p in pieces) <= 65536
+    assert sum(len(p) for p in pieces) == 64 << 20
+    assert not any(any(p) for p in pieces)
+
+
+@pytest.mark.parametrize("step", [1, 1000, 1 << 20])
+def test_frames(step):
+    frames = [os.urandom(100000), b"a" * 300000, b"", b"end"]
+    data = b"".join(zstandard.ZstdCompressor().compress(f) for f in frames)
+
+    pieces = decompress(data, 4096, step)
+
+    assert max(len(p) for p in pieces) <= 4096
+    assert b"".join(pieces) == b"".join(frames)
+
+
+def test_truncated():
+    data = zstandard.ZstdCompressor().compress(os.urandom(1000))
+
+    with pytest.raises(EOFError):
+        decompress(data[:-10], 4096, 100)